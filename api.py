@@ -1,8 +1,16 @@
 from slack import WebClient
-import sys
-import hmac
+from slack.errors import SlackApiError
+import aiohttp
 import hashlib
+import asyncio
+import json
+from functools import partial
 import ui
+from cache import TTLCache
+from ingress import SignatureVerifier
+from backend import MemoryBackend
+from workers import fan_out
+from ratelimit import SlackCallScheduler, PRIORITY_URGENT, PRIORITY_NORMAL, PRIORITY_LOW
 
 INTERACTION_STUDENT_REFRESH = 'RefreshHomePage'
 INTERACTION_STUDENT_CONNECT_TA = 'ConnectTA'
@@ -15,33 +23,217 @@ INTERACTION_TA_MASTER_SWITCH = 'TASwitch'
 INTERACTION_ADMIN_RESET = 'AdminReset'
 INPUT_TA_PASS_ID = 'TAPassID'
 
+USER_CACHE_SIZE = 20000
+USER_CACHE_TTL = 6 * 60 * 60
+USERS_LIST_PAGE_SIZE = 200
+IM_CACHE_SIZE = 20000
+IM_CACHE_TTL = 24 * 60 * 60
+HOME_VIEW_CACHE_TTL = 60 * 60
+HTTP_POOL_SIZE = 64             # Open connections to Slack, calls beyond this wait for a free one
+HTTP_KEEPALIVE = 60             # Seconds an idle connection is kept for reuse
+HTTP_DNS_CACHE_TTL = 5 * 60
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical calls: callers asking for the same key while a call is in flight share its result
+    Nothing is cached once the call finishes.
+    """
+
+    def __init__(self):
+        self._in_flight = dict()  # key -> future
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    async def do(self, key, coro_fn):
+        """
+        :param key: Hashable identity of the call, e.g. (method, argument)
+        :param coro_fn: Zero-argument coroutine function performing the call
+        """
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(coro_fn())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # Shield so one cancelled caller does not cancel the call for everyone else
+        return await asyncio.shield(future)
+
+
+class UserDirectory:
+    """
+    In-memory user profile cache: user ID -> (display name, team ID)
+    Filled in bulk from users.list pages, on demand from users.info, and kept fresh by user_change events
+    """
+
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self._users = TTLCache(maxsize, ttl)
+
+    def __len__(self):
+        return len(self._users)
+
+    def update(self, user):
+        """ Store a user object as found in users.list / users.info / user_change payloads """
+        return self.set(user['id'], user['profile']['display_name'], user['team_id'])
+
+    def set(self, user_id, name, team_id):
+        entry = (name, team_id)
+        self._users.set(user_id, entry)
+        return entry
+
+    def load_page(self, members):
+        for user in members:
+            self.update(user)
+
+    def get(self, user_id, count=True):
+        """
+        :param count: Whether the lookup counts towards hit / miss statistics
+        :return: (display name, team ID) or None if not cached
+        """
+        return self._users.get(user_id, count=count)
+
+    @property
+    def hits(self):
+        return self._users.hits
+
+    @property
+    def misses(self):
+        return self._users.misses
+
+    def hit_rate(self):
+        return self._users.hit_rate()
+
 
 class Slack:
-    def __init__(self, bot_token, signing_secret):
+    def __init__(self, bot_token, signing_secret, base_url=None, ssl_context=None):
+        """
+        :param base_url: Web API root, defaults to slack.com. Load tests point it at benchmarks/fake_slack.py
+        :param ssl_context: Used for every connection to Slack, e.g. with certifi's CA bundle
+        """
         # Initialize a Web API client
         # Note: Slack WebClient need to be in async mode in order to get two request at same time to work
         # https://github.com/slackapi/python-slackclient/issues/429
-        self.slack_web_client = WebClient(token=bot_token, run_async=True)
-        slack_web_client_sync = WebClient(token=bot_token, run_async=False)  # TODO: Messy...
-        self.bot_user = slack_web_client_sync.auth_test()
-        self.all_users = slack_web_client_sync.users_list()
-        self.id_to_name = dict()
-        self.id_to_teamId = dict()
-        self.signing_secret = signing_secret
+        client_kwargs = {'base_url': base_url} if base_url is not None else {}
+        self.slack_web_client = WebClient(token=bot_token, run_async=True, ssl=ssl_context, **client_kwargs)
+        self.ssl_context = ssl_context
+        self.http_session = None  # Shared keep-alive session, see open_session
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.bot_user_id = None  # Set by fetch_identity
+        self.users = UserDirectory()
+        self.im_channels = TTLCache(IM_CACHE_SIZE, IM_CACHE_TTL)  # user ID -> IM channel ID
+        self._im_channel_users = TTLCache(IM_CACHE_SIZE, IM_CACHE_TTL)  # IM channel ID -> user ID
+        self._home_view_hashes = TTLCache(USER_CACHE_SIZE, HOME_VIEW_CACHE_TTL)  # user ID -> last published view
+        self.home_views_skipped = 0
+        self.verifier = SignatureVerifier(signing_secret)  # HMAC keyed once, copied per request
+        self._single_flight = SingleFlight()
+        self.scheduler = SlackCallScheduler()  # Every async Web API call goes through here
+        self.backend = MemoryBackend()  # Second-level cache shared with other worker processes
+
+    # Startup, nothing calls Slack before the event loop runs
+    async def open_session(self):
+        """
+        One keep-alive session for every Web API call
+        Without it the SDK opens a new session, and a new TCP + TLS handshake, for each call.
+        """
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_connection_created)
+        trace.on_connection_reuseconn.append(self._on_connection_reused)
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=HTTP_KEEPALIVE,
+                                         ttl_dns_cache=HTTP_DNS_CACHE_TTL, ssl=self.ssl_context)
+        self.http_session = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+        self.slack_web_client.session = self.http_session
+
+    async def close(self):
+        """ Stop sending calls and close pooled connections """
+        await self.scheduler.stop()
+        if self.http_session is not None:
+            await self.http_session.close()
+            self.http_session = None
+
+    async def _on_connection_created(self, session, context, params):
+        self.connections_created += 1
+
+    async def _on_connection_reused(self, session, context, params):
+        self.connections_reused += 1
+
+    async def fetch_identity(self):
+        """ Who the bot is, needed before handling messages """
+        self.bot_user_id = (await self._call('auth.test', self.slack_web_client.auth_test, PRIORITY_URGENT))['user_id']
+
+    async def load_all_users(self):
+        """
+        Prewarm user directory with every users.list page, each page is usable as soon as it arrives
+        Lookups for users not loaded yet fall back to users.info.
+        """
+        cursor = None
+        while True:
+            page = await self._call('users.list', self.slack_web_client.users_list, PRIORITY_LOW,
+                                    limit=USERS_LIST_PAGE_SIZE, cursor=cursor)
+            self.users.load_page(page['members'])
+            cursor = page.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+
+    async def on_user_change(self, user):
+        """ user_change event handler, refreshes the cached profile here and for other worker processes """
+        cached = self.users.update(user)
+        await self.backend.run(self.backend.kv_set, 'user:' + user['id'], cached, USER_CACHE_TTL)
+
+    async def _get_user(self, user_id):
+        cached = self.users.get(user_id)
+        if cached is None:
+            shared = await self.backend.read(self.backend.kv_get, 'user:' + user_id)
+            if shared is not None:
+                return self.users.set(user_id, *shared)
+            cached = self.users.update((await self._users_info(user_id))['user'])
+            await self.backend.run(self.backend.kv_set, 'user:' + user_id, cached, USER_CACHE_TTL)
+        return cached
+
+    # Read-style calls, coalesced while in flight
+    async def _users_info(self, user_id):
+        return await self._single_flight.do(
+            ('users.info', user_id),
+            lambda: self._call('users.info', self.slack_web_client.users_info, user=user_id))
+
+    async def _conversations_info(self, channel_id):
+        return await self._single_flight.do(
+            ('conversations.info', channel_id),
+            lambda: self._call('conversations.info', self.slack_web_client.conversations_info, channel=channel_id))
+
+    async def _conversations_open(self, user_id):
+        return await self._single_flight.do(
+            ('conversations.open', user_id),
+            lambda: self._call('conversations.open', self.slack_web_client.conversations_open, users=[user_id]))
+
+    async def _call(self, api_method, client_fn, priority=PRIORITY_NORMAL, shard=None, **kwargs):
+        """
+        Run a Web API call through the rate-limit aware scheduler
+        :param api_method: Slack method name, selects the rate tier bucket
+        :param client_fn: Bound WebClient method
+        :param shard: Fair share key within the method's budget, see SlackCallScheduler
+        :return: Response data
+        """
+        return await self.scheduler.call(api_method, lambda: self._request(client_fn, **kwargs), priority,
+                                         kwargs.get('channel'), shard)
+
+    @staticmethod
+    async def _request(client_fn, **kwargs):
+        return (await client_fn(**kwargs)).data
 
     async def get_user_name(self, user_id):
-        if user_id not in self.id_to_name.keys():
-            self.id_to_name[user_id] = \
-                (await self.slack_web_client.users_info(user=user_id)).data['user']['profile']['display_name']
-        return self.id_to_name[user_id]
+        return (await self._get_user(user_id))[0]
+
+    def cached_user_name(self, user_id):
+        """ Display name if cached, else the user ID. Never calls Slack, for log lines """
+        cached = self.users.get(user_id, count=False)
+        return cached[0] if cached is not None else user_id
 
     async def get_user_teamid(self, user_id):
-        if user_id not in self.id_to_teamId.keys():
-            self.id_to_teamId[user_id] = (await self.slack_web_client.users_info(user=user_id)).data['user']['team_id']
-        return self.id_to_teamId[user_id]
+        return (await self._get_user(user_id))[1]
 
     async def get_channel_name(self, channel_id):
-        channel_info = (await self.slack_web_client.conversations_info(channel=channel_id)).data['channel']
+        channel_info = (await self._conversations_info(channel_id))['channel']
         if channel_info['is_im']:
             im_with = channel_info['user']
             return f'Private Message with {await self.get_user_name(im_with)}'
@@ -49,30 +241,91 @@ class Slack:
             return channel_info['name_normalized']
 
     def is_this_bot(self, user_id):
-        return user_id == self.bot_user.data['user_id']
+        return user_id == self.bot_user_id
 
-    async def send_chat_text(self, channel_id, text):
-        await self.slack_web_client.chat_postMessage(channel=channel_id, text=text)
+    async def send_chat_text(self, channel_id, text, priority=PRIORITY_NORMAL):
+        await self._post_message(priority, channel=channel_id, text=text)
         return self
 
-    async def send_chat_block(self, channel_id, block):
-        await self.slack_web_client.chat_postMessage(channel=channel_id, blocks=block)
+    async def send_chat_block(self, channel_id, block, priority=PRIORITY_NORMAL):
+        await self._post_message(priority, channel=channel_id, blocks=block)
         return self
 
-    async def send_home_view(self, user_id, view):
-        await self.slack_web_client.views_publish(user_id=user_id, view=view)
+    async def _post_message(self, priority, **kwargs):
+        try:
+            await self._call('chat.postMessage', self.slack_web_client.chat_postMessage, priority, **kwargs)
+        except SlackApiError as e:
+            if e.response['error'] == 'channel_not_found':
+                await self.forget_im_channel(kwargs['channel'])
+            raise
+
+    async def send_home_view(self, user_id, view, force=False, priority=PRIORITY_NORMAL, shard=None):
+        """
+        Publish App Home, skipped if it is identical to what this user was last sent
+        :param view: View dict, or a view already serialized to a JSON string (sent as is)
+        :param force: Publish even if unchanged, e.g. when the user opens their home and Slack's copy may be stale
+        :param priority: NORMAL when the user is waiting on it after a click, PRIORITY_BACKGROUND for pushes
+        :param shard: Queue section, sections take turns in the shared views.publish budget
+        """
+        serialized = view if isinstance(view, str) else json.dumps(view, separators=(',', ':'))
+        view_hash = hashlib.blake2b(serialized.encode(), digest_size=16).digest()
+        if not force and self._home_view_hashes.get(user_id) == view_hash:
+            self.home_views_skipped += 1
+            return self
+        # Form encoded, where views.publish takes the view as a JSON string field. views_publish() would send a
+        # JSON body, encoding the already serialized view a second time.
+        try:
+            await self._call('views.publish', partial(self.slack_web_client.api_call, 'views.publish'), priority, shard,
+                             data={'user_id': user_id, 'view': serialized})
+        except BaseException:  # Cancellation too
+            self._home_view_hashes.pop(user_id)  # Unknown what Slack shows now, next publish must go through
+            raise
+        self._home_view_hashes.set(user_id, view_hash)
         return self
 
     async def send_modal(self, trigger_id, modal):
-        await self.slack_web_client.views_open(trigger_id=trigger_id, view=modal)
+        # trigger_id expires 3 seconds after the click
+        await self._call('views.open', self.slack_web_client.views_open, PRIORITY_URGENT,
+                         trigger_id=trigger_id, view=modal)
         return self
 
     async def delete_chat(self, channel_id, msg_ts):
-        await self.slack_web_client.chat_delete(channel=channel_id, ts=msg_ts)
+        await self._call('chat.delete', self.slack_web_client.chat_delete, channel=channel_id, ts=msg_ts)
         return self
 
+    async def get_channel_members(self, channel_id):
+        """ All member IDs of a channel, every page """
+        members = []
+        cursor = None
+        while True:
+            page = await self._call('conversations.members', self.slack_web_client.conversations_members,
+                                    channel=channel_id, limit=USERS_LIST_PAGE_SIZE, cursor=cursor)
+            members += page['members']
+            cursor = page.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return members
+
     async def get_im_channel(self, user_id):
-        return (await self.slack_web_client.conversations_open(users=[user_id]))['channel']['id']
+        channel_id = self.im_channels.get(user_id)
+        if channel_id is None:
+            channel_id = await self.backend.read(self.backend.kv_get, 'im:' + user_id)
+            if channel_id is None:
+                channel_id = (await self._conversations_open(user_id))['channel']['id']
+                await self.backend.run(self.backend.kv_set, 'im:' + user_id, channel_id, IM_CACHE_TTL)
+            self.im_channels.set(user_id, channel_id)
+            self._im_channel_users.set(channel_id, user_id)
+        return channel_id
+
+    async def forget_im_channel(self, channel_id):
+        """ Drop a cached IM channel here and in the shared cache, next get_im_channel for its user opens it again """
+        user_id = self._im_channel_users.pop(channel_id)
+        if user_id is not None:
+            self.im_channels.pop(user_id)
+            await self.backend.run(self.backend.kv_delete, 'im:' + user_id)
+
+    async def warm_im_channels(self, user_ids):
+        """ Open and cache IM channels for users not cached yet """
+        return await fan_out([uid for uid in user_ids if uid not in self.im_channels], self.get_im_channel)
 
     async def get_request_block(self, student_uid):
         student_name = await self.get_user_name(student_uid)
@@ -80,45 +333,10 @@ class Slack:
         return [
             ui.text(f"You have a new request from {student_name}:\n*<{student_im}|Click to chat with {student_name} >*"),
             # ui.text(f"*Question Brief:*\n<FIXME>"),
-            ui.actions([ui.button_styled("Finished!", INTERACTION_TA_DONE, "primary")
-                        # ui.button_styled("Pass to Other TA", INTERACTION_TA_PASS, "danger")
-                        ])
+            ui.actions([ui.button_styled("Finished!", INTERACTION_TA_DONE, "primary"),
+                        ui.button_styled("Pass to Other TA", INTERACTION_TA_PASS, "danger")])
         ]
 
     def verify_signature(self, timestamp, signature, data):
-        # Verify the request signature of the request sent from Slack
-        # Generate a new hash using the app's signing secret and request data
-
-        # Compare the generated hash and incoming request signature
-        # Python 2.7.6 doesn't support compare_digest
-        # It's recommended to use Python 2.7.7+
-        # noqa See https://docs.python.org/2/whatsnew/2.7.html#pep-466-network-security-enhancements-for-python-2-7
-        if hasattr(hmac, "compare_digest"):
-            req = str.encode('v0:' + str(timestamp) + ':') + data
-            request_hash = 'v0=' + hmac.new(
-                str.encode(self.signing_secret),
-                req, hashlib.sha256
-            ).hexdigest()
-            # Compare byte strings for Python 2
-            if (sys.version_info[0] == 2):
-                return hmac.compare_digest(bytes(request_hash), bytes(signature))
-            else:
-                return hmac.compare_digest(request_hash, signature)
-        else:
-            # So, we'll compare the signatures explicitly
-            req = str.encode('v0:' + str(timestamp) + ':') + data
-            request_hash = 'v0=' + hmac.new(
-                str.encode(self.signing_secret),
-                req, hashlib.sha256
-            ).hexdigest()
-
-            if len(request_hash) != len(signature):
-                return False
-            result = 0
-            if isinstance(request_hash, bytes) and isinstance(signature, bytes):
-                for x, y in zip(request_hash, signature):
-                    result |= x ^ y
-            else:
-                for x, y in zip(request_hash, signature):
-                    result |= ord(x) ^ ord(y)
-            return result == 0
+        """ Verify the request signature and timestamp of a request sent from Slack """
+        return self.verifier.verify(timestamp, signature, data)
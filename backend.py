@@ -0,0 +1,185 @@
+import asyncio
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from time import time
+
+
+class MemoryBackend:
+    """
+    Default backend: state lives only in this process
+    QueueManager keeps its state in its own objects, nothing is shared or reloaded.
+    """
+    shared = False
+
+    def __init__(self):
+        self._user_sections = dict()
+
+    async def run(self, fn, *args):
+        """ Call one of the methods below from the event loop; nothing blocks here, so inline """
+        return fn(*args)
+
+    read = run
+
+    def section_of(self, user_id):
+        return self._user_sections.get(user_id)
+
+    def set_section(self, user_id, section):
+        self._user_sections[user_id] = section
+
+    def kv_get(self, key):
+        return None
+
+    def kv_set(self, key, value, ttl):
+        pass
+
+    def kv_delete(self, key):
+        pass
+
+
+class Transaction:
+    """ Open write transaction on one section's shared state """
+
+    def __init__(self, version, state_json):
+        self.version = version          # None if the section has never been written
+        self._state_json = state_json
+        self.new_state = None
+
+    @property
+    def state(self):
+        return json.loads(self._state_json) if self._state_json is not None else None
+
+    def commit(self, state):
+        """ Stage the section's new state, written when the transaction exits """
+        self.new_state = state
+
+
+class SQLiteBackend:
+    """
+    State shared by every worker process on this host, in one SQLite database in WAL mode
+    - Each section's state is one versioned row. Transitions run inside BEGIN IMMEDIATE, so writers on the
+      same database are serialized across processes; a process whose copy is behind reloads before applying.
+    - Readers only compare the version number, a point query, and reload when it moved.
+    - Also holds user -> section routing and a small key-value store for Slack lookups.
+    Methods block (up to busy_timeout waiting for another process' write lock), so the event loop calls them
+    through run() and transaction(), which use the write connection from one background thread, one call at a
+    time. Reads (version, load, section_of, kv_get) go through read() instead: a second connection on its own
+    thread, which WAL lets read the last commit while a write transaction is open, so they never wait for one.
+    Called directly only before serving, e.g. while restoring at startup.
+    """
+    shared = True
+
+    def __init__(self, path, busy_timeout=5.0):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-backend')
+        self._lock = None           # asyncio.Lock, an open transaction owns the connection until it ends
+        self._db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS section_state '
+                         '(section TEXT PRIMARY KEY, version INTEGER, state TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS user_section (user_id TEXT PRIMARY KEY, section TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-backend-read')
+        self._read_db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+
+    def close(self):
+        """ Blocking, run off the event loop """
+        self._executor.shutdown()
+        self._reader.shutdown()
+        self._db.close()
+        self._read_db.close()
+
+    async def run(self, fn, *args):
+        """ Call one of the blocking methods below on the backend thread """
+        async with self._get_lock():
+            return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+    async def read(self, fn, *args):
+        """ Call one of the read methods below on the reader thread, not waiting for writes or transactions """
+        return await asyncio.get_event_loop().run_in_executor(self._reader, fn, *args)
+
+    @asynccontextmanager
+    async def transaction(self, section):
+        """
+        Write transaction on one section's state, for `async with`. The body runs on the event loop and must not
+        await: the cross-process write lock is held until it exits.
+        """
+        loop = asyncio.get_event_loop()
+        async with self._get_lock():
+            txn = await loop.run_in_executor(self._executor, self._begin, section)
+            try:
+                yield txn
+            except BaseException:
+                await loop.run_in_executor(self._executor, self._rollback)
+                raise
+            await loop.run_in_executor(self._executor, self._commit, section, txn)
+
+    def _get_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _begin(self, section):
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._db.execute('SELECT version, state FROM section_state WHERE section = ?', (section,)).fetchone()
+        except BaseException:
+            self._rollback()
+            raise
+        return Transaction(*row) if row is not None else Transaction(None, None)
+
+    def _commit(self, section, txn):
+        try:
+            if txn.new_state is not None:
+                version = (txn.version or 0) + 1
+                self._db.execute('INSERT OR REPLACE INTO section_state (section, version, state) VALUES (?, ?, ?)',
+                                 (section, version, json.dumps(txn.new_state)))
+                txn.version = version
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._rollback()
+            raise
+
+    def _rollback(self):
+        if self._db.in_transaction:
+            self._db.execute('ROLLBACK')
+
+    def version(self, section):
+        row = self._read_db.execute('SELECT version FROM section_state WHERE section = ?', (section,)).fetchone()
+        return row[0] if row is not None else None
+
+    def load(self, section):
+        """ :return: (version, state) or (None, None) """
+        row = self._read_db.execute('SELECT version, state FROM section_state WHERE section = ?', (section,)).fetchone()
+        return (row[0], json.loads(row[1])) if row is not None else (None, None)
+
+    def section_of(self, user_id):
+        row = self._read_db.execute('SELECT section FROM user_section WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_section(self, user_id, section):
+        self._db.execute('INSERT OR REPLACE INTO user_section (user_id, section) VALUES (?, ?)', (user_id, section))
+
+    def kv_get(self, key):
+        row = self._read_db.execute('SELECT value, expires FROM kv WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < time():
+            return None
+        return json.loads(row[0])
+
+    def kv_set(self, key, value, ttl):
+        self._db.execute('INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)',
+                         (key, json.dumps(value), time() + ttl))
+
+    def kv_delete(self, key):
+        self._db.execute('DELETE FROM kv WHERE key = ?', (key,))
+
+
+def create_backend(spec):
+    """ 'memory' or 'sqlite:<path>' """
+    if spec == 'memory':
+        return MemoryBackend()
+    if spec.startswith('sqlite:'):
+        return SQLiteBackend(spec[len('sqlite:'):])
+    raise ValueError(f'Unknown state backend: {spec}')
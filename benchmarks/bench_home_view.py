@@ -0,0 +1,86 @@
+"""
+App Home render + serialization microbenchmark: nested dicts + json.dumps vs pre-serialized ui templates
+Renders the view a logged-in TA sees while the system is on (panel, roster, login row), the heaviest home view
+Usage: python benchmarks/bench_home_view.py [renders] [busy_tas]
+"""
+import json
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ui  # noqa: E402
+
+# Button values, as in api.py (importing it needs the Slack SDK)
+REFRESH, CONNECT, LOGIN, SWITCH, RESET = 'RefreshHomePage', 'ConnectTA', 'TALogIn', 'TASwitch', 'AdminReset'
+
+PANEL_ACTIONS_RAW = ui.raw(ui.actions([ui.button_styled("System States Reset", RESET, "danger", ui.reset_confirm()),
+                                       ui.button_styled("Turn off system", SWITCH, "danger", ui.off_confirm())]))
+CONNECT_ROW = ui.Template(ui.actions([ui.button_styled(":telephone_receiver: Connect to a TA", CONNECT, "primary"),
+                                      ui.button("@@login_text@@", LOGIN)]))
+REFRESH_ROW_RAW = ui.raw(ui.actions([ui.button(":arrows_counterclockwise: Refresh", REFRESH)]))
+
+
+def render_dicts(state):
+    """ Before: every block built as fresh dicts, the whole view serialized on publish """
+    blocks = [
+        ui.welcome_title(state['name']),
+        ui.greeting(True, True, True),
+        ui.DIVIDER,
+        ui.text(f"*{state['queue_length']} Students* waiting in queue"),
+        ui.text(state['queue_text']),
+        ui.actions([ui.button_styled("System States Reset", RESET, "danger", ui.reset_confirm()),
+                    ui.button_styled("Turn off system", SWITCH, "danger", ui.off_confirm())]),
+        ui.DIVIDER,
+        ui.active_ta(state['ta_count']),
+        ui.text(state['free_text']),
+        ui.list_quote_text(state['busy']),
+        ui.actions([ui.button_styled(":telephone_receiver: Connect to a TA", CONNECT, "primary"),
+                    ui.button("TA Logoff", LOGIN)]),
+        ui.actions([ui.button(":arrows_counterclockwise: Refresh", REFRESH)]),
+    ]
+    return json.dumps({"type": "home", "blocks": blocks}, separators=(',', ':'))
+
+
+def render_templates(state):
+    """ After: static blocks serialized once, dynamic slots spliced in """
+    return ui.view_raw("home", [
+        ui.welcome_title_raw(state['name']),
+        ui.greeting_raw(True, True, True),
+        ui.DIVIDER_RAW,
+        ui.text_raw(f"*{state['queue_length']} Students* waiting in queue"),
+        ui.text_raw(state['queue_text']),
+        PANEL_ACTIONS_RAW,
+        ui.DIVIDER_RAW,
+        ui.active_ta_raw(state['ta_count']),
+        ui.text_raw(state['free_text']),
+        ui.list_quote_text_raw(state['busy']),
+        CONNECT_ROW.fill(login_text="TA Logoff"),
+        REFRESH_ROW_RAW,
+    ])
+
+
+def timed(fn, state, n):
+    start = perf_counter()
+    for _ in range(n):
+        fn(state)
+    return perf_counter() - start
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    busy = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    state = {
+        'name': 'Ada Lovelace',
+        'queue_length': 25,
+        'queue_text': '\n'.join(f'{i + 1}. Student {i}' for i in range(25)),
+        'ta_count': busy + 3,
+        'free_text': 'TA A, TA B, TA C',
+        'busy': [f'TA {i} is helping Student {i}' for i in range(busy)],
+    }
+    assert json.loads(render_dicts(state)) == json.loads(render_templates(state))
+    dict_time = timed(render_dicts, state, n)
+    template_time = timed(render_templates, state, n)
+    print(f"{n} TA home views, {busy} busy TAs, {len(render_templates(state))} bytes each")
+    print(f"dicts + json.dumps: {dict_time / n * 1e6:7.1f} us/view")
+    print(f"templates:          {template_time / n * 1e6:7.1f} us/view  ({dict_time / template_time:.1f}x)")
@@ -0,0 +1,100 @@
+"""
+Request ingress microbenchmark: per-request HMAC keying + json vs Ingress (keyed HMAC copy + orjson if installed)
+Verifies and decodes signed Events API bodies (app_home_opened) and interaction bodies (block_actions click)
+Usage: python benchmarks/bench_ingress.py [requests]
+"""
+import hashlib
+import hmac
+import json
+import os
+import sys
+from time import perf_counter, time
+from urllib.parse import parse_qs, urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ingress import Ingress, SignatureVerifier, loads  # noqa: E402
+
+SECRET = '8f742231b10e8888abcd99yyyzzz85a5'
+
+
+def sign(timestamp, body):
+    return 'v0=' + hmac.new(SECRET.encode(), b'v0:' + timestamp.encode() + b':' + body, hashlib.sha256).hexdigest()
+
+
+def signed(body):
+    timestamp = str(int(time()))
+    return {'X-Slack-Request-Timestamp': timestamp, 'X-Slack-Signature': sign(timestamp, body)}, body
+
+
+def make_event(i):
+    return signed(json.dumps({
+        'token': 'x', 'team_id': 'T00000000', 'api_app_id': 'A00000000', 'type': 'event_callback',
+        'event_id': f'Ev{i:010d}', 'event_time': int(time()),
+        'event': {'type': 'app_home_opened', 'user': f'U{i:08d}', 'channel': f'D{i:08d}', 'tab': 'home',
+                  'view': {'id': f'V{i:08d}', 'type': 'home', 'blocks': [{'type': 'section', 'text': {'type': 'mrkdwn', 'text': 'x' * 60}}] * 12}},
+    }).encode())
+
+
+def make_interaction(i):
+    payload = {
+        'type': 'block_actions',
+        'user': {'id': f'U{i:08d}', 'username': f'student{i}', 'team_id': 'T00000000'},
+        'trigger_id': f'{i}.123456789.abcdef',
+        'container': {'type': 'view', 'view_id': f'V{i:08d}'},
+        'actions': [{'type': 'button', 'action_id': 'a', 'value': 'student_refresh', 'action_ts': str(time())}],
+        'view': {'id': f'V{i:08d}', 'type': 'home', 'blocks': [{'type': 'section', 'text': {'type': 'mrkdwn', 'text': 'x' * 60}}] * 12},
+    }
+    return signed(urlencode({'payload': json.dumps(payload)}).encode())
+
+
+def baseline_verify(headers, body):
+    """ What the endpoints did before: key a new HMAC per request """
+    timestamp = headers['X-Slack-Request-Timestamp']
+    assert abs(time() - int(timestamp)) <= 60 * 5
+    request_hash = 'v0=' + hmac.new(str.encode(SECRET), str.encode('v0:' + str(timestamp) + ':') + body,
+                                    hashlib.sha256).hexdigest()
+    assert hmac.compare_digest(request_hash, headers['X-Slack-Signature'])
+
+
+def run_baseline_events(requests):
+    for headers, body in requests:
+        baseline_verify(headers, body)
+        json.loads(body.decode('utf-8'))
+
+
+def run_baseline_interactions(requests):
+    for headers, body in requests:
+        baseline_verify(headers, body)
+        json.loads(parse_qs(body.decode('utf-8'))['payload'][0])
+
+
+def run_ingress_events(requests):
+    ingress = Ingress(SignatureVerifier(SECRET))
+    for headers, body in requests:
+        ingress.parse_event(headers, body)
+
+
+def run_ingress_interactions(requests):
+    ingress = Ingress(SignatureVerifier(SECRET))
+    for headers, body in requests:
+        ingress.parse_interaction(headers, body)
+
+
+def timed(fn, *args):
+    start = perf_counter()
+    fn(*args)
+    return perf_counter() - start
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f"{n} signed requests per kind, JSON decoder: {'orjson' if loads is not json.loads else 'json'}")
+    for kind, make, baseline, new in [('events', make_event, run_baseline_events, run_ingress_events),
+                                      ('interactions', make_interaction, run_baseline_interactions,
+                                       run_ingress_interactions)]:
+        requests = [make(i) for i in range(n)]
+        baseline_time = timed(baseline, requests)
+        ingress_time = timed(new, requests)
+        print(f"{kind} ({len(requests[0][1])} bytes)")
+        print(f"  baseline: {baseline_time / n * 1e6:7.1f} us/request")
+        print(f"  ingress:  {ingress_time / n * 1e6:7.1f} us/request  ({baseline_time / ingress_time:.2f}x)")
@@ -0,0 +1,104 @@
+"""
+Logging cost on the event loop: f-string fields awaiting a user lookup vs lazy %s fields,
+and a FileHandler writing inline vs the QueueHandler / listener thread from logs.py
+1% of users are not cached, looking them up waits one users.info round trip (--rtt).
+--stall-us adds a pause to every write, like a busy disk or a network file system.
+Usage: python benchmarks/bench_logging.py [--records 20000] [--rtt 0.02] [--stall-us 200]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+from time import perf_counter, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import logs  # noqa: E402
+
+USERS = {f'U{i:05d}': f'user-{i}' for i in range(99)}  # U00099 is never cached
+
+
+class SlowFileHandler(logging.FileHandler):
+
+    def __init__(self, path, stall):
+        super().__init__(path)
+        self.stall = stall
+
+    def emit(self, record):
+        super().emit(record)
+        if self.stall:
+            sleep(self.stall)
+
+
+def user_id(i):
+    return f'U{i % 100:05d}'
+
+
+async def log_fstring(logger, n, rtt):
+    async def get_user_name(uid):
+        if uid not in USERS:
+            await asyncio.sleep(rtt)  # users.info
+            return uid
+        return USERS[uid]
+
+    for i in range(n):
+        logger.debug(f"Student {await get_user_name(user_id(i))} requests a connection!")
+
+
+async def log_lazy(logger, n, rtt):
+    for i in range(n):
+        logger.debug("Student %s requests a connection!", logs.Lazy(USERS.get, user_id(i), user_id(i)))
+
+
+def timed(args, coro_fn, logger):
+    """ :return: µs per record """
+    start = perf_counter()
+    asyncio.get_event_loop().run_until_complete(coro_fn(logger, args.records, args.rtt))
+    return (perf_counter() - start) / args.records * 1e6
+
+
+def main(args):
+    logger = logging.getLogger('bench')
+    logger.propagate = False
+    directory = tempfile.mkdtemp()
+    formatter = logging.Formatter(logs.LOG_FORMAT)
+    print(f"{args.records} debug records, users.info {args.rtt * 1000:.0f} ms for the 1% uncached users,"
+          f" µs per record on the event loop")
+
+    logger.setLevel(logging.INFO)
+    print(f"DEBUG disabled            f-string + await: {timed(args, log_fstring, logger):8.2f}"
+          f"   lazy: {timed(args, log_lazy, logger):8.2f}")
+    logger.setLevel(logging.DEBUG)
+
+    for stall in sorted({0, args.stall_us}):
+        inline_handler = SlowFileHandler(os.path.join(directory, f'inline{stall}.log'), stall / 1e6)
+        inline_handler.setFormatter(formatter)
+        inline_handler.addFilter(logs.ContextFilter())
+        logger.addHandler(inline_handler)
+        print(f"FileHandler, {stall:4d} µs stall f-string + await: {timed(args, log_fstring, logger):8.2f}"
+              f"   lazy: {timed(args, log_lazy, logger):8.2f}")
+        logger.removeHandler(inline_handler)
+        inline_handler.close()
+
+        queued_handler = SlowFileHandler(os.path.join(directory, f'queued{stall}.log'), stall / 1e6)
+        queued_handler.setFormatter(formatter)
+        root_handlers = logging.getLogger().handlers[:]
+        listener = logs.start_logging([queued_handler])
+        logger.propagate = True
+        fstring, lazy = timed(args, log_fstring, logger), timed(args, log_lazy, logger)
+        start = perf_counter()
+        listener.stop()
+        print(f"QueueHandler, {stall:3d} µs stall f-string + await: {fstring:8.2f}   lazy: {lazy:8.2f}"
+              f"   (writer thread finished {perf_counter() - start:.2f} s later)")
+        logger.propagate = False
+        logging.getLogger().handlers = root_handlers
+        queued_handler.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--rtt', type=float, default=0.02, help='users.info latency, seconds')
+    parser.add_argument('--stall-us', type=int, default=200, help='Pause per log write, microseconds')
+    main(parser.parse_args())
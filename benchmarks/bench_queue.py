@@ -0,0 +1,54 @@
+"""
+Student queue microbenchmark: plain list vs IndexedQueue
+Simulates one round of refreshes (every queued student looks up their position) plus random cancellations
+Usage: python benchmarks/bench_queue.py [queued_students]
+"""
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from structures import IndexedQueue  # noqa: E402
+
+
+def run_list(ids, cancels):
+    queue = []
+    for sid in ids:
+        queue.append(sid)
+    for sid in ids:
+        queue.index(sid)
+    for sid in cancels:
+        queue.remove(sid)
+    while len(queue) != 0:
+        queue.remove(queue[0])
+
+
+def run_indexed(ids, cancels):
+    queue = IndexedQueue()
+    for sid in ids:
+        queue.append(sid)
+    for sid in ids:
+        queue.position(sid)
+    for sid in cancels:
+        queue.remove(sid)
+    while len(queue) != 0:
+        queue.popleft()
+
+
+def timed(fn, *args):
+    start = perf_counter()
+    fn(*args)
+    return perf_counter() - start
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rng = random.Random(0)
+    ids = [f'U{i:08d}' for i in range(n)]
+    cancels = rng.sample(ids, n // 10)
+    list_time = timed(run_list, ids, cancels)
+    indexed_time = timed(run_indexed, ids, cancels)
+    print(f"{n} queued students, {len(cancels)} cancellations")
+    print(f"list:         {list_time * 1000:9.1f} ms")
+    print(f"IndexedQueue: {indexed_time * 1000:9.1f} ms  ({list_time / indexed_time:.1f}x)")
@@ -0,0 +1,91 @@
+"""
+Startup benchmark against benchmarks/fake_slack.py
+Times the old blocking bootstrap (auth.test + every users.list page before binding) and the async one:
+time until the server answers, until /status reports ready, and until the user directory is fully loaded.
+users.list is a Tier 2 method, so the full directory load is paced by the rate limiter, not by startup.
+Usage: python benchmarks/bench_startup.py [--users 1000] [--latency 0.1]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from time import perf_counter
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import aiohttp
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_slack import FakeSlack, free_port  # noqa: E402
+
+
+def blocking_bootstrap(base_url, page_size=200):
+    """ What importing bot.py used to do before hypercorn could bind """
+    urlopen(base_url + 'auth.test', data=b'').read()
+    cursor = ''
+    while True:
+        page = json.loads(urlopen(base_url + 'users.list?' + urlencode({'limit': page_size, 'cursor': cursor})).read())
+        cursor = page['response_metadata']['next_cursor']
+        if not cursor:
+            return
+
+
+async def first_response(session, url, predicate):
+    """ Seconds until GET url returns a response for which predicate(status, body) holds """
+    start = perf_counter()
+    while True:
+        try:
+            async with session.get(url) as response:
+                if predicate(response.status, await response.json()):
+                    return perf_counter() - start
+        except (aiohttp.ClientConnectionError, aiohttp.ContentTypeError):
+            pass
+        await asyncio.sleep(0.01)
+
+
+async def main(args):
+    fake = FakeSlack({f'U{i:07d}': f'user-{i}' for i in range(args.users)}, latency=args.latency)
+    base_url = fake.start()
+    start = perf_counter()
+    blocking_bootstrap(base_url)
+    blocking = perf_counter() - start
+
+    port = free_port()
+    os.environ.update({
+        'SLACK_BOT_TOKEN': 'xoxb-startup', 'SLACK_SIGNING_SECRET': 'startup', 'SLACK_TA_PASSWD': 'startup',
+        'IP_ADDR': '127.0.0.1', 'SLACK_API_URL': base_url,
+        'QUEUE_JOURNAL': os.path.join(tempfile.mkdtemp(), 'queue_state.sqlite3'),
+    })
+    start = perf_counter()
+    import bot
+    imported = perf_counter() - start
+    shutdown = asyncio.Event()
+    config = Config()
+    config.bind = [f'127.0.0.1:{port}']
+    server = asyncio.ensure_future(serve(bot.app, config, shutdown_trigger=shutdown.wait))
+    url = f'http://127.0.0.1:{port}/status/startup'
+    async with aiohttp.ClientSession() as session:
+        bound = imported + await first_response(session, url, lambda status, body: True)
+        ready = bound + await first_response(session, url, lambda status, body: body['ready'])
+        loaded = ready + await first_response(session, url, lambda status, body: 'user_directory' in body['finished'])
+    shutdown.set()
+    await server
+    fake.stop()
+
+    print(f"{args.users} users, Slack latency {args.latency * 1000:.0f} ms")
+    print(f"blocking bootstrap before bind: {blocking:7.2f} s")
+    print(f"async: import        {imported:7.2f} s")
+    print(f"       serving       {bound:7.2f} s")
+    print(f"       ready         {ready:7.2f} s")
+    print(f"       users loaded  {loaded:7.2f} s  ({len(bot.slack.users)} cached, paced by users.list rate tier)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.1, help='Fake Slack latency per call, seconds')
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,177 @@
+"""
+In-process stand-in for the Slack Web API, for load tests
+Serves the users, conversations, chat and views methods the bot uses from memory,
+with configurable latency and injected 429s. Runs on its own thread and event loop, so serving it does not
+compete with the bot under test. Point Slack at it with base_url (SLACK_API_URL for bot.py).
+"""
+import asyncio
+import json
+import random
+import socket
+import threading
+from time import time
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+BOT_USER_ID = 'UBOT00000'
+TEAM_ID = 'T00000000'
+
+
+def free_port(host='127.0.0.1'):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class FakeSlack:
+
+    def __init__(self, users, latency=0.0, jitter=0.0, rate_limit_prob=0.0, retry_after=1, page_size=200,
+                 listener=None, seed=0):
+        """
+        :param users: Dict user ID -> display name, served by users.list / users.info
+        :param latency: Seconds added to every response
+        :param jitter: Up to this many extra seconds per response, uniformly random
+        :param rate_limit_prob: Chance that a call is answered with HTTP 429
+        :param retry_after: Retry-After seconds sent with injected 429s
+        :param page_size: Largest page users.list / conversations.members return
+        :param listener: Called on the fake's thread as listener(method, args, response) after each answered call
+        """
+        self.users = users
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_prob = rate_limit_prob
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.listener = listener
+        self.channels = dict()      # Channel ID -> member IDs, for conversations.members
+        self.base_url = None
+        self.calls = dict()         # method -> answered calls
+        self.rate_limited = dict()  # method -> injected 429s
+        self.content_types = dict()  # method -> request content type of the last answered call
+        self._rng = random.Random(seed)
+        self._ts = 0
+        self._methods = {
+            'auth.test': self._auth_test,
+            'users.list': self._users_list,
+            'users.info': self._users_info,
+            'conversations.info': self._conversations_info,
+            'conversations.open': self._conversations_open,
+            'conversations.members': self._conversations_members,
+            'chat.postMessage': self._chat_post_message,
+            'chat.delete': self._ok,
+            'views.publish': self._view,
+            'views.open': self._view,
+        }
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    def start(self, host='127.0.0.1', port=None):
+        """ Serve on a background thread, :return: base URL to give WebClient """
+        port = port if port is not None else free_port(host)
+        self.base_url = f'http://{host}:{port}/api/'
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(host, port, ready), name='fake-slack', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self.base_url
+
+    def stop(self):
+        if self._thread is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def _serve(self, host, port, ready):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        app = web.Application()
+        app.router.add_route('*', '/api/{method}', self._handle)
+        self._runner = web.AppRunner(app)
+        self._loop.run_until_complete(self._runner.setup())
+        self._loop.run_until_complete(web.TCPSite(self._runner, host, port).start())
+        ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    async def _handle(self, request):
+        method = request.match_info['method']
+        if method not in self._methods:
+            return web.json_response({'ok': False, 'error': 'unknown_method'})
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self._rng.random() * self.jitter)
+        if self._rng.random() < self.rate_limit_prob:
+            self.rate_limited[method] = self.rate_limited.get(method, 0) + 1
+            return web.json_response({'ok': False, 'error': 'ratelimited'}, status=429,
+                                     headers={'Retry-After': str(self.retry_after)})
+        args = await self._args(request)
+        response = self._methods[method](args)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        self.content_types[method] = request.content_type
+        if self.listener is not None:
+            self.listener(method, args, response)
+        return web.json_response(response)
+
+    @staticmethod
+    async def _args(request):
+        """ The SDK sends arguments as query string, form or JSON depending on the method """
+        args = dict(request.query)
+        if request.content_type == 'application/json':
+            args.update(await request.json())
+        elif request.can_read_body:
+            args.update(parse_qsl((await request.read()).decode()))
+        return args
+
+    def _page(self, items, args):
+        start = int(args.get('cursor') or 0)
+        end = start + min(int(args.get('limit') or self.page_size), self.page_size)
+        return items[start:end], {'next_cursor': str(end) if end < len(items) else ''}
+
+    def _user(self, user_id):
+        return {'id': user_id, 'team_id': TEAM_ID, 'name': user_id.lower(),
+                'profile': {'display_name': self.users.get(user_id, user_id), 'real_name': self.users.get(user_id, user_id)}}
+
+    # Methods
+    @staticmethod
+    def _ok(args):
+        return {'ok': True}
+
+    def _auth_test(self, args):
+        return {'ok': True, 'user_id': BOT_USER_ID, 'team_id': TEAM_ID, 'user': 'queue-bot'}
+
+    def _users_list(self, args):
+        page, metadata = self._page(list(self.users), args)
+        return {'ok': True, 'members': [self._user(user_id) for user_id in page], 'response_metadata': metadata}
+
+    def _users_info(self, args):
+        if args['user'] not in self.users:
+            return {'ok': False, 'error': 'user_not_found'}
+        return {'ok': True, 'user': self._user(args['user'])}
+
+    def _conversations_info(self, args):
+        return {'ok': True, 'channel': {'id': args['channel'], 'name': args['channel'].lower()}}
+
+    def _conversations_open(self, args):
+        users = args['users']
+        user_id = users[0] if isinstance(users, list) else users.split(',')[0]
+        return {'ok': True, 'channel': {'id': 'D' + user_id}}
+
+    def _conversations_members(self, args):
+        page, metadata = self._page(self.channels.get(args['channel'], []), args)
+        return {'ok': True, 'members': page, 'response_metadata': metadata}
+
+    def _chat_post_message(self, args):
+        self._ts += 1
+        if isinstance(args.get('blocks'), str):
+            args['blocks'] = json.loads(args['blocks'])
+        return {'ok': True, 'channel': args['channel'], 'ts': f'{int(time())}.{self._ts:06d}'}
+
+    def _view(self, args):
+        self._ts += 1
+        view = json.loads(args['view']) if isinstance(args['view'], str) else args['view']
+        return {'ok': True, 'view': {'id': f'V{self._ts:08d}', 'type': view.get('type')}}
@@ -0,0 +1,238 @@
+"""
+End-to-end load test: bot.py served by hypercorn, the Slack Web API replaced by benchmarks/fake_slack.py
+M TAs log in through the password modal, N students open their home, connect, refresh while queued, sometimes
+cancel and reconnect, and TAs press Finished after a service time. Every request is signed like Slack signs them.
+Reports ack latency p50/p99, Slack calls per interaction and time-to-assignment.
+Usage: python benchmarks/load_slack.py [--students 200] [--tas 10] [--rounds 2] [--latency 0.05] [--rate-limit 0.01]
+                                       [--ack-first]
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+from time import perf_counter, time
+from urllib.parse import urlencode
+
+import aiohttp
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_slack import FakeSlack, free_port  # noqa: E402
+
+SIGNING_SECRET = 'load-test-signing-secret'
+TA_PASSWORD = 'load-test-ta-password'
+# Button values and modal block ID, as in api.py (imported only after the environment is set up)
+REFRESH, CONNECT, DEQUEUE, LOGIN, DONE, SWITCH = ('RefreshHomePage', 'ConnectTA', 'DequeueConnectTA', 'TALogIn',
+                                                  'TADone', 'TASwitch')
+INPUT_TA_PASS_ID = 'TAPassID'
+NEW_REQUEST = re.compile(r'new request from (\S+):')
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class LoadClient:
+    """ Sends signed Events API and interactivity requests, records ack latency """
+
+    def __init__(self, session, url):
+        self.session = session
+        self.url = url
+        self.ack_latencies = []
+        self.errors = 0
+        self._seq = 0
+
+    def _next_id(self):
+        self._seq += 1
+        return self._seq
+
+    async def _post(self, path, body, content_type):
+        timestamp = str(int(time()))
+        signature = 'v0=' + hmac.new(SIGNING_SECRET.encode(), b'v0:' + timestamp.encode() + b':' + body,
+                                     hashlib.sha256).hexdigest()
+        headers = {'X-Slack-Request-Timestamp': timestamp, 'X-Slack-Signature': signature,
+                   'Content-Type': content_type}
+        start = perf_counter()
+        async with self.session.post(self.url + path, data=body, headers=headers) as response:
+            await response.read()
+            self.ack_latencies.append(perf_counter() - start)
+            if response.status != 200:
+                self.errors += 1
+
+    async def event(self, event):
+        body = json.dumps({'type': 'event_callback', 'event_id': f'Ev{self._next_id():010d}', 'event': event})
+        await self._post('/slack/events', body.encode(), 'application/json')
+
+    async def interaction(self, payload):
+        body = urlencode({'payload': json.dumps(payload)})
+        await self._post('/slack/interactive-endpoint', body.encode(), 'application/x-www-form-urlencoded')
+
+    async def click(self, user_id, value, **extra):
+        await self.interaction(dict({'type': 'block_actions', 'user': {'id': user_id},
+                                     'trigger_id': f'{self._next_id()}.{user_id}',
+                                     'actions': [{'type': 'button', 'value': value}]}, **extra))
+
+    async def submit_password(self, user_id):
+        await self.interaction({'type': 'view_submission', 'user': {'id': user_id},
+                                'trigger_id': f'{self._next_id()}.{user_id}',
+                                'view': {'id': f'VSUB{self._next_id():08d}', 'state': {'values': {
+                                    INPUT_TA_PASS_ID: {'field': {'type': 'plain_text_input', 'value': TA_PASSWORD}}}}}})
+
+
+class Simulation:
+
+    def __init__(self, args, client, student_names):
+        self.args = args
+        self.client = client
+        self.rng = random.Random(args.seed)
+        self.uid_by_name = {name: uid for uid, name in student_names.items()}
+        self.loop = asyncio.get_event_loop()
+        self.assigned = dict()  # Student ID -> future resolved on the TA's request message
+        self.finished = dict()  # Student ID -> future resolved once the TA pressed Finished
+        self.ta_tasks = []
+        self.time_to_assignment = []
+
+    def on_slack_call(self, method, call_args, response):
+        """ FakeSlack listener, runs on the fake's thread """
+        if method == 'chat.postMessage' and DONE in json.dumps(call_args.get('blocks', [])):
+            self.loop.call_soon_threadsafe(self.on_request_message, call_args, response)
+
+    def on_request_message(self, call_args, response):
+        match = NEW_REQUEST.search(call_args['blocks'][0]['text']['text'])
+        student_id = self.uid_by_name.get(match.group(1)) if match else None
+        ta_id = call_args['channel'][1:]  # IM channel IDs are 'D' + user ID
+        future = self.assigned.get(student_id)
+        if future is not None and not future.done():
+            future.set_result(perf_counter())
+        self.ta_tasks.append(asyncio.ensure_future(
+            self.ta_finish(ta_id, student_id, call_args['channel'], response['ts'])))
+
+    async def ta_finish(self, ta_id, student_id, channel_id, ts):
+        await asyncio.sleep(self.rng.expovariate(1 / self.args.service_time))
+        await self.client.click(ta_id, DONE, channel={'id': channel_id}, message={'ts': ts})
+        future = self.finished.get(student_id)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def ta_login(self, ta_id):
+        await self.client.click(ta_id, LOGIN)  # Not a TA yet, opens the password modal
+        await self.client.submit_password(ta_id)
+
+    async def student(self, student_id):
+        await asyncio.sleep(self.rng.random() * self.args.ramp_up)
+        await self.client.event({'type': 'app_home_opened', 'user': student_id, 'tab': 'home'})
+        for _ in range(self.args.rounds):
+            await asyncio.sleep(self.rng.expovariate(1 / self.args.think_time))
+            future = self.loop.create_future()
+            self.assigned[student_id] = future
+            self.finished[student_id] = self.loop.create_future()
+            start = perf_counter()
+            await self.client.click(student_id, CONNECT)
+            while True:
+                try:
+                    self.time_to_assignment.append(
+                        await asyncio.wait_for(asyncio.shield(future), self.args.refresh_every) - start)
+                    break
+                except asyncio.TimeoutError:
+                    if self.rng.random() < self.args.cancel_prob:
+                        await self.client.click(student_id, DEQUEUE)
+                        await self.client.click(student_id, CONNECT)
+                    else:
+                        await self.client.click(student_id, REFRESH)
+            await self.finished[student_id]
+            await self.client.click(student_id, REFRESH)
+
+    async def run(self, student_ids, ta_ids):
+        await self.client.click(ta_ids[0], SWITCH)  # Turn the system on
+        await asyncio.gather(*[self.ta_login(ta_id) for ta_id in ta_ids])
+        await asyncio.gather(*[self.student(student_id) for student_id in student_ids])
+        await asyncio.gather(*self.ta_tasks)
+
+
+async def wait_ready(session, url):
+    """ Poll until the bot is bound and its Slack bootstrap finished """
+    while True:
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientConnectionError:
+            pass
+        await asyncio.sleep(0.05)
+
+
+async def main(args):
+    students = {f'US{i:05d}': f'student-{i}' for i in range(args.students)}
+    tas = {f'UT{i:03d}': f'ta-{i}' for i in range(args.tas)}
+    simulation = None
+    fake = FakeSlack(dict(students, **tas), latency=args.latency, jitter=args.latency,
+                     rate_limit_prob=args.rate_limit, listener=lambda *call: simulation is not None and simulation.on_slack_call(*call))
+    port = free_port()
+    os.environ.update({
+        'SLACK_BOT_TOKEN': 'xoxb-load-test', 'SLACK_SIGNING_SECRET': SIGNING_SECRET, 'SLACK_TA_PASSWD': TA_PASSWORD,
+        'IP_ADDR': '127.0.0.1', 'SLACK_API_URL': fake.start(),
+        'SLACK_ACK_FIRST': '1' if args.ack_first else '0',
+        'QUEUE_JOURNAL': os.path.join(tempfile.mkdtemp(), 'queue_state.sqlite3'),
+    })
+    import bot  # Reads the environment at import
+
+    shutdown = asyncio.Event()
+    config = Config()
+    config.bind = [f'127.0.0.1:{port}']
+    server = asyncio.ensure_future(serve(bot.app, config, shutdown_trigger=shutdown.wait))
+    async with aiohttp.ClientSession() as session:
+        client = LoadClient(session, f'http://127.0.0.1:{port}')
+        simulation = Simulation(args, client, students)
+        await wait_ready(session, f'http://127.0.0.1:{port}/status')
+        startup_calls = fake.total_calls()
+        start = perf_counter()
+        await simulation.run(list(students), list(tas))
+        elapsed = perf_counter() - start
+        await asyncio.sleep(1.0)  # Let ack-first workers and the home publishers drain
+    shutdown.set()
+    await server
+    fake.stop()
+
+    interactions = len(client.ack_latencies)
+    print(f"{args.students} students x {args.rounds} rounds, {args.tas} TAs, ack-first={args.ack_first},"
+          f" Slack latency {args.latency * 1000:.0f}-{args.latency * 2000:.0f} ms, 429 rate {args.rate_limit:.1%}")
+    print(f"requests:            {interactions} in {elapsed:.1f} s ({client.errors} non-200)")
+    print(f"ack latency:         p50 {percentile(client.ack_latencies, 50) * 1000:.1f} ms"
+          f"  p99 {percentile(client.ack_latencies, 99) * 1000:.1f} ms")
+    print(f"Slack calls:         {fake.total_calls() - startup_calls} after startup,"
+          f" {(fake.total_calls() - startup_calls) / interactions:.2f} per request,"
+          f" {sum(fake.rate_limited.values())} answered 429")
+    print(f"Slack connections:   {bot.slack.connections_created} opened,"
+          f" {bot.slack.connections_reused} reused from the pool")
+    for method, count in sorted(fake.calls.items()):
+        print(f"  {method:24s} {count}")
+    print(f"time to assignment:  p50 {percentile(simulation.time_to_assignment, 50):.2f} s"
+          f"  p99 {percentile(simulation.time_to_assignment, 99):.2f} s"
+          f"  ({len(simulation.time_to_assignment)} assignments)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--tas', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=2, help='Help requests per student')
+    parser.add_argument('--latency', type=float, default=0.05, help='Fake Slack latency, seconds (plus same jitter)')
+    parser.add_argument('--rate-limit', type=float, default=0.01, help='Share of Slack calls answered with 429')
+    parser.add_argument('--service-time', type=float, default=2.0, help='Mean seconds a TA spends per student')
+    parser.add_argument('--think-time', type=float, default=2.0, help='Mean seconds between a student\'s requests')
+    parser.add_argument('--refresh-every', type=float, default=1.5, help='Seconds between refreshes while queued')
+    parser.add_argument('--cancel-prob', type=float, default=0.05, help='Chance a refresh is a cancel + reconnect')
+    parser.add_argument('--ramp-up', type=float, default=5.0, help='Students arrive over this many seconds')
+    parser.add_argument('--ack-first', action='store_true', help='Run the bot with SLACK_ACK_FIRST=1')
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
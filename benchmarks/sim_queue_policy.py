@@ -0,0 +1,144 @@
+"""
+Student queue policy simulation: wait times under each of structures.STUDENT_QUEUE_POLICIES on the same trace
+A lab session of help requests against a fixed number of TAs. Some sessions drop early and the student asks again
+(re-queued class), some waiting students get flagged by a section lead (flagged class).
+The trace is generated from a seed, or read from a CSV with columns
+arrival,service,flag_after,drop_after,reask (seconds; empty flag_after / drop_after for none).
+--save-trace writes the generated one in that format.
+Usage: python benchmarks/sim_queue_policy.py [--tas 6] [--hours 3] [--seed 0] [--trace trace.csv]
+"""
+import argparse
+import csv
+import heapq
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from structures import PriorityStudentQueue, STUDENT_QUEUE_POLICIES, CLASS_NORMAL, CLASS_REQUEUED, \
+    CLASS_FLAGGED  # noqa: E402
+
+FIELDS = ('arrival', 'service', 'flag_after', 'drop_after', 'reask')
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def generate_trace(args):
+    """ Arrivals ramp up towards the end of the session, like before a deadline """
+    rng = random.Random(args.seed)
+    duration = args.hours * 3600
+    peak_rate = 2 * args.load * args.tas / args.service  # Linear ramp 0 -> peak averages to the offered load
+    trace = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(peak_rate)  # Thinning: keep an arrival with probability rate(t) / peak_rate
+        if t >= duration:
+            return trace
+        if rng.random() < t / duration:
+            trace.append({
+                'arrival': t,
+                'service': rng.lognormvariate(0, 0.6) * args.service / 1.2,  # Mean of lognormal(0, 0.6) is 1.2
+                'flag_after': rng.uniform(5, 20) * 60 if rng.random() < args.flag_prob else None,
+                'drop_after': rng.uniform(10, 80) if rng.random() < args.drop_prob else None,
+                'reask': rng.uniform(10, 60),
+            })
+
+
+def read_trace(path):
+    with open(path) as f:
+        return [{field: float(row[field]) if row[field] != '' else None for field in FIELDS}
+                for row in csv.DictReader(f)]
+
+
+def write_trace(path, trace):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        writer.writerows({field: '' if request[field] is None else f'{request[field]:.3f}' for field in FIELDS}
+                         for request in trace)
+
+
+def simulate(trace, tas, credits):
+    """ :return: Student class -> list of waits in seconds, for every time a student was assigned a TA """
+    queue = PriorityStudentQueue(credits)
+    waits = {CLASS_NORMAL: [], CLASS_REQUEUED: [], CLASS_FLAGGED: []}
+    queued_at = dict()
+    waiting = dict()    # Queued uid -> trace request
+    events = []     # (time, seq, kind, uid, request)
+    seq = 0
+    for i, request in enumerate(trace):
+        events.append((request['arrival'], seq, 'arrive', f'S{i}', request))
+        seq += 1
+    heapq.heapify(events)
+    free_tas = tas
+
+    def assign(now, uid, request, wait_class):
+        nonlocal seq, free_tas
+        free_tas -= 1
+        waits[wait_class].append(now - queued_at.pop(uid))
+        dropped = request['drop_after'] is not None and not uid.endswith('r')
+        heapq.heappush(events, (now + (request['drop_after'] if dropped else request['service']), seq, 'done',
+                                uid, request))
+        seq += 1
+        if dropped:
+            heapq.heappush(events, (now + request['drop_after'] + request['reask'], seq, 'reask', uid + 'r', request))
+            seq += 1
+
+    while len(events) != 0:
+        now, _, kind, uid, request = heapq.heappop(events)
+        if kind in ('arrive', 'reask'):
+            queued_at[uid] = now
+            student_class = CLASS_REQUEUED if kind == 'reask' else CLASS_NORMAL
+            if free_tas != 0:
+                assign(now, uid, request, student_class)
+                continue
+            queue.append(uid, now, student_class)
+            waiting[uid] = request
+            if kind == 'arrive' and request['flag_after'] is not None:
+                heapq.heappush(events, (now + request['flag_after'], seq, 'flag', uid, request))
+                seq += 1
+        elif kind == 'flag':
+            if uid in queue and queue.class_of(uid) == CLASS_NORMAL and CLASS_FLAGGED in credits:
+                queue.promote(uid, CLASS_FLAGGED, queued_at[uid])
+        elif kind == 'done':
+            free_tas += 1
+            if len(queue) != 0:
+                student_class = queue.class_of(queue.peek())
+                next_uid = queue.popleft()
+                assign(now, next_uid, waiting.pop(next_uid), student_class)
+    return waits
+
+
+def main(args):
+    trace = read_trace(args.trace) if args.trace is not None else generate_trace(args)
+    if args.save_trace is not None:
+        write_trace(args.save_trace, trace)
+    print(f"{len(trace)} requests over {max(r['arrival'] for r in trace) / 3600:.1f} h, {args.tas} TAs,"
+          f" {sum(r['drop_after'] is not None for r in trace)} dropped sessions,"
+          f" {sum(r['flag_after'] is not None for r in trace)} flag requests")
+    print(f"{'policy':8s} {'class':9s} {'n':>5s} {'p50':>8s} {'p95':>8s} {'max':>8s}  (wait, minutes)")
+    for name, credits in STUDENT_QUEUE_POLICIES.items():
+        waits = simulate(trace, args.tas, credits)
+        rows = [('all', sum(waits.values(), []))] + list(waits.items())
+        for student_class, values in rows:
+            print(f"{name:8s} {student_class:9s} {len(values):5d} {percentile(values, 50) / 60:8.1f}"
+                  f" {percentile(values, 95) / 60:8.1f} {max(values, default=float('nan')) / 60:8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tas', type=int, default=6)
+    parser.add_argument('--hours', type=float, default=3.0)
+    parser.add_argument('--service', type=float, default=6 * 60, help='Mean seconds per session')
+    parser.add_argument('--load', type=float, default=0.95, help='Offered load as a share of TA capacity')
+    parser.add_argument('--drop-prob', type=float, default=0.08, help='Share of sessions that drop early')
+    parser.add_argument('--flag-prob', type=float, default=0.05, help='Share of students a lead flags if waiting')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace', help='CSV trace to replay instead of generating one')
+    parser.add_argument('--save-trace', help='Write the trace used to this CSV')
+    main(parser.parse_args())
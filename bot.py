@@ -1,13 +1,23 @@
 import os
 import logging
-from quart import Quart, request, make_response, Response
+import re
+from quart import Quart, request, make_response, Response, g
 import ssl as ssl_lib
 import certifi
-import json
 import ui
-from time import time, strftime
-from manager import QueueManager
+from time import strftime, perf_counter
+from manager import QueueRegistry, parse_channel_sections, parse_section_policies
+from publisher import HomePublisher
+from workers import KeyedWorkerPool, fan_out, JOB_STATE, JOB_COSMETIC
 from api import *
+from backend import create_backend
+from cache import DedupeCache
+from ingress import Ingress, IngressError, Router
+import metrics
+import logs
+from logs import Lazy
+from stats import WAIT_QUANTILES
+from startup import Readiness
 import asyncio
 import signal
 from hypercorn.config import Config
@@ -15,33 +25,129 @@ from hypercorn.asyncio import serve
 
 TA_PASSWORD = os.environ["SLACK_TA_PASSWD"]
 IP_ADDR = os.environ["IP_ADDR"]
+# Acknowledge Slack right after validating a request and handle it on a background worker pool
+ACK_FIRST = os.environ.get("SLACK_ACK_FIRST", "0") == "1"
+logger = logging.getLogger(__name__)
 # Initialize a Flask app to host the events adapter
 app = Quart(__name__)
-slack = Slack(os.environ['SLACK_BOT_TOKEN'], os.environ["SLACK_SIGNING_SECRET"])
-manager = QueueManager(slack)
-system_active = False
+ssl_context = ssl_lib.create_default_context(cafile=certifi.where())
+slack = Slack(os.environ['SLACK_BOT_TOKEN'], os.environ["SLACK_SIGNING_SECRET"], os.environ.get("SLACK_API_URL"),
+              ssl_context=ssl_context)
+# memory: single process (default). sqlite:<path>: state shared by every hypercorn worker on this host
+state_backend = create_backend(os.environ.get("QUEUE_BACKEND", "memory"))
+slack.backend = state_backend
+worker_pool = KeyedWorkerPool(workers=int(os.environ.get("SLACK_WORKERS", "8")))
+# Slack bootstrap runs after binding; requests are answered right away but handled once these are done
+readiness = Readiness(critical=['slack_identity'])
+bootstrap_task = None
+CHANNEL_MEMBERS_ATTEMPTS = 5    # Until then, and if it gives up, users not routed yet use the default section
+held_requests = set()       # Inline mode: handlers waiting for readiness after their request was answered
+# Slack retries deliveries it thinks we missed, drop anything already handled
+seen_requests = DedupeCache()
+# Both endpoints share one front half: size cap, signature and timestamp check, JSON decode
+ingress = Ingress(slack.verifier)
+events = Router()           # Event type -> handler(event_data)
+actions = Router()          # Button value -> handler(payload), not affected by system states
+system_actions = Router()   # Button value -> handler(payload), only while the system is on
+# Requests that only ask for a fresh home view, never queued behind clicks that change state
+COSMETIC_EVENTS = {'app_home_opened'}
+COSMETIC_ACTIONS = {INTERACTION_STUDENT_REFRESH}
+
+# Prometheus metrics: latencies recorded on the request path, everything else read when scraped
+app_metrics = metrics.Metrics()
+route_latency = app_metrics.histogram('http_request_seconds', 'Time to answer an HTTP request', ('route',))
+handler_latency = app_metrics.histogram('slack_handler_seconds', 'Time to handle an event or interaction',
+                                        ('kind', 'name'))
+
+
+@app.before_serving
+async def start_background_tasks():
+    global bootstrap_task
+    if ACK_FIRST:
+        worker_pool.start()
+    await slack.open_session()
+    bootstrap_task = asyncio.ensure_future(bootstrap())
+
+
+async def bootstrap():
+    """ Slack calls needed at startup, run concurrently inside the event loop """
+    await asyncio.gather(readiness.run('slack_identity', slack.fetch_identity),
+                         readiness.run('channel_members', registry.load_channel_members, CHANNEL_MEMBERS_ATTEMPTS),
+                         readiness.run('user_directory', slack.load_all_users))  # Cache warming, not critical
+
+
+@app.after_serving
+async def stop_background_tasks():
+    if bootstrap_task is not None:
+        bootstrap_task.cancel()
+    for task in list(held_requests):
+        task.cancel()
+    for manager in registry:
+        await manager.publisher.stop()
+    if worker_pool.is_running():
+        await worker_pool.stop()
+    for manager in registry:    # After the workers, their last jobs may still need the writer
+        await manager.stop()
+    await slack.close()
+    await asyncio.get_event_loop().run_in_executor(None, registry.close)
+
+
+async def dispatch(user_id, coro_fn, cosmetic=False):
+    """
+    Run a handler inline, or hand it to the worker pool (ordered per user) in ack-first mode
+    Before startup is done an inline handler is held in the background, so Slack still gets its answer within
+    3 seconds.
+    :param cosmetic: The handler only asks for a home view, which is cheap: once ready it runs inline in either mode
+    """
+    if cosmetic and readiness.is_ready():
+        await coro_fn()
+    elif ACK_FIRST:
+        if not worker_pool.submit(user_id, lambda: run_when_ready(coro_fn), JOB_COSMETIC if cosmetic else JOB_STATE):
+            logger.warning("Worker queue full, dropped a home view request from %s", user_id)
+    elif not readiness.is_ready():
+        task = asyncio.ensure_future(run_held(coro_fn))
+        held_requests.add(task)
+        task.add_done_callback(held_requests.discard)
+    else:
+        await coro_fn()
+
+
+async def run_when_ready(coro_fn):
+    if not readiness.is_ready():
+        await readiness.wait()
+    await coro_fn()
+
+
+async def run_held(coro_fn):
+    """ Nobody awaits a held handler, log its failure here """
+    try:
+        await run_when_ready(coro_fn)
+    except Exception:
+        logger.exception("Held request failed")
+
+
+@app.before_request
+async def start_request_timer():
+    g.request_start = perf_counter()
+
+
+@app.after_request
+async def record_request_latency(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    route_latency.observe((route,), perf_counter() - g.request_start)
+    return response
+
+
+@app.errorhandler(IngressError)
+async def ingress_rejected(error):
+    logger.warning("Rejected request to %s: %s", request.path, error)
+    return await make_response("", error.status)
 
 
 @app.route("/slack/events", methods=['POST'])
 async def slack_event():
-    req_header = request.headers
-    req_data = await request.data
-    # Each request comes with request timestamp and request signature
-    # emit an error if the timestamp is out of range
-    req_timestamp = req_header.get('X-Slack-Request-Timestamp')
-    if abs(time() - int(req_timestamp)) > 60 * 5:
-        logger.exception('Invalid request timestamp')
-        return await make_response("", 403)
-
-    # Verify the request signature using the app's signing secret
-    # emit an error if the signature can't be verified
-    req_signature = req_header.get('X-Slack-Signature')
-    if not slack.verify_signature(req_timestamp, req_signature, req_data):
-        logger.exception('Invalid request signature')
-        return await make_response("", 403)
-
-    # Parse the request payload into JSON
-    event_data = json.loads(req_data.decode('utf-8'))
+    ingress.check_length(request.content_length)
+    event_data = ingress.parse_event(request.headers, await request.get_data())
 
     # Echo the URL verification challenge code back to Slack
     if "challenge" in event_data:
@@ -51,30 +157,84 @@ async def slack_event():
 
     # Parse the Event payload and emit the event to the event listener
     if "event" in event_data:
-        event_type = event_data["event"]["type"]
-        if event_type == "app_home_opened":
-            await home_open(event_data)
-        elif event_type == "app_mention":
-            await mentioned(event_data)
-        elif event_type == "message":
-            await on_message(event_data)
-        response = await make_response("", 200)
-        # response.headers['X-Slack-Powered-By'] = self.package_info
-        return response
+        if event_data["event"].get("type") not in events:
+            return await make_response("", 200)
+        if seen_requests.is_duplicate(event_data.get("event_id")):
+            logger.info("Dropped duplicate event %s (retry %s)", event_data.get('event_id'),
+                        request.headers.get('X-Slack-Retry-Num'))
+            return await make_response("", 200)
+        await dispatch(event_user_id(event_data["event"]), lambda: handle_event(event_data),
+                       event_data["event"]["type"] in COSMETIC_EVENTS)
+    return await make_response("", 200)
+
+
+def event_user_id(event):
+    """ user_change carries the whole user object, other events its ID """
+    user = event.get("user")
+    return user.get("id") if isinstance(user, dict) else user
+
+
+async def handle_event(event_data):
+    event_type = event_data["event"]["type"]
+    with logs.request_context(event_user_id(event_data["event"]), event_type), \
+            handler_latency.labels('event', event_type).time():
+        await events.get(event_type)(event_data)
+        logger.debug("Handled event")
 
 
 @app.route("/status")
 async def ping():
+    if not readiness.is_ready():
+        return readiness.status(), 503
     return "Success!"
 
 
+@app.route("/status/startup")
+async def startup_status():
+    return readiness.status()
+
+
+@app.route("/status/workers")
+async def worker_status():
+    return {
+        "ack_first": ACK_FIRST,
+        "queue_depth": worker_pool.depth() if worker_pool.is_running() else 0,
+        "last_lag_seconds": worker_pool.last_lag,
+        "max_lag_seconds": worker_pool.max_lag,
+        "submitted": worker_pool.submitted,
+        "shed": worker_pool.shed,
+        "completed": worker_pool.completed,
+        "failed": worker_pool.failed,
+        "duplicates_dropped": seen_requests.dropped,
+        "requests_rejected": ingress.rejected,
+        "slack_connections_created": slack.connections_created,
+        "slack_connections_reused": slack.connections_reused,
+    }
+
+
+@app.route("/status/sections")
+async def section_status():
+    """ Per section load and timing statistics, for sizing TA staffing """
+    return {manager.section: dict(manager.stats.summary(),
+                                  queue_length=manager.get_queue_length(),
+                                  active_tas=manager.get_ta_size())
+            for manager in registry}
+
+
+@app.route("/metrics")
+async def metrics_endpoint():
+    return Response(app_metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@events.on("app_home_opened")
 async def home_open(payload):
     event = payload.get("event", {})
     user_id = event.get("user")
-    logger.debug(f"Home opened by {await slack.get_user_name(user_id)}")
-    await slack.send_home_view(user_id, await get_app_home(user_id))
+    logger.debug("Home opened by %s", Lazy(slack.cached_user_name, user_id))
+    await request_home_view(user_id, force=True)
 
 
+@events.on("app_mention")
 async def mentioned(payload):
     event = payload.get("event", {})
     user_id = event.get("user")
@@ -84,72 +244,145 @@ async def mentioned(payload):
     await slack.send_chat_text(channel_id, "Please find me under Apps on your sidebar")
 
 
+@events.on("member_joined_channel")
+async def member_joined(payload):
+    event = payload.get("event", {})
+    user_id = event.get("user")
+    if await registry.on_channel_join(event.get("channel"), user_id):
+        await request_home_view(user_id)
+
+
+@events.on("user_change")
+async def user_change(payload):
+    await slack.on_user_change(payload["event"]["user"])
+
+
+@events.on("message")
 async def on_message(payload):
     event = payload.get("event", {})
     user_id = event.get("user")
     # Disregard message from None which could be a message-delete event
     # Disregard own message
-    if user_id is None or user_id == slack.bot_user.data['user_id']:
+    if user_id is None or slack.is_this_bot(user_id):
         return
     channel_id = event.get("channel")
     text = event.get("text")
     if text == "!h ping":
         await slack.send_chat_text(channel_id, "pong :tada:")
     elif text == "!h reset":
-        manager.admin_reset()
+        manager = await registry.route(user_id)
+        await manager.admin_reset()
+    elif text is not None and text.startswith("!h section "):
+        section = text[len("!h section "):].strip()
+        if section not in registry.sections:
+            await slack.send_chat_text(channel_id, f"Unknown section *{section}*, pick one of: "
+                                                   f"{', '.join(sorted(registry.sections))}")
+        elif await registry.join(user_id, section):
+            await slack.send_chat_text(channel_id, f"You are now in section *{section}*")
+            await request_home_view(user_id)
+        else:
+            await slack.send_chat_text(channel_id, "Please leave the queue or log off before switching sections")
+    elif text is not None and text.startswith("!h flag "):
+        await flag_student(user_id, channel_id, text[len("!h flag "):])
     # await debug_print_msg(payload)
 
 
+async def flag_student(user_id, channel_id, mention):
+    """ `!h flag @student` from a TA of the student's section, moves the student up under aging queue policies """
+    match = re.fullmatch(r'\s*<@(\w+)(\|[^>]*)?>\s*', mention)
+    if match is None:
+        await slack.send_chat_text(channel_id, "Usage: `!h flag @student`")
+        return
+    student_id = match.group(1)
+    manager = await registry.route(student_id)
+    if not manager.is_ta(user_id)[0]:
+        await slack.send_chat_text(channel_id, "Only TAs of the student's section can flag them")
+        return
+    if not manager.can_flag():
+        await slack.send_chat_text(channel_id, f"Flagging has no effect under the {manager.queue_policy} queue policy")
+        return
+    position = await manager.flag_student(student_id)
+    if position is None:
+        await slack.send_chat_text(channel_id, f"<@{student_id}> is not in the queue")
+    else:
+        await slack.send_chat_text(channel_id, f"Flagged <@{student_id}>, now #{position} in the"
+                                               f" {manager.queue_policy} queue")
+
+
 # Views
+# Static App Home blocks are serialized once, views are published as JSON strings
+TA_PANEL_ACTIONS_RAW = {
+    system_active: ui.raw(ui.actions([
+        ui.button_styled("System States Reset", INTERACTION_ADMIN_RESET, "danger", ui.reset_confirm()),
+        ui.button_styled("Turn on system", INTERACTION_TA_MASTER_SWITCH, "primary") if not system_active else
+        ui.button_styled("Turn off system", INTERACTION_TA_MASTER_SWITCH, "danger", ui.off_confirm())
+    ]))
+    for system_active in (False, True)
+}
+CONNECT_ROW = ui.Template(ui.actions([
+    ui.button_styled(":telephone_receiver: Connect to a TA", INTERACTION_STUDENT_CONNECT_TA, "primary"),
+    ui.button("@@login_text@@", INTERACTION_TA_LOGIN),
+]))
+LOGIN_ROW = ui.Template(ui.actions([ui.button("@@login_text@@", INTERACTION_TA_LOGIN)]))
+DEQUEUE_ROW_RAW = ui.raw(ui.actions([ui.button("Cancel Request", INTERACTION_STUDENT_DEQUEUE)]))
+CONNECTED_RAW = ui.raw(ui.text("You are connected with a TA. Look for their direct message in a moment."))
+REFRESH_ROW_RAW = ui.raw(ui.actions([ui.button(":arrows_counterclockwise: Refresh", INTERACTION_STUDENT_REFRESH)]))
+
+
+async def render_ta_panel(manager):
+    """ TA control panel: queue listing and system switches, shared by all TAs of a section """
+    return [
+        ui.DIVIDER_RAW,
+        ui.text_raw(f"*{manager.get_queue_length()} Students* waiting in queue"),
+        ui.text_raw(await manager.str_queue()),
+        TA_PANEL_ACTIONS_RAW[manager.system_active]
+    ]
+
+
+async def render_ta_roster(manager, ta_view):
+    """ Active TAs with busy TAs' status, TAs also see who is being helped """
+    busy_tas = await fan_out(manager.pairs.keys(), lambda ta: ta.get_status_text(ta_view=ta_view))
+    return [
+        ui.DIVIDER_RAW,
+        ui.active_ta_raw(manager.get_ta_size()),
+        ui.text_raw(manager.str_free_ta()),
+        ui.list_quote_text_raw([status for status in busy_tas.results if status is not None])
+    ]
+
+
 async def get_app_home(user_id):
-    global system_active
+    """ :return: Serialized home view """
+    manager = await registry.route(user_id)
+    system_active = manager.system_active
     current_status = manager.get_student_status(user_id)
     is_ta, is_active = manager.is_ta(user_id)
 
     # Info
     blocks = [
-        ui.welcome_title(await slack.get_user_name(user_id)),
-        ui.greeting(is_ta, is_active, system_active),
+        ui.welcome_title_raw(await slack.get_user_name(user_id)),
+        ui.greeting_raw(is_ta, is_active, system_active),
     ]
 
     # Control Panel for TA Only
     if is_ta:
-        blocks += [
-            ui.DIVIDER,
-            ui.text(f"*{manager.get_queue_length()} Students* waiting in queue"),
-            ui.text(await manager.str_queue()),
-            ui.actions([ui.button_styled("System States Reset", INTERACTION_ADMIN_RESET, "danger",
-                                         ui.reset_confirm()),
-                        ui.button_styled("Turn on system", INTERACTION_TA_MASTER_SWITCH, "primary"
-                                         ) if not system_active else
-                        ui.button_styled("Turn off system", INTERACTION_TA_MASTER_SWITCH, "danger",
-                                         ui.off_confirm())
-                        ])
-        ]
+        blocks += await manager.fragments.get(('ta_panel', system_active), lambda: render_ta_panel(manager))
 
     # Functional
     if system_active:
-        blocks += [
-            ui.DIVIDER,
-            ui.active_ta(manager.get_ta_size())
-        ]
-        blocks += [ui.text(manager.str_free_ta())]
-        busy_tas = [await ta.get_status_text(ta_view=is_ta) for ta in manager.pairs.keys()]
-        blocks += [ui.list_quote_text(busy_tas)]
+        blocks += await manager.fragments.get(('ta_roster', is_ta), lambda: render_ta_roster(manager, is_ta))
 
         if current_status == 'idle':
-            blocks += [ui.actions([
-                ui.button_styled(":telephone_receiver: Connect to a TA", INTERACTION_STUDENT_CONNECT_TA, "primary"),
-                ui.button(manager.get_ta_login_text(user_id), INTERACTION_TA_LOGIN),
-            ])]
+            blocks.append(CONNECT_ROW.fill(login_text=manager.get_ta_login_text(user_id)))
         elif current_status == 'queued':
-            blocks += [ui.text(f"You are *#{manager.get_queue_position(user_id)}* in the queue."
-                               f" Click *refresh* button below to refresh."),
-                       ui.actions([ui.button("Cancel Request", INTERACTION_STUDENT_DEQUEUE)])
+            eta = manager.get_eta(user_id)
+            blocks += [ui.text_raw(f"You are *#{manager.get_queue_position(user_id)}* in the queue."
+                                   + (f" Estimated wait: {ui.format_eta(eta)}." if eta is not None else "")
+                                   + " This page updates automatically as the queue moves."),
+                       DEQUEUE_ROW_RAW
                        ]
         elif current_status == 'busy':
             blocks += [
-                ui.text("You are connected with a TA. Look for their direct message in a moment.")
+                CONNECTED_RAW
                 # TODO: Haven't implemented notify TA so disabled for now
                 # {"type": "actions",
                 #  "elements": [{"type": "button",
@@ -164,14 +397,68 @@ async def get_app_home(user_id):
             raise ValueError(
                 f"Unexpected current_status: {current_status} for student {await slack.get_user_name(user_id)}")
     else:
-        blocks += [ui.actions([
-            ui.button(manager.get_ta_login_text(user_id), INTERACTION_TA_LOGIN)])
-        ]
-    blocks += [ui.actions([ui.button(":arrows_counterclockwise: Refresh", INTERACTION_STUDENT_REFRESH)])]
-    return {
-        "type": "home",
-        "blocks": blocks
-    }
+        blocks.append(LOGIN_ROW.fill(login_text=manager.get_ta_login_text(user_id)))
+    blocks.append(REFRESH_ROW_RAW)
+    return ui.view_raw("home", blocks)
+
+
+async def request_home_view(user_id, force=False):
+    """ Have the user's section publish their home view, the caller does not wait for it to go out """
+    manager = await registry.route(user_id)
+    manager.publisher.request(user_id, force)
+
+
+def attach_publisher(manager):
+    """ Each section publishes through its own publisher, sections take turns in the views.publish budget """
+    manager.publisher = HomePublisher(slack, get_app_home, section=manager.section)
+
+
+def collect_queue_gauges(size_fn):
+    return lambda: [((manager.section,), size_fn(manager)) for manager in registry]
+
+
+app_metrics.add(slack.scheduler.latency)
+app_metrics.counter('slack_api_calls_total', 'Slack Web API calls sent, retries included', ('method',),
+                    lambda: [((method,), count) for method, count in slack.scheduler.calls.items()])
+app_metrics.counter('slack_api_rate_limited_total', 'Slack Web API calls answered with 429', ('method',),
+                    lambda: [((method,), count) for method, count in slack.scheduler.rate_limited.items()])
+app_metrics.counter('slack_cache_hits_total', 'Slack lookup cache hits', ('cache',),
+                    lambda: [(('user',), slack.users.hits), (('im_channel',), slack.im_channels.hits)])
+app_metrics.counter('slack_cache_misses_total', 'Slack lookup cache misses', ('cache',),
+                    lambda: [(('user',), slack.users.misses), (('im_channel',), slack.im_channels.misses)])
+app_metrics.gauge('slack_cache_hit_ratio', 'Slack lookup cache hit ratio since start', ('cache',),
+                  lambda: [(('user',), slack.users.hit_rate()), (('im_channel',), slack.im_channels.hit_rate())])
+app_metrics.counter('slack_http_connections_total', 'Connections to the Slack Web API, opened or reused from the pool',
+                    ('kind',), lambda: [(('created',), slack.connections_created),
+                                        (('reused',), slack.connections_reused)])
+app_metrics.counter('slack_home_views_skipped_total', 'Home view publishes skipped as unchanged', (),
+                    lambda: [((), slack.home_views_skipped)])
+app_metrics.gauge('queue_length', 'Students waiting in queue', ('section',),
+                  collect_queue_gauges(lambda manager: manager.get_queue_length()))
+app_metrics.gauge('queue_free_tas', 'Active TAs not helping anyone', ('section',),
+                  collect_queue_gauges(lambda manager: len(manager.free_ta)))
+app_metrics.gauge('queue_pairs', 'TAs currently helping a student', ('section',),
+                  collect_queue_gauges(lambda manager: len(manager.pairs)))
+app_metrics.gauge('queue_wait_seconds', 'Wait from request to assignment since start, sketch quantiles',
+                  ('section', 'quantile'),
+                  lambda: [((manager.section, str(q)), manager.stats.overall.wait.quantile(q) or 0.0)
+                           for manager in registry for q in WAIT_QUANTILES])
+app_metrics.gauge('queue_service_seconds_ewma', 'Recent session length', ('section',),
+                  collect_queue_gauges(lambda manager: manager.stats.overall.service.value or 0.0))
+app_metrics.counter('queue_served_total', 'Sessions completed', ('section',),
+                    collect_queue_gauges(lambda manager: manager.stats.overall.served))
+
+
+# Sections' queues are restored from their journals, so restarts do not drop queued students and TA pairings
+# A shared backend is durable by itself and replaces the journal
+registry = QueueRegistry(slack, os.environ.get("TA_POLICY", "least-recently-assigned"),
+                         journal_path=(None if state_backend.shared
+                                       else os.environ.get("QUEUE_JOURNAL", "queue_state.sqlite3")),
+                         channel_sections=parse_channel_sections(os.environ.get("QUEUE_SECTIONS", "")),
+                         on_create=attach_publisher,
+                         backend=state_backend,
+                         queue_policy=os.environ.get("QUEUE_POLICY", "fifo"),
+                         section_policies=parse_section_policies(os.environ.get("QUEUE_SECTION_POLICIES", "")))
 
 
 def get_ta_verification():
@@ -240,118 +527,159 @@ async def debug_print_msg(payload):
 # https://api.slack.com/messaging/interactivity
 @app.route("/slack/interactive-endpoint", methods=["POST"])
 async def interactive_received():
-    global system_active
-    payload = json.loads((await request.form)["payload"])
+    ingress.check_length(request.content_length)
+    payload = ingress.parse_interaction(request.headers, await request.get_data())
     assert payload['type'] in ['block_actions', 'view_submission']
-    logger.debug(f"{payload['type']} triggered from {await slack.get_user_name(payload['user']['id'])}")
+    if seen_requests.is_duplicate(interaction_key(payload)):
+        logger.info("Dropped duplicate %s from %s", payload['type'], payload['user']['id'])
+        return await make_response("", 200)
+    await dispatch(payload['user']['id'], lambda: handle_interaction(payload), is_cosmetic(payload))
+    # Send an HTTP 200 response with empty body so Slack knows we're done here
+    return await make_response("", 200)
+
+
+def is_cosmetic(payload):
+    """ Whether a click only asks for a fresh home view """
+    return payload['type'] == 'block_actions' and len(payload['actions']) == 1 \
+        and payload['actions'][0].get('value') in COSMETIC_ACTIONS
+
+
+def interaction_key(payload):
+    """ A click is identified by its trigger_id and the action it fired """
+    if payload['type'] == 'view_submission':
+        return f"{payload.get('trigger_id')}:{payload['view']['id']}"
+    return f"{payload.get('trigger_id')}:{','.join(action.get('value', '') for action in payload['actions'])}"
+
+
+async def handle_interaction(payload):
+    user_id = payload['user']['id']
     if payload['type'] == 'view_submission':
-        await ta_verify_passwd(payload)
+        kind, name = 'view_submission', 'ta_verification'
     else:
-        actions = payload['actions']
-        assert len(actions) == 1
-        action_value = actions[0]['value']
-        logger.debug(f"Action is {action_value}")
-        # NOTE: *** Expect people to click on button with old home view page -- may mess up states
-        # Certain buttons may not exist anymore in current page
-        # Example: Could still receive STUDENT_CONNECT_TA when system is switched off
-
-        # Not affected by system states
-        if action_value == INTERACTION_STUDENT_REFRESH:
-            user_id = payload['user']['id']
-            await slack.send_home_view(user_id, await get_app_home(user_id))
-        elif action_value == INTERACTION_TA_DONE:
-            await ta_done(payload)
-        elif action_value == INTERACTION_TA_PASS:
-            ta_pass(payload)
-        elif action_value == INTERACTION_TA_LOGIN:
-            trigger_id = payload['trigger_id']
-            user_id = payload['user']['id']
-            if manager.is_ta_active(user_id):
-                await manager.ta_login(user_id)
-                await slack.send_home_view(user_id, await get_app_home(user_id))
-            else:
-                await slack.send_modal(trigger_id, get_ta_verification())
-        elif action_value == INTERACTION_ADMIN_RESET:
-            user_id = payload['user']['id']
-            system_active = False
-            manager.admin_reset()
-            await slack.send_home_view(user_id, await get_app_home(user_id))
-        elif action_value == INTERACTION_TA_MASTER_SWITCH:
-            user_id = payload['user']['id']
-            system_active = not system_active
-            await manager.toggle_system_active(system_active)
-            await slack.send_home_view(user_id, await get_app_home(user_id))
-
-        # Is affected by system states
-        if not system_active:
-            user_id = payload['user']['id']
-            await slack.send_home_view(user_id, await get_app_home(user_id))
+        assert len(payload['actions']) == 1
+        action_value = payload['actions'][0]['value']
+        # Only known values become labels, anything else would grow the metric without bound
+        known = action_value in actions or action_value in system_actions
+        kind, name = 'action', action_value if known else 'unknown'
+    with logs.request_context(user_id, name), handler_latency.labels(kind, name).time():
+        logger.debug("%s triggered from %s", payload['type'], Lazy(slack.cached_user_name, user_id))
+        if kind == 'view_submission':
+            await ta_verify_passwd(payload)
         else:
-            if action_value == INTERACTION_STUDENT_CONNECT_TA:
-                await student_connect(payload)
-            elif action_value == INTERACTION_STUDENT_DEQUEUE:
-                await student_dequeue(payload)
-            elif action_value == INTERACTION_STUDENT_END_CHAT:
-                disconnect_student(payload)
-    # Send an HTTP 200 response with empty body so Slack knows we're done here
-    return await make_response("", 200)
+            await handle_action(payload, action_value)
+        logger.debug("Handled %s", kind)
+
+
+async def handle_action(payload, action_value):
+    user_id = payload['user']['id']
+    logger.debug("Action is %s", action_value)
+    # NOTE: *** Expect people to click on button with old home view page -- may mess up states
+    # Certain buttons may not exist anymore in current page
+    # Example: Could still receive STUDENT_CONNECT_TA when system is switched off
+    handler = actions.get(action_value)
+    if handler is not None:
+        await handler(payload)
+    manager = await registry.route(user_id)
+    if not manager.system_active:
+        await request_home_view(user_id)
+    else:
+        handler = system_actions.get(action_value)
+        if handler is not None:
+            await handler(payload)
+
+
+@actions.on(INTERACTION_STUDENT_REFRESH)
+async def refresh_home(payload):
+    user_id = payload['user']['id']
+    await request_home_view(user_id)
+
+
+@actions.on(INTERACTION_TA_LOGIN)
+async def ta_login(payload):
+    user_id = payload['user']['id']
+    manager = await registry.route(user_id)
+    if manager.is_ta_active(user_id):
+        await manager.ta_login(user_id)
+        await request_home_view(user_id)
+    else:
+        await slack.send_modal(payload['trigger_id'], get_ta_verification())
+
+
+@actions.on(INTERACTION_ADMIN_RESET)
+async def admin_reset(payload):
+    user_id = payload['user']['id']
+    manager = await registry.route(user_id)
+    await manager.admin_reset()
+    await request_home_view(user_id)
+
+
+@actions.on(INTERACTION_TA_MASTER_SWITCH)
+async def master_switch(payload):
+    user_id = payload['user']['id']
+    manager = await registry.route(user_id)
+    await manager.toggle_system_active(not manager.system_active)
+    await request_home_view(user_id)
 
 
 async def ta_verify_passwd(payload):
     user_id = payload['user']['id']
     passwd = payload['view']['state']['values'][INPUT_TA_PASS_ID]['field']['value']
     if passwd == TA_PASSWORD:
+        manager = await registry.route(user_id)
         await manager.ta_login(user_id)
-    await slack.send_home_view(user_id, await get_app_home(user_id))
+    await request_home_view(user_id)
 
 
-#
+@actions.on(INTERACTION_TA_PASS)
+async def ta_pass(payload):
+    channel_id = payload['channel']['id']
+    msg_ts = payload['message']['ts']
+    user_id = payload['user']['id']
+    manager = await registry.route(user_id)
+    # The request message goes away while the manager notifies everyone, one round of Slack latency in total
+    student_name, _ = await asyncio.gather(manager.ta_pass(user_id),
+                                           slack.delete_chat(channel_id, msg_ts))
+    if student_name is None:
+        await slack.send_chat_text(channel_id, "You are not helping anyone right now, nothing to pass on")
+        return
+    logger.debug("%s passed %s on", Lazy(slack.cached_user_name, user_id), student_name)
 
-# def ta_reassign(user_id):
-#     raise NotImplementedError()
-#     the_ta = tas[user_id]
-#     the_ta.reassign()
-#     free_ta.append(the_ta)
-#     busy_ta.remove(the_ta)
-#     check_student_queue()
-#
-#
-# def ta_pass(payload):
-#     channel_id = payload['channel']['id']
-#     msg_ts = payload['message']['ts']
-#     user_id = payload['user']['id']
-#     ta_reassign(user_id)
-#     print("TA Pass to next TA!")
-#     slack.delete_chat(channel_id, msg_ts).send_chat_text(channel_id, 'TA Pass!')
-#
-#
+
+@actions.on(INTERACTION_TA_DONE)
 async def ta_done(payload):
     channel_id = payload['channel']['id']
     msg_ts = payload['message']['ts']
     user_id = payload['user']['id']
+    manager = await registry.route(user_id)
     student_name = await manager.ta_complete_request(user_id)
-    logger.debug(f"{await slack.get_user_name(user_id)} has finished helping {student_name}")
+    if student_name is None:
+        await slack.delete_chat(channel_id, msg_ts)
+        return
+    logger.debug("%s has finished helping %s", Lazy(slack.cached_user_name, user_id), student_name)
     await(await slack.delete_chat(channel_id, msg_ts)).send_chat_text(channel_id, f'Finished helping {student_name}!')
 
 
+@system_actions.on(INTERACTION_STUDENT_CONNECT_TA)
 async def student_connect(payload):
-    global system_active
     user_id = payload['user']['id']
-    if not system_active:
-        await slack.send_home_view(user_id, await get_app_home(user_id))
+    manager = await registry.route(user_id)
+    if not manager.system_active:
+        await request_home_view(user_id)
         return
-    logger.debug(f"Student {await slack.get_user_name(user_id)} requests a connection!")
+    logger.debug("Student %s requests a connection!", Lazy(slack.cached_user_name, user_id))
     trigger_id = payload['trigger_id']
     await manager.student_request(user_id, trigger_id)
-    await slack.send_home_view(user_id, await get_app_home(user_id))
+    await request_home_view(user_id)
 
 
+@system_actions.on(INTERACTION_STUDENT_DEQUEUE)
 async def student_dequeue(payload):
     user_id = payload['user']['id']
-    logger.debug(f"Student {await slack.get_user_name(user_id)} removes themselves from queue!")
+    logger.debug("Student %s removes themselves from queue!", Lazy(slack.cached_user_name, user_id))
     trigger_id = payload['trigger_id']
-    manager.student_remove_from_queue(user_id, trigger_id)
-    await slack.send_home_view(user_id, await get_app_home(user_id))
+    manager = await registry.route(user_id)
+    await manager.student_remove_from_queue(user_id, trigger_id)
+    await request_home_view(user_id)
 
 shutdown_event = asyncio.Event()
 
@@ -361,21 +689,17 @@ def _signal_handler(*_) -> None:
 
 
 if __name__ == "__main__":
-    # Logging
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+    # Logging, written by a background thread so the event loop never blocks on disk or console I/O
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
     fh = logging.FileHandler(strftime("bot_%Y%b%d_%H-%M-%S.log"))
-    fh.setLevel(logging.DEBUG)
+    fh.setLevel(os.environ.get("LOG_LEVEL", "DEBUG"))
     # create formatter and add it to the handlers
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    formatter = logging.Formatter(logs.LOG_FORMAT)
     fh.setFormatter(formatter)
     ch.setFormatter(formatter)
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    log_listener = logs.start_logging([fh, ch], min(fh.level, ch.level))
 
-    ssl_context = ssl_lib.create_default_context(cafile=certifi.where())
     # app.run(port=3000)
     config = Config()
     config.bind = [f"{IP_ADDR}:3000"]
@@ -383,3 +707,4 @@ if __name__ == "__main__":
     logger.info('Server starting...')
     loop.add_signal_handler(signal.SIGTERM, _signal_handler)
     loop.run_until_complete(serve(app, config, shutdown_trigger=shutdown_event.wait))
+    log_listener.stop()
@@ -0,0 +1,114 @@
+from collections import OrderedDict
+from time import monotonic
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded mapping with per-entry time to live
+    Least recently used entry is evicted once maxsize is reached; expired entries are dropped on access.
+    Keeps hit / miss counts for stats.
+    """
+
+    def __init__(self, maxsize, ttl, clock=monotonic):
+        """
+        :param maxsize: Max number of entries
+        :param ttl: Seconds an entry stays valid, None to never expire
+        :param clock: Time source, monotonic seconds
+        """
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    def get(self, key, default=None, count=True):
+        entry = self._data.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at is None or expires_at > self.clock():
+                self._data.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return value
+            del self._data[key]
+        if count:
+            self.misses += 1
+        return default
+
+    def set(self, key, value):
+        expires_at = None if self.ttl is None else self.clock() + self.ttl
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total != 0 else 0.0
+
+
+class FragmentCache:
+    """
+    Rendered fragments shared by every user, valid for one state version
+    All fragments are dropped as soon as the version reported by version_fn changes.
+    """
+
+    def __init__(self, version_fn):
+        self.version_fn = version_fn
+        self._version = None
+        self._fragments = dict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key, build):
+        """
+        :param key: Fragment identity within a state version, include every input besides state
+        :param build: Zero-argument coroutine function rendering the fragment
+        """
+        version = self.version_fn()
+        if version != self._version:
+            self._version = version
+            self._fragments = dict()
+        if key in self._fragments:
+            self.hits += 1
+            return self._fragments[key]
+        self.misses += 1
+        fragment = await build()
+        if self._version == version:  # State may have moved on while building
+            self._fragments[key] = fragment
+        return fragment
+
+
+class DedupeCache:
+    """ Remembers recently seen keys (event IDs etc.) to drop retried deliveries """
+
+    def __init__(self, maxsize=10000, ttl=60 * 60):
+        self._seen = TTLCache(maxsize, ttl)
+        self.dropped = 0
+
+    def is_duplicate(self, key):
+        """ True if key was seen within ttl, otherwise remember it. None is never a duplicate """
+        if key is None:
+            return False
+        if key in self._seen:
+            self.dropped += 1
+            return True
+        self._seen.set(key, True)
+        return False
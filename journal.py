@@ -0,0 +1,235 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+from datetime import date
+
+from structures import CLASS_NORMAL
+
+logger = logging.getLogger(__name__)
+
+COMPACT_EVERY = 5000    # Events between snapshots, bounds replay work at startup
+_CLOSE = object()
+
+
+class StateModel:
+    """
+    Plain-data mirror of QueueManager state, rebuilt by applying journal ops
+    Op is a tuple (name, *args):
+    - ('reset',)                        - ('system', is_active)
+    - ('ta', uid, name)                 - ('ta_active', uid, is_active)
+    - ('free_add', uid)                 - ('free_remove', uid)              - ('free_clear',)
+    - ('enqueue', uid, queued_at, student_class)                            - ('queue_class', uid, student_class, key)
+    - ('enqueue_front', uid, queued_at, student_class, key)                 - ('passed', uid, ta_uid)
+    - ('dequeue', uid)                  - ('queue_clear',)
+    - ('pair', ta_uid, student_uid, assigned_at)                            - ('unpair', ta_uid)
+    - ('status', uid, status)           - ('member', uid, is_member)
+    - ('dropped', uid, ended_at)        - ('ta_policy', state)
+    Timestamps are epoch seconds; journals written before they existed replay with None, and students with the
+    normal class.
+    """
+
+    def __init__(self, state=None):
+        state = state if state is not None else dict()
+        self.system_active = state.get('system_active', False)
+        # uid -> {'name', 'active', 'last_assigned', 'sessions_day', 'sessions'}, see manager.TA.to_dict
+        self.tas = state.get('tas', dict())
+        self.ta_policy = state.get('ta_policy')                     # TA pool policy state, None if stateless
+        self.free_ta = dict.fromkeys(state.get('free_ta', []))      # Ordered set of uids
+        self.pairs = state.get('pairs', dict())                     # TA uid -> student uid
+        queued_at = state.get('queued_at', dict())
+        self.queue = {uid: queued_at.get(uid) for uid in state.get('queue', [])}  # Ordered uid -> queued at
+        self.queue_class = state.get('queue_class', dict())         # Queued uid -> class, normal ones left out
+        self.queue_key = state.get('queue_key', dict())             # Queued uid -> ordering key, if not derived
+        self.assigned_at = state.get('assigned_at', dict())         # TA uid -> assigned at
+        self.passed_by = state.get('passed_by', dict())             # Student uid -> TA uids who passed them on
+        self.dropped_at = state.get('dropped_at', dict())           # Student uid -> when their session dropped
+        self.status = state.get('status', dict())                   # uid -> non-idle status
+        self.members = set(state.get('members', []))                # Users routed to this section
+
+    def to_dict(self):
+        return {
+            'system_active': self.system_active,
+            'tas': self.tas,
+            'ta_policy': self.ta_policy,
+            'free_ta': list(self.free_ta),
+            'pairs': self.pairs,
+            'queue': list(self.queue),
+            'queued_at': {uid: at for uid, at in self.queue.items() if at is not None},
+            'queue_class': self.queue_class,
+            'queue_key': self.queue_key,
+            'assigned_at': self.assigned_at,
+            'passed_by': self.passed_by,
+            'dropped_at': self.dropped_at,
+            'status': self.status,
+            'members': sorted(self.members),
+        }
+
+    def apply(self, op):
+        name, args = op[0], op[1:]
+        if name == 'reset':
+            self.__init__({'members': self.members})  # Section membership survives a queue reset
+        elif name == 'system':
+            self.system_active = args[0]
+        elif name == 'ta':
+            self.tas[args[0]] = {'name': args[1], 'active': False}
+        elif name == 'ta_active':
+            self.tas[args[0]]['active'] = args[1]
+        elif name == 'free_add':
+            self.free_ta[args[0]] = None
+        elif name == 'free_remove':
+            self.free_ta.pop(args[0], None)
+        elif name == 'free_clear':
+            self.free_ta = dict()
+        elif name == 'enqueue':
+            self.queue[args[0]] = args[1] if len(args) > 1 else None
+            if len(args) > 2 and args[2] != CLASS_NORMAL:
+                self.queue_class[args[0]] = args[2]
+        elif name == 'enqueue_front':
+            self.queue = dict({args[0]: args[1]}, **self.queue)
+            if args[2] != CLASS_NORMAL:
+                self.queue_class[args[0]] = args[2]
+            if len(args) > 3:
+                self.queue_key[args[0]] = args[3]   # Older journals put the key into queued_at
+        elif name == 'passed':
+            self.passed_by.setdefault(args[0], []).append(args[1])
+        elif name == 'queue_class':
+            if args[1] == CLASS_NORMAL:
+                self.queue_class.pop(args[0], None)
+            else:
+                self.queue_class[args[0]] = args[1]
+            if len(args) > 2:
+                self.queue_key[args[0]] = args[2]
+        elif name == 'dequeue':
+            self.queue.pop(args[0], None)
+            self.queue_class.pop(args[0], None)
+            self.queue_key.pop(args[0], None)
+        elif name == 'queue_clear':
+            self.queue = dict()
+            self.queue_class = dict()
+            self.queue_key = dict()
+        elif name == 'pair':
+            self.pairs[args[0]] = args[1]
+            if len(args) > 2:
+                self.assigned_at[args[0]] = args[2]
+                ta = self.tas[args[0]]
+                day = date.fromtimestamp(args[2]).isoformat()
+                ta['sessions'] = ta.get('sessions', 0) + 1 if ta.get('sessions_day') == day else 1
+                ta['sessions_day'] = day
+                ta['last_assigned'] = args[2]
+        elif name == 'unpair':
+            self.pairs.pop(args[0], None)
+            self.assigned_at.pop(args[0], None)
+        elif name == 'status':
+            if args[1] == 'idle':
+                self.status.pop(args[0], None)
+                self.passed_by.pop(args[0], None)
+            else:
+                self.status[args[0]] = args[1]
+                self.dropped_at.pop(args[0], None)  # Asked again
+        elif name == 'dropped':
+            self.dropped_at[args[0]] = args[1]
+        elif name == 'ta_policy':
+            self.ta_policy = args[0]
+        elif name == 'member':
+            if args[1]:
+                self.members.add(args[0])
+            else:
+                self.members.discard(args[0])
+        else:
+            raise ValueError(f'Unknown journal op: {op}')
+
+
+class Journal:
+    """
+    Append-only journal of QueueManager state transitions in SQLite
+    append() only enqueues, a writer thread batches pending ops into one fsync'd transaction
+    and periodically replaces the event log with a snapshot so replay stays short.
+    """
+
+    def __init__(self, path, compact_every=COMPACT_EVERY):
+        self.path = path
+        self.compact_every = compact_every
+        self._queue = queue.Queue()
+        self._thread = None
+        self._model = None
+        self._seq = 0
+        self._events_since_snapshot = 0
+
+    def open(self):
+        """
+        Load snapshot and replay events after it, then start the writer thread
+        :return: StateModel of the last journaled state
+        """
+        db = self._connect()
+        db.execute('CREATE TABLE IF NOT EXISTS snapshot (id INTEGER PRIMARY KEY CHECK (id = 1), seq INTEGER, state TEXT)')
+        db.execute('CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY, op TEXT)')
+        db.commit()
+        row = db.execute('SELECT seq, state FROM snapshot WHERE id = 1').fetchone()
+        self._seq, state = (row[0], json.loads(row[1])) if row is not None else (0, None)
+        self._model = StateModel(state)
+        for seq, op in db.execute('SELECT seq, op FROM events WHERE seq > ? ORDER BY seq', (self._seq,)):
+            self._model.apply(json.loads(op))
+            self._seq = seq
+            self._events_since_snapshot += 1
+        db.close()
+        logger.info(f'Journal replayed up to event {self._seq} ({self._events_since_snapshot} after snapshot)')
+        self._thread = threading.Thread(target=self._write_loop, name='journal-writer', daemon=True)
+        self._thread.start()
+        return StateModel(json.loads(json.dumps(self._model.to_dict())))  # Caller gets its own copy
+
+    def append(self, *op):
+        """ Journal one op, see StateModel for the format. Never blocks. """
+        self._queue.put(op)
+
+    def close(self):
+        """ Flush pending ops and stop the writer thread. Blocking, run off the event loop. """
+        if self._thread is not None:
+            self._queue.put(_CLOSE)
+            self._thread.join()
+            self._thread = None
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=FULL')
+        return db
+
+    def _write_loop(self):
+        db = self._connect()
+        closing = False
+        while not closing:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is _CLOSE:
+                closing = True
+                batch.pop()
+            try:
+                self._write_batch(db, batch)
+            except Exception:
+                logger.exception(f'Failed to journal {len(batch)} ops')
+        db.close()
+
+    def _write_batch(self, db, batch):
+        rows = []
+        for op in batch:
+            self._model.apply(op)
+            self._seq += 1
+            rows.append((self._seq, json.dumps(op)))
+        with db:
+            db.executemany('INSERT INTO events (seq, op) VALUES (?, ?)', rows)
+        self._events_since_snapshot += len(rows)
+        if self._events_since_snapshot >= self.compact_every:
+            self._compact(db)
+
+    def _compact(self, db):
+        with db:
+            db.execute('INSERT OR REPLACE INTO snapshot (id, seq, state) VALUES (1, ?, ?)',
+                       (self._seq, json.dumps(self._model.to_dict())))
+            db.execute('DELETE FROM events WHERE seq <= ?', (self._seq,))
+        self._events_since_snapshot = 0
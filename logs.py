@@ -0,0 +1,86 @@
+import contextvars
+import logging
+import logging.handlers
+import queue
+from contextlib import contextmanager
+from time import perf_counter
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s%(context)s'
+
+_current_request = contextvars.ContextVar('current_request', default=None)  # RequestContext of the running handler
+
+
+class RequestContext:
+    """ Who and what the running handler serves, attached to every record it logs """
+    __slots__ = ('user', 'action', 'start')
+
+    def __init__(self, user, action):
+        self.user = user
+        self.action = action
+        self.start = perf_counter()
+
+    def latency_ms(self):
+        return (perf_counter() - self.start) * 1000
+
+
+@contextmanager
+def request_context(user, action):
+    """
+    Tag records logged inside the with block, including by tasks it starts (they copy the context)
+    :param user: User ID the request came from
+    :param action: Button value, event type, ...
+    """
+    token = _current_request.set(RequestContext(user, action))
+    try:
+        yield
+    finally:
+        _current_request.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds the request context to records as user, action, latency_ms (None outside a request), and as text in
+    `context` for LOG_FORMAT. Has to run where the record is created: attach it to the QueueHandler.
+    """
+
+    def filter(self, record):
+        current = _current_request.get()
+        if current is None:
+            record.user = record.action = record.latency_ms = None
+            record.context = ''
+        else:
+            record.user = current.user
+            record.action = current.action
+            record.latency_ms = current.latency_ms()
+            record.context = f' [user={current.user} action={current.action} {record.latency_ms:.1f}ms]'
+        return True
+
+
+class Lazy:
+    """ Log argument computed only if the record is emitted: logger.debug('%s', Lazy(fn, *args)) """
+    __slots__ = ('fn', 'args')
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        return str(self.fn(*self.args))
+
+
+def start_logging(handlers, level=logging.DEBUG):
+    """
+    Send every record of the root logger through a queue; a listener thread formats and writes them,
+    so file and console I/O never block the event loop
+    :param handlers: Handlers the listener writes to, each filtered by its own level
+    :return: Started QueueListener, stop() flushes it
+    """
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -1,4 +1,19 @@
 from api import *
+import asyncio
+from structures import PriorityStudentQueue, TAPool, TA_POLICIES, STUDENT_QUEUE_POLICIES, CLASS_NORMAL, \
+    CLASS_REQUEUED, CLASS_FLAGGED
+from workers import fan_out
+from cache import FragmentCache
+from journal import Journal, StateModel
+from backend import MemoryBackend
+from stats import SectionStats
+import logging
+import os
+import re
+from datetime import date
+from time import time, monotonic
+
+logger = logging.getLogger(__name__)
 
 
 class TA:
@@ -9,21 +24,53 @@ class TA:
         https://stackoverflow.com/questions/33128325/how-to-set-class-attribute-with-await-in-init/33134213
         """
         assert isinstance(slack, Slack)
-        self = TA()
+        self = cls.restore(slack, uid, await slack.get_user_name(uid), active=False)
+        await slack.get_im_channel(uid)  # Warm IM channel cache
+        return self
+
+    @classmethod
+    def restore(cls, slack, uid, name, active, last_assigned=0.0, sessions_day=None, sessions=0):
+        """
+        Build a TA from known state without calling Slack, e.g. replayed from the journal
+        :param sessions_day: ISO date sessions were counted on, today if None
+        """
+        self = cls()
         self.slack = slack
         self.uid = uid
-        self.active = False
+        self.active = active
         self.busy = False
         self.helping_who = 'ERR: NOT HELPING ANYONE'
-        self.name = await slack.get_user_name(uid)
-        self.im = await slack.get_im_channel(uid)
+        self.last_assigned = last_assigned  # Epoch time of last assignment, used by TA pool policies
+        self._sessions_day = date.fromisoformat(sessions_day) if sessions_day is not None else date.today()
+        self._sessions_count = sessions
+        self.name = name
         return self
 
-    async def assign(self, student_id):
+    def to_dict(self):
+        """ Plain-data state for journal.StateModel, inverse of restore """
+        return {'name': self.name, 'active': self.active, 'last_assigned': self.last_assigned,
+                'sessions_day': self._sessions_day.isoformat(), 'sessions': self._sessions_count}
+
+    async def get_im(self):
+        """ IM channel with this TA, served from Slack's IM channel cache """
+        return await self.slack.get_im_channel(self.uid)
+
+    def assign(self, student_id, now=None):
+        """
+        Mark this TA busy helping student_id
+        :return: Effect notifying the TA, for the caller to run
+        """
         assert not self.busy
         self.busy = True
         self.helping_who = student_id
-        await self.slack.send_chat_block(self.im, await self.slack.get_request_block(student_id))
+        self.last_assigned = time() if now is None else now
+        self.sessions_today()
+        self._sessions_count += 1
+        return lambda: self.notify_assigned(student_id)
+
+    async def notify_assigned(self, student_id):
+        await self.slack.send_chat_block(await self.get_im(), await self.slack.get_request_block(student_id),
+                                         priority=PRIORITY_URGENT)
 
     def complete(self):
         """
@@ -38,16 +85,26 @@ class TA:
         self.helping_who = 'ERR: NOT HELPING ANYONE'
         return finished_student
 
-    async def toggle_active(self):
-        self.active = not self.active
-        if self.active:
-            await self.slack.send_chat_text(self.im, "You have started accepting requests!")
-        else:
-            await self.slack.send_chat_text(self.im, "You are logged off and are no longer accepting new requests!")
+    def sessions_today(self):
+        """ Number of students helped today, resets at local midnight """
+        if self._sessions_day != date.today():
+            self._sessions_day = date.today()
+            self._sessions_count = 0
+        return self._sessions_count
+
+    def set_active(self, active):
+        """
+        Start / stop accepting requests
+        :return: Effect notifying the TA, for the caller to run
+        """
+        self.active = active
+        return lambda: self.notify_active(active)
 
-    async def make_offline_if_online(self):
-        if self.active:
-            await self.toggle_active()
+    async def notify_active(self, active):
+        if active:
+            await self.slack.send_chat_text(await self.get_im(), "You have started accepting requests!")
+        else:
+            await self.slack.send_chat_text(await self.get_im(), "You are logged off and are no longer accepting new requests!")
 
     async def get_status_text(self, ta_view):
         if self.busy:
@@ -59,8 +116,25 @@ class TA:
             return f'{self.name}'
 
     def reassign(self):
-        # Notify student, change student_ta_connection, change self status, etc
-        raise NotImplementedError()
+        """
+        Pass the student this TA is helping on to someone else
+        *Caller responsible for pairing the student again and notifying them
+        :return: passed student's ID and an effect telling the TA
+        """
+        passed_student = self.complete()
+        return passed_student, lambda: self.notify_passed(passed_student)
+
+    async def notify_passed(self, student_id):
+        await self.slack.send_chat_text(await self.get_im(),
+                                        f'Passed {await self.slack.get_user_name(student_id)} on to another TA')
+
+
+DEFAULT_SECTION = 'default'
+DROPPED_SESSION = 90        # Seconds, a session this short most likely dropped (call failed, TA pulled away)
+REQUEUE_WINDOW = 10 * 60    # Seconds after a dropped session during which asking again counts as re-queued
+SYNC_INTERVAL = 1.0         # Seconds between checks for changes by other worker processes, on a shared backend
+CONNECTED_TEXT = (":tada: You are now connected with a TA. They will DM you in a second."
+                  " If you don't get any message within 1 minute, DM your section lead to let them know.")
 
 
 class QueueManager:
@@ -76,44 +150,258 @@ class QueueManager:
     - Request TA
     - Exit Queue
     - Finish TA
+
+    Every state change goes through a single writer task. A transition (_t_*) never awaits: it commits the whole
+    change at once and returns (result, effects), effects being zero-argument coroutine functions carrying the
+    Slack notifications. Effects run concurrently afterwards, outside the writer, so slow Slack calls never hold
+    up other transitions and two transitions can never interleave.
     """
 
-    def __init__(self, slack_web_client):
+    def __init__(self, slack_web_client, ta_policy='least-recently-assigned', section=None, queue_policy='fifo'):
+        """
+        :param slack_web_client: Slack instance
+        :param ta_policy: How free TAs are picked, one of structures.TA_POLICIES
+        :param section: Name of the section this queue serves, see QueueRegistry
+        :param queue_policy: Order queued students are served in, one of structures.STUDENT_QUEUE_POLICIES
+        """
         assert isinstance(slack_web_client, Slack)
-        self.free_ta = []               # List of Free TAs
+        assert ta_policy in TA_POLICIES
+        assert queue_policy in STUDENT_QUEUE_POLICIES
+        self.ta_policy = ta_policy
+        self.queue_policy = queue_policy
+        self.section = section if section is not None else DEFAULT_SECTION
+        self.members = set()            # Users routed here by QueueRegistry
+        self.free_ta = TAPool(TA_POLICIES[ta_policy]())  # Pool of Free TAs
         # self.busy_ta = []
         self.pairs = dict()             # Currently connected TA - Student pairs
-        self.student_queue = []         # Queue for all student ids waiting for next avil TA
+        # Queue for all student ids waiting for next avil TA
+        self.student_queue = PriorityStudentQueue(STUDENT_QUEUE_POLICIES[queue_policy])
+        self._queued_at = dict()        # Student ID -> epoch time they joined the queue
+        self._queue_keys = dict()       # Student ID -> ordering key, if placed by a flag or pass, not by queued_at
+        self._dropped_at = dict()       # Student ID -> epoch time their last session ended as dropped
+        self._passed_by = dict()        # Student ID -> TA IDs who passed them on, until the student is idle again
+        self.stats = SectionStats()     # Wait / service times for ETAs and staffing, kept across resets
         self.tas = dict()               # Stores all TA instances
         self._student_status = dict()  # TODO: Refactor this into a class
         self.slack = slack_web_client
+        self.publisher = None           # Optional HomePublisher, notified of users whose home view changed
+        self.version = 0                # Bumped on every state change, keys shared render fragments
+        self.fragments = FragmentCache(lambda: self.version)
+        self.system_active = False
+        self.journal = None             # Optional journal.Journal recording every state transition
+        self._journal_ops = []          # Ops of the running transition, journaled once it succeeds
+        self._commands = None           # Single writer command queue, created on first use
+        self._writer = None
+        self.backend = MemoryBackend()  # Where state is shared with other worker processes, see backend.py
+        self._backend_version = None    # Version of shared state this process has loaded
+        self._sync_due = 0.0            # Monotonic time of the next version check
+        self._journaled_policy = None   # TA pool policy state as of the last journaled transition
+
+    def _touch(self):
+        self.version += 1
+
+    def _journal(self, *op):
+        if self.journal is not None:
+            self._journal_ops.append(op)
+
+    def restore(self, model):
+        """
+        Load state replayed from the journal, see journal.StateModel
+        TAs are rebuilt from journaled names, nobody is notified.
+        """
+        self._reset_state()
+        self.system_active = model.system_active
+        for uid, ta_state in model.tas.items():
+            self.tas[uid] = TA.restore(self.slack, uid, ta_state['name'], ta_state['active'],
+                                       ta_state.get('last_assigned') or 0.0, ta_state.get('sessions_day'),
+                                       ta_state.get('sessions', 0))
+        if model.ta_policy is not None:
+            self.free_ta.policy.load(model.ta_policy)
+        self._journaled_policy = model.ta_policy
+        for uid in model.free_ta:
+            self.free_ta.add(self.tas[uid])
+        for ta_uid, student_id in model.pairs.items():
+            the_ta = self.tas[ta_uid]
+            the_ta.busy = True
+            the_ta.helping_who = student_id
+            the_ta.last_assigned = model.assigned_at.get(ta_uid) or 0.0
+            self.pairs[the_ta] = student_id
+        for student_id, queued_at in model.queue.items():
+            self.student_queue.append(student_id, queued_at, model.queue_class.get(student_id, CLASS_NORMAL),
+                                      model.queue_key.get(student_id))
+            if queued_at is not None:
+                self._queued_at[student_id] = queued_at
+        self._queue_keys = dict(model.queue_key)
+        self._passed_by = {uid: set(ta_uids) for uid, ta_uids in model.passed_by.items()}
+        self._dropped_at = dict(model.dropped_at)
+        self._student_status = dict(model.status)
+        self.members = set(model.members)
+
+    def to_model(self):
+        """ Plain-data copy of current state, inverse of restore """
+        model = StateModel()
+        model.system_active = self.system_active
+        model.tas = {uid: ta.to_dict() for uid, ta in self.tas.items()}
+        model.ta_policy = self.free_ta.policy.state()
+        model.free_ta = dict.fromkeys(ta.uid for ta in self.free_ta)
+        model.pairs = {ta.uid: student_id for ta, student_id in self.pairs.items()}
+        model.queue = {uid: self._queued_at.get(uid) for uid in self.student_queue}
+        model.queue_class = {uid: self.student_queue.class_of(uid) for uid in self.student_queue
+                             if self.student_queue.class_of(uid) != CLASS_NORMAL}
+        model.queue_key = dict(self._queue_keys)
+        model.assigned_at = {ta.uid: ta.last_assigned for ta in self.pairs}
+        model.passed_by = {uid: sorted(ta_uids) for uid, ta_uids in self._passed_by.items()}
+        model.dropped_at = dict(self._dropped_at)
+        model.status = {uid: status for uid, status in self._student_status.items() if status != 'idle'}
+        model.members = set(self.members)
+        return model
+
+    async def sync(self):
+        """
+        Reload state if another worker process changed it
+        The version is checked at most every SYNC_INTERVAL, reads in between may miss their latest changes.
+        Transitions always apply to the latest state, see _transact.
+        """
+        if not self.backend.shared or monotonic() < self._sync_due:
+            return
+        self._sync_due = monotonic() + SYNC_INTERVAL
+        if await self.backend.read(self.backend.version, self.section) != self._backend_version:
+            await self._enqueue(self._reload, 'reload')
+
+    def load_shared(self):
+        """ Load state from a shared backend. Blocking, for startup before the event loop serves """
+        if self.backend.shared:
+            self._load(*self.backend.load(self.section))
+
+    async def _reload(self):
+        """ Writer step, so a reload never lands between a transition and its commit """
+        self._load(*await self.backend.read(self.backend.load, self.section))
+
+    def _load(self, version, state):
+        if version != self._backend_version:
+            self.restore(StateModel(state))
+            self._backend_version = version
+
+    async def add_member(self, user_id):
+        await self._apply(self._t_add_member, user_id)
+
+    async def remove_member(self, user_id):
+        """
+        Let a user leave this section, unless they are queued, being helped, logged in or helping someone
+        :return: False if the user is busy here
+        """
+        return await self._apply(self._t_remove_member, user_id)
 
-    def admin_reset(self):
-        self.free_ta = []
-        self.pairs = dict()
-        self.student_queue = []
-        self.tas = dict()
-        self._student_status = dict()
+    def _mark_dirty(self, user_ids):
+        if self.publisher is not None:
+            self.publisher.mark_dirty(user_ids)
 
-    async def ta_login(self, user_id):
-        if user_id not in self.tas.keys():
-            self.tas[user_id] = await TA.create(self.slack, user_id)
+    def _queue_changed(self, moved_students):
+        """ Queue listing changed for TAs; moved_students have a new position or status """
+        self._mark_dirty(self.tas.keys())
+        self._mark_dirty(moved_students)
 
-        the_ta = self.tas[user_id]
+    # Single writer
+    async def _apply(self, transition, *args):
+        """ Commit a transition on the writer, then run its effects. Returns the transition's result """
+        result, effects = await self._submit(transition, *args)
+        await self._run_effects(effects)
+        return result
 
-        # TA Log on
-        # A new TA added, check queue
-        if not the_ta.active:
-            self.free_ta.append(the_ta)
-            await the_ta.toggle_active()
-            await self.queue_move()
+    async def _submit(self, transition, *args):
+        return await self._enqueue(lambda: self._commit(transition, args), transition.__name__)
 
-        # TA Log off
-        else:
-            if the_ta in self.free_ta:
-                self.free_ta.remove(the_ta)
-            # The TA complete process is responsible for removing the TA if it's already inactive (no new request)
-            await the_ta.toggle_active()
+    async def _enqueue(self, step, name):
+        """
+        Run a step on the single writer
+        :param step: Zero-argument coroutine function
+        :param name: For logs
+        """
+        if self._commands is None:
+            self._commands = asyncio.Queue()
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write_loop())  # Picks up commands already queued
+        future = asyncio.get_event_loop().create_future()
+        await self._commands.put((step, name, future))
+        return await future
+
+    async def stop(self):
+        """ Cancel the single writer, commands still queued are dropped """
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+
+    async def _write_loop(self):
+        while True:
+            step, name, future = await self._commands.get()
+            if future.done():   # Caller cancelled while queued, nobody would run the effects
+                continue
+            try:
+                outcome = await step()
+            except Exception as e:
+                if future.done():
+                    logger.exception(f'Writer step {name} failed in section {self.section}')
+                else:
+                    future.set_exception(e)     # Caller logs it
+            else:
+                if not future.done():
+                    future.set_result(outcome)
+
+    async def _commit(self, transition, args):
+        """
+        Run one transition, journaling its ops only if it succeeds
+        Transitions check their preconditions before changing anything, so one that raises leaves state as it was.
+        On a shared backend the transaction is rolled back as well and the next step reloads.
+        """
+        self._journal_ops = []
+        try:
+            if self.backend.shared:
+                outcome = await self._transact(transition, args)
+            else:
+                outcome = transition(*args)
+        except BaseException:
+            self._backend_version = None
+            self._sync_due = 0.0
+            raise
+        finally:
+            ops, self._journal_ops = self._journal_ops, []
+        if self.journal is not None:
+            for op in ops:
+                self.journal.append(*op)
+            policy = self.free_ta.policy.state()
+            if policy != self._journaled_policy:
+                self.journal.append('ta_policy', policy)
+                self._journaled_policy = policy
+        return outcome
+
+    async def _transact(self, transition, args):
+        """ Apply a transition to shared state, holding the backend's cross-process write lock """
+        async with self.backend.transaction(self.section) as txn:
+            if txn.version != self._backend_version:
+                self.restore(StateModel(txn.state))
+            outcome = transition(*args)
+            txn.commit(self.to_model().to_dict())
+        self._backend_version = txn.version
+        return outcome
+
+    async def _run_effects(self, effects):
+        outcome = await fan_out(effects, lambda effect: effect())
+        for _, e in outcome.failures:
+            logger.error(f'Notification failed in section {self.section}: {e!r}')
+        return outcome
+
+    # Commands
+    async def admin_reset(self):
+        await self._apply(self._t_reset)
+
+    async def ta_login(self, user_id):
+        """ Log a TA on, or off if already on """
+        new_ta = await TA.create(self.slack, user_id) if user_id not in self.tas else None
+        await self._apply(self._t_ta_login, user_id, new_ta)
 
     async def ta_complete_request(self, ta_user_id):
         """
@@ -121,19 +409,24 @@ class QueueManager:
         Checks it the TA is still online. If so, process student waiting queue.
         Also sets student status back to idle.
         :param ta_user_id: User ID for this TA
-        :return: Name of student this TA was helping
+        :return: Name of student this TA was helping, None if they were not helping anyone
         """
-        the_ta = self.tas[ta_user_id]
-        finished_student = the_ta.complete()
-        await self.slack.send_chat_text(await self.slack.get_im_channel(finished_student),
-                                        f"{the_ta.name} has completed your request.")
-        self.set_student_status(finished_student, 'idle')
-        if the_ta.active:
-            self.free_ta.append(the_ta)
-            await self.queue_move()
-        del self.pairs[the_ta]
+        finished_student = await self._apply(self._t_complete_request, ta_user_id)
+        if finished_student is None:
+            return None
         return await self.slack.get_user_name(finished_student)
 
+    async def ta_pass(self, ta_user_id):
+        """
+        TA can't help their student: hand the student to another free TA, or back to the head of the queue
+        The TA is free again (if still active). Student, TA and any newly assigned TA are notified concurrently.
+        :return: Name of the student passed on, None if the TA was not helping anyone
+        """
+        passed_student = await self._apply(self._t_ta_pass, ta_user_id)
+        if passed_student is None:
+            return None
+        return await self.slack.get_user_name(passed_student)
+
     async def student_request(self, user_id, trigger_id):
         """
         Search for a free TA and connect with the student, or put student into queue if no free TA
@@ -141,31 +434,260 @@ class QueueManager:
         :param user_id: Student user ID
         :param trigger_id: Student's button click trigger ID, for modal use, etc
         """
-        assert self.get_student_status(user_id) == 'idle'
+        await self._apply(self._t_student_request, user_id)
+
+    async def student_remove_from_queue(self, user_id, trigger_id):
+        await self._apply(self._t_student_remove_from_queue, user_id)
+
+    async def flag_student(self, user_id):
+        """
+        Section lead asks for a queued student to be helped sooner, never later than their current turn
+        Does nothing unless can_flag().
+        :return: New queue position, None if the student is not queued
+        """
+        return await self._apply(self._t_flag_student, user_id)
+
+    async def toggle_system_active(self, is_active):
+        """
+        Turning on warms IM channels of active TAs; turning off logs off every TA. Either way the queue is cleared.
+        :return: FanOutResult of the notifications sent
+        """
+        _, effects = await self._submit(self._t_toggle_system_active, is_active)
+        if is_active:
+            # After the clear: students just removed from the queue get one notice, not worth warming for
+            _, notified = await asyncio.gather(self.warm_im_channels(), self._run_effects(effects))
+        else:
+            notified = await self._run_effects(effects)
+        logger.info(f'System turned {"on" if is_active else "off"} in section {self.section},'
+                    f' sent {notified.succeeded}/{notified.total} notifications')
+        return notified
+
+    # Transitions, run on the single writer only
+    def _reset_state(self):
+        self._touch()
+        self.system_active = False
+        self.free_ta = TAPool(TA_POLICIES[self.ta_policy]())
+        self.pairs = dict()
+        self.student_queue.clear()
+        self._queued_at = dict()
+        self._queue_keys = dict()
+        self._dropped_at = dict()
+        self._passed_by = dict()
+        self.tas = dict()
+        self._student_status = dict()
+
+    def _t_reset(self):
+        self._journal('reset')
+        self._reset_state()
+        return None, []
+
+    def _t_ta_login(self, user_id, new_ta):
+        if user_id not in self.tas:
+            if new_ta is None:  # Reset since ta_login looked, the name is all a TA needs from Slack
+                new_ta = TA.restore(self.slack, user_id, self.slack.cached_user_name(user_id), active=False)
+            self.tas[user_id] = new_ta
+            self._journal('ta', user_id, new_ta.name)
+
+        the_ta = self.tas[user_id]
+        effects = []
+
+        # TA Log on
+        # A new TA added, check queue
+        if not the_ta.active:
+            self._journal('ta_active', user_id, True)
+            effects.append(the_ta.set_active(True))
+            # Logged off mid-session and back on: still busy, ta_complete_request frees them
+            if not the_ta.busy:
+                self.free_ta.add(the_ta)
+                self._journal('free_add', user_id)
+                effects += self._queue_move()
+
+        # TA Log off
+        else:
+            self.free_ta.discard(the_ta)
+            self._journal('free_remove', user_id)
+            self._journal('ta_active', user_id, False)
+            # The TA complete process is responsible for removing the TA if it's already inactive (no new request)
+            effects.append(the_ta.set_active(False))
+        self._touch()
+        self._mark_dirty([user_id])
+        return None, effects
+
+    def _t_complete_request(self, ta_user_id):
+        the_ta = self.tas.get(ta_user_id)
+        if the_ta is None or not the_ta.busy:   # Already completed, e.g. Done clicked twice
+            return None, []
+        now = time()
+        finished_student = the_ta.complete()
+        if the_ta.last_assigned != 0.0:  # Unknown for pairs restored from journals without timestamps
+            self.stats.on_completed(ta_user_id, now - the_ta.last_assigned, now)
+            if now - the_ta.last_assigned < DROPPED_SESSION:
+                self._dropped_at[finished_student] = now
+                self._journal('dropped', finished_student, now)
+        self.set_student_status(finished_student, 'idle')
+        self._mark_dirty([finished_student])
+        del self.pairs[the_ta]
+        self._journal('unpair', ta_user_id)
+        effects = [lambda: self._notify(finished_student, f"{the_ta.name} has completed your request.")]
+        if the_ta.active:
+            self.free_ta.add(the_ta)
+            self._journal('free_add', ta_user_id)
+            effects += self._queue_move()
+        return finished_student, effects
+
+    def _t_ta_pass(self, ta_user_id):
+        the_ta = self.tas.get(ta_user_id)
+        if the_ta is None or not the_ta.busy:   # Already completed or passed, e.g. a stale request message
+            return None, []
+        passed_student, notify_ta = the_ta.reassign()
+        del self.pairs[the_ta]
+        self._journal('unpair', ta_user_id)
+        self._passed_by.setdefault(passed_student, set()).add(ta_user_id)
+        self._journal('passed', passed_student, ta_user_id)
+        effects = [notify_ta]
+        next_ta = self.free_ta.pop_excluding(self._passed_by[passed_student])
+        if next_ta is not None:
+            effects += self._make_connection(passed_student, None, next_ta,
+                                             ":arrows_counterclockwise: Your TA passed your question on."
+                                             " Another TA will DM you in a second.")
+        else:
+            now = time()   # Their wait for the next TA starts now, the key only places them at the front
+            key = self.student_queue.push_front(passed_student, now, CLASS_REQUEUED)
+            self._queued_at[passed_student] = now
+            self._queue_keys[passed_student] = key
+            self._journal('enqueue_front', passed_student, now, CLASS_REQUEUED, key)
+            self.set_student_status(passed_student, 'queued')
+            self._queue_changed(list(self.student_queue))
+            effects.append(lambda: self._notify(passed_student,
+                                                ":arrows_counterclockwise: Your TA passed your question on."
+                                                " You are back at the front of the queue."))
+        if the_ta.active:
+            self.free_ta.add(the_ta)
+            self._journal('free_add', ta_user_id)
+            effects += self._queue_move()  # Never hands the passed student back to this TA
+        self._touch()
+        self._mark_dirty([ta_user_id])
+        return passed_student, effects
+
+    def _t_student_request(self, user_id):
+        if self.get_student_status(user_id) != 'idle':  # Already queued or helped, e.g. Connect clicked twice
+            return None, []
+        now = time()
+        self.stats.on_arrival(now)
+        dropped_at = self._dropped_at.pop(user_id, None)
         if len(self.free_ta) == 0:
+            student_class = CLASS_REQUEUED if dropped_at is not None and now - dropped_at < REQUEUE_WINDOW \
+                else CLASS_NORMAL
             self.set_student_status(user_id, 'queued')
-            self.student_queue.append(user_id)
+            self.student_queue.append(user_id, now, student_class)
+            self._queued_at[user_id] = now
+            self._journal('enqueue', user_id, now, student_class)
+            self._queue_changed(list(self.student_queue.items_after(user_id)))
+            return None, []
         else:
-            await self.make_connection(user_id)
+            return None, self._make_connection(user_id, now, self.free_ta.pop())
 
-    async def make_connection(self, student_id, free_ta_index=0):
-        assert len(self.free_ta) != 0
-        assert free_ta_index < len(self.free_ta)
-        self.set_student_status(student_id, 'busy')
-        assigned_ta = self.free_ta[free_ta_index]
-        await assigned_ta.assign(student_id) # This will send TA a notification
-        self.pairs[assigned_ta] = student_id
-        self.free_ta.remove(assigned_ta)
-        # Send student notification
-        await self.slack.send_chat_text(await self.slack.get_im_channel(student_id),
-                                        ":tada: You are now connected with a TA. They will DM you in a second."
-                                        " If you don't get any message within 1 minute,"
-                                        " DM your section lead to let them know.")
-
-    def student_remove_from_queue(self, user_id, trigger_id):
-        assert user_id in self.student_queue
+    def _t_student_remove_from_queue(self, user_id):
+        if user_id not in self.student_queue:   # Already left or was picked up, e.g. a stale Leave button
+            return None, []
+        moved_students = list(self.student_queue.items_after(user_id))
         self.student_queue.remove(user_id)
+        self._queued_at.pop(user_id, None)
+        self._queue_keys.pop(user_id, None)
+        self.stats.on_abandoned()
+        self._journal('dequeue', user_id)
         self.set_student_status(user_id, 'idle')
+        self._queue_changed(moved_students)
+        return None, []
+
+    def _t_flag_student(self, user_id):
+        if user_id not in self.student_queue:
+            return None, []
+        if self.can_flag() and self.student_queue.class_of(user_id) != CLASS_FLAGGED:
+            key = self.student_queue.promote(user_id, CLASS_FLAGGED, self._queued_at.get(user_id))
+            self._queue_keys[user_id] = key
+            self._journal('queue_class', user_id, CLASS_FLAGGED, key)
+            self._touch()
+            self._queue_changed(list(self.student_queue))
+        return self.student_queue.position(user_id), []
+
+    def _t_add_member(self, user_id):
+        self.members.add(user_id)
+        self._journal('member', user_id, True)
+        return None, []
+
+    def _t_remove_member(self, user_id):
+        if self.get_student_status(user_id) != 'idle' or self.is_ta_active(user_id) or self.is_ta_helping(user_id):
+            return False, []
+        self.members.discard(user_id)
+        self._journal('member', user_id, False)
+        return True, []
+
+    def _t_toggle_system_active(self, is_active):
+        self.system_active = is_active
+        self._journal('system', is_active)
+        effects = []
+        if not is_active:
+            # Mark all TA inactive, clear queue
+            for ta in list(self.pairs.keys()) + list(self.free_ta):
+                if ta.active:
+                    effects.append(ta.set_active(False))
+                    self._journal('ta_active', ta.uid, False)
+            self.free_ta.clear()
+            self._journal('free_clear')
+
+        self._touch()
+        removed_students = list(self.student_queue)
+        for queued_student_id in removed_students:
+            self.set_student_status(queued_student_id, 'idle')
+        self._queue_changed(removed_students)
+        self.student_queue.clear()
+        self._queued_at = dict()
+        self._queue_keys = dict()
+        self._journal('queue_clear')
+        effects += [lambda student_id=student_id: self._notify(
+            student_id,
+            "You are removed from queue since TA turned off the system."
+            " You can still use Piazza for Q&A."
+            " DM a TA if you believe this is an error.") for student_id in removed_students]
+        return None, effects
+
+    def _make_connection(self, student_id, queued_at, assigned_ta, notice=CONNECTED_TEXT):
+        """
+        :param queued_at: When the student asked for help, None if unknown
+        :param assigned_ta: TA already popped from the free pool, picked by TA pool policy
+        :param notice: Message for the student
+        """
+        now = time()
+        self.set_student_status(student_id, 'busy')
+        self.pairs[assigned_ta] = student_id
+        if queued_at is not None:
+            self.stats.on_assigned(assigned_ta.uid, now - queued_at)
+        self._journal('free_remove', assigned_ta.uid)
+        self._journal('pair', assigned_ta.uid, student_id, now)
+        return [assigned_ta.assign(student_id, now),  # This will send TA a notification
+                lambda: self._notify(student_id, notice)]  # Send student notification
+
+    def _queue_move(self):
+        """ Connect the first queued student with a free TA who has not passed them on, if there is one """
+        assert len(self.free_ta) != 0
+        for student_id in self.student_queue:
+            passed_by = self._passed_by.get(student_id)
+            assigned_ta = self.free_ta.pop() if passed_by is None else self.free_ta.pop_excluding(passed_by)
+            if assigned_ta is not None:
+                break
+        else:
+            return []
+        # Dequeue student, everyone behind moves up
+        moved_students = list(self.student_queue.items_after(student_id))
+        self.student_queue.remove(student_id)
+        self._queue_keys.pop(student_id, None)
+        self._journal('dequeue', student_id)
+        self._queue_changed([student_id] + moved_students)
+        return self._make_connection(student_id, self._queued_at.pop(student_id, None), assigned_ta)
+
+    async def _notify(self, user_id, text):
+        await self.slack.send_chat_text(await self.slack.get_im_channel(user_id), text)
 
     def is_ta(self, user_id):
         """ Returns (is_ta, is_active) """
@@ -181,7 +703,9 @@ class QueueManager:
         if len(self.student_queue) == 0:
             return 'Empty Queue. Looking good!'
         else:
-            return '> ' + '\n> '.join([await self.slack.get_user_name(sid) for sid in self.student_queue])
+            names = await fan_out(self.student_queue, self.slack.get_user_name)
+            return '> ' + '\n> '.join([name if name is not None else sid
+                                       for sid, name in zip(names.items, names.results)])
 
     def str_free_ta(self):
         if len(self.free_ta) == 0:
@@ -190,11 +714,16 @@ class QueueManager:
             return '> ' + '\n> '.join([ta.name for ta in self.free_ta])
 
     def get_ta_size(self):
-        return len(self.free_ta) + len(self.pairs)
+        """ TAs taking students: free ones plus busy ones still logged in, a TA who logged off takes no one new """
+        return len(self.free_ta) + sum(1 for ta in self.pairs if ta.active)
 
     def get_queue_position(self, user_id):
         assert user_id in self.student_queue
-        return self.student_queue.index(user_id) + 1
+        return self.student_queue.position(user_id)
+
+    def get_eta(self, user_id):
+        """ Estimated seconds until a queued student is assigned, None without enough data """
+        return self.stats.eta(self.get_queue_position(user_id), self.get_ta_size())
 
     def get_student_status(self, user_id):
         if user_id not in self._student_status.keys():
@@ -204,19 +733,14 @@ class QueueManager:
 
     def set_student_status(self, user_id, status):
         assert status in ['idle', 'queued', 'busy']
+        self._touch()
+        self._journal('status', user_id, status)
         self._student_status[user_id] = status
+        if status == 'idle':
+            self._passed_by.pop(user_id, None)
 
         return self._student_status[user_id]
 
-    async def queue_move(self):
-        assert len(self.free_ta) != 0
-        if len(self.student_queue) != 0:
-            # Dequeue student
-            student_id = self.student_queue[0]
-            self.student_queue.remove(student_id)
-
-            await self.make_connection(student_id)
-
     def get_ta_login_text(self, user_id):
         if user_id not in self.tas:
             return ":key: TA Login"
@@ -231,19 +755,156 @@ class QueueManager:
                 return True
         return False
 
-    async def toggle_system_active(self, is_active):
-        if not is_active:
-            # Mark all TA inactive, clear queue
-            for ta in self.pairs.keys():
-                await ta.make_offline_if_online()
-            for ta in self.free_ta:
-                await ta.make_offline_if_online()
-            self.free_ta = []
-
-        for queued_student_id in self.student_queue:
-            await self.slack.send_chat_text(await self.slack.get_im_channel(queued_student_id),
-                                            "You are removed from queue since TA turned off the system."
-                                            " You can still use Piazza for Q&A."
-                                            " DM a TA if you believe this is an error.")
-            self.set_student_status(queued_student_id, 'idle')
-        self.student_queue = []
+    def can_flag(self):
+        """ Flagged students get a head start under this section's queue policy, not under fifo """
+        return self.student_queue.credits.get(CLASS_FLAGGED, 0) > 0
+
+    def is_ta_helping(self, user_id):
+        """ TA is paired with a student, logged in or not """
+        return user_id in self.tas and self.tas[user_id] in self.pairs
+
+    async def warm_im_channels(self):
+        """ Cache IM channels of logged in TAs, they get a notification for every assignment """
+        await self.slack.warm_im_channels([uid for uid, ta in self.tas.items() if ta.active])
+
+
+class QueueRegistry:
+    """
+    One independent QueueManager per section (lab section / course) in the workspace
+    Each section has its own system switch, TA pool, queue, render cache, publisher and journal.
+    Users belong to one section, routing is a dict lookup. Users never assigned go to the default section.
+    Sections are the default one and those of channel_sections, plus any left over in journals on disk.
+    """
+
+    def __init__(self, slack_web_client, ta_policy='least-recently-assigned', journal_path=None,
+                 channel_sections=None, on_create=None, backend=None, queue_policy='fifo', section_policies=None):
+        """
+        :param slack_web_client: Slack instance
+        :param ta_policy: TA pool policy for every section
+        :param queue_policy: Student queue policy of sections not in section_policies
+        :param section_policies: Section -> student queue policy
+        :param journal_path: Journal path of the default section, other sections get <name>.<section><ext>.
+                             None to run without journals
+        :param channel_sections: Channel ID -> section; joining that channel routes a user to the section
+        :param on_create: Called with each new QueueManager, e.g. to attach a publisher
+        :param backend: State backend shared by all sections, MemoryBackend by default
+        """
+        self.slack = slack_web_client
+        self.ta_policy = ta_policy
+        self.queue_policy = queue_policy
+        self.section_policies = section_policies if section_policies is not None else dict()
+        self.journal_path = journal_path
+        self.channel_sections = channel_sections if channel_sections is not None else dict()
+        self.on_create = on_create
+        self.backend = backend if backend is not None else MemoryBackend()
+        self._managers = dict()         # section -> QueueManager
+        # Users can only join configured sections, journaled ones are loaded so nobody in them is stranded
+        self.sections = {DEFAULT_SECTION} | set(self.channel_sections.values())
+        for section in sorted(self.sections | self._journaled_sections()):
+            self._create(section)
+
+    def __iter__(self):
+        return iter(list(self._managers.values()))
+
+    def get(self, section):
+        """ QueueManager of a section, KeyError if there is no such section """
+        return self._managers[section]
+
+    def _create(self, section):
+        """ New QueueManager for a section, restored from its journal """
+        assert re.fullmatch(r'[A-Za-z0-9_-]+', section), f'Invalid section name: {section}'
+        manager = QueueManager(self.slack, self.ta_policy, section,
+                               self.section_policies.get(section, self.queue_policy))
+        manager.backend = self.backend
+        if self.journal_path is not None:
+            journal = Journal(self._journal_path_for(section))
+            manager.restore(journal.open())
+            manager.journal = journal
+            for user_id in manager.members:
+                self.backend.set_section(user_id, section)
+        manager.load_shared()
+        if self.on_create is not None:
+            self.on_create(manager)
+        self._managers[section] = manager
+
+    async def section_of(self, user_id):
+        """ Section the user belongs to, the default one if unassigned or routed to a section no longer served """
+        section = await self.backend.read(self.backend.section_of, user_id)
+        return section if section in self._managers else DEFAULT_SECTION
+
+    async def route(self, user_id):
+        """ QueueManager serving this user, synced with other worker processes """
+        manager = self.get(await self.section_of(user_id))
+        await manager.sync()
+        return manager
+
+    async def join(self, user_id, section):
+        """
+        Move a user to another section
+        :param section: One of self.sections, ValueError otherwise
+        :return: False if the user is busy in their current section (queued, logged in, helping or being helped)
+        """
+        if section not in self.sections:
+            raise ValueError(f'Unknown section: {section}')
+        current = await self.route(user_id)
+        if current.section == section:
+            return True
+        if not await current.remove_member(user_id):
+            return False
+        await self.get(section).add_member(user_id)
+        await self.backend.run(self.backend.set_section, user_id, section)
+        return True
+
+    async def on_channel_join(self, channel_id, user_id):
+        """ member_joined_channel handler, routes users joining a section channel to that section """
+        if channel_id in self.channel_sections:
+            return await self.join(user_id, self.channel_sections[channel_id])
+        return False
+
+    async def load_channel_members(self):
+        """ Route current members of section channels, users already routed keep their section """
+        for channel_id, section in self.channel_sections.items():
+            for user_id in await self.slack.get_channel_members(channel_id):
+                if await self.backend.read(self.backend.section_of, user_id) is None:
+                    await self.join(user_id, section)
+
+    def close(self):
+        """ Flush journals. Blocking, run off the event loop. """
+        for manager in self._managers.values():
+            if manager.journal is not None:
+                manager.journal.close()
+
+    def _journaled_sections(self):
+        """ Sections with a journal on disk, so sections created at runtime come back after a restart """
+        if self.journal_path is None:
+            return set()
+        root, ext = os.path.splitext(self.journal_path)
+        pattern = re.compile(re.escape(os.path.basename(root)) + r'\.([A-Za-z0-9_-]+)' + re.escape(ext))
+        directory = os.path.dirname(self.journal_path) or '.'
+        return {match.group(1) for match in map(pattern.fullmatch, os.listdir(directory)) if match is not None}
+
+    def _journal_path_for(self, section):
+        if section == DEFAULT_SECTION:
+            return self.journal_path
+        root, ext = os.path.splitext(self.journal_path)
+        return f'{root}.{section}{ext}'
+
+
+def parse_channel_sections(spec):
+    """ "lab1:C0123,lab2:C0456" -> {'C0123': 'lab1', 'C0456': 'lab2'} """
+    channel_sections = dict()
+    for item in spec.split(','):
+        if item.strip() != '':
+            section, channel_id = item.strip().split(':')
+            channel_sections[channel_id] = section
+    return channel_sections
+
+
+def parse_section_policies(spec):
+    """ "lab1:aging,lab2:fifo" -> {'lab1': 'aging', 'lab2': 'fifo'} """
+    section_policies = dict()
+    for item in spec.split(','):
+        if item.strip() != '':
+            section, policy = item.strip().split(':')
+            section_policies[section] = policy
+    return section_policies
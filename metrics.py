@@ -0,0 +1,131 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+# Seconds, covers a cache hit (sub-millisecond) up to a Slack call stuck behind Retry-After
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram, Prometheus style
+    observe() is a bisect and three increments, no locks: everything records from the event loop thread.
+    Buckets are kept per bucket and only made cumulative when rendered.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        """ Observe the seconds spent in the with block """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+
+class HistogramFamily:
+    """ One histogram per label values, created on first observation """
+
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self.children = dict()  # Label values tuple -> Histogram
+
+    def labels(self, *values):
+        histogram = self.children.get(values)
+        if histogram is None:
+            histogram = self.children[values] = Histogram(self.buckets)
+        return histogram
+
+    def observe(self, values, value):
+        self.labels(*values).observe(value)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for values, histogram in sorted(self.children.items(), key=_label_order):
+            labels = _labels(self.label_names, values)
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{{{labels + "," if labels else ""}le="{le}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'{self.name}_count{{{labels}}} {histogram.count}')
+        return lines
+
+
+class Collected:
+    """
+    Counter or gauge read at scrape time from state the app keeps anyway, so recording costs nothing
+    collect() returns an iterable of (label values tuple, value).
+    """
+
+    def __init__(self, name, help_text, metric_type, label_names, collect):
+        assert metric_type in ('counter', 'gauge')
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.label_names = tuple(label_names)
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.metric_type}']
+        for values, value in sorted(self.collect(), key=_label_order):
+            labels = _labels(self.label_names, values)
+            lines.append(f'{self.name}{{{labels}}} {value}' if labels else f'{self.name} {value}')
+        return lines
+
+
+class Metrics:
+    """ Set of metric families rendered together in the Prometheus text format """
+
+    def __init__(self):
+        self._families = []
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        family = HistogramFamily(name, help_text, label_names, buckets)
+        self._families.append(family)
+        return family
+
+    def add(self, family):
+        """ Register a family owned elsewhere, e.g. SlackCallScheduler.latency """
+        self._families.append(family)
+        return family
+
+    def counter(self, name, help_text, label_names, collect):
+        return self.add(Collected(name, help_text, 'counter', label_names, collect))
+
+    def gauge(self, name, help_text, label_names, collect):
+        return self.add(Collected(name, help_text, 'gauge', label_names, collect))
+
+    def render(self):
+        lines = []
+        for family in self._families:
+            lines += family.render()
+        return '\n'.join(lines) + '\n'
+
+
+def _label_order(item):
+    return tuple(str(value) for value in item[0])
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
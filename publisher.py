@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from ratelimit import PRIORITY_NORMAL, PRIORITY_BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_DEBOUNCE = 0.5
+
+
+class HomePublisher:
+    """
+    Pushes App Home updates to users whose view changed, instead of waiting for them to click refresh
+    State changes mark users dirty; a background task waits for marks to settle, renders each dirty user once
+    and publishes it through Slack's call scheduler, below any view a user is waiting on after a click.
+    Views a user asked for, by clicking or opening their home, are requested instead: published right away at
+    normal priority in a task of their own, so the handler that asked never waits on the views.publish budget.
+    """
+
+    def __init__(self, slack, render, debounce=PUBLISH_DEBOUNCE, section=None):
+        """
+        :param slack: Slack instance
+        :param render: Coroutine function user_id -> home view
+        :param debounce: Seconds to collect further marks before publishing
+        :param section: Queue section, takes turns with other sections' pushes in the views.publish budget
+        """
+        self.slack = slack
+        self.render = render
+        self.debounce = debounce
+        self.section = section
+        self._dirty = set()
+        self._wake = asyncio.Event()
+        self._task = None
+        self._requests = dict()         # user ID -> task publishing a requested view
+        self._requested_again = dict()  # user ID -> force, requested while their last request was in flight
+        self.published = 0
+
+    def mark_dirty(self, user_ids):
+        for user_id in user_ids:
+            self._dirty.add(user_id)
+        if len(self._dirty) != 0:
+            self.start()
+            self._wake.set()
+
+    def request(self, user_id, force=False):
+        """
+        Publish a user's home view soon, ahead of pushes. Requests made before it goes out collapse into one.
+        :param force: Publish even if unchanged, see Slack.send_home_view
+        """
+        self._dirty.discard(user_id)
+        if user_id in self._requests:   # Rendered already, maybe before the change the user is asking to see
+            self._requested_again[user_id] = self._requested_again.get(user_id, False) or force
+        else:
+            self._requests[user_id] = asyncio.ensure_future(self._serve_request(user_id, force))
+
+    def pending(self):
+        return len(self._dirty) + len(self._requests)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._requested_again.clear()
+        for task in [self._task] + list(self._requests.values()):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(self.debounce)
+            self._wake.clear()
+            batch, self._dirty = self._dirty, set()
+            await asyncio.gather(*[self._publish(user_id) for user_id in batch])
+
+    async def _serve_request(self, user_id, force):
+        try:
+            await self._publish(user_id, PRIORITY_NORMAL, force)
+        finally:
+            del self._requests[user_id]
+            if user_id in self._requested_again:
+                self.request(user_id, self._requested_again.pop(user_id))
+
+    async def _publish(self, user_id, priority=PRIORITY_BACKGROUND, force=False):
+        try:
+            await self.slack.send_home_view(user_id, await self.render(user_id), force,
+                                          priority=priority, shard=self.section)
+            self.published += 1
+        except Exception:
+            logger.exception(f'Failed to publish home view for {user_id}')
@@ -0,0 +1,229 @@
+import asyncio
+import heapq
+from time import monotonic
+from metrics import HistogramFamily
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter for coroutines
+    Allows bursts of up to `burst` calls, refilled at `rate` tokens per second.
+    """
+
+    def __init__(self, rate, burst, clock=monotonic):
+        assert rate > 0 and burst >= 1
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def delay(self):
+        """ Seconds until next token is available """
+        self._refill()
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep(self.delay())
+
+
+def per_minute(calls_per_minute, burst=None):
+    """ Bucket sized for a Slack rate tier, given in calls per minute """
+    return TokenBucket(calls_per_minute / 60, burst if burst is not None else max(1, calls_per_minute // 10))
+
+
+# Outbound call priorities, lower runs first
+PRIORITY_URGENT = 0     # Time critical: TA assignment, modals (trigger_id expires in 3 seconds)
+PRIORITY_NORMAL = 1     # Includes home views published in answer to a click
+PRIORITY_LOW = 2        # Cache warming
+PRIORITY_BACKGROUND = 3  # Home views pushed by HomePublisher after someone else's action
+
+# Calls per minute per Slack rate tier https://api.slack.com/docs/rate-limits
+TIER_PER_MINUTE = {1: 1, 2: 20, 3: 50, 4: 100}
+METHOD_TIERS = {    # Tiers from each method's documentation page
+    'auth.test': 4,     # Special, effectively tier 4
+    'users.list': 2,
+    'users.info': 4,
+    'conversations.info': 3,
+    'conversations.open': 3,
+    'conversations.members': 4,
+    'chat.delete': 3,
+    'views.publish': 4,
+    'views.open': 4,
+}
+DEFAULT_TIER = 3
+# Special tier methods limited per channel instead of per workspace: calls per minute, burst
+PER_CHANNEL_LIMITS = {
+    'chat.postMessage': (60, 3),    # 1 per second per channel, short bursts tolerated
+}
+MAX_RATE_LIMITED_RETRIES = 3
+
+
+class SlackCallScheduler:
+    """
+    Single gate for outbound Slack Web API calls
+    - One token bucket per method, sized by the method's rate tier, or per method and channel for
+      PER_CHANNEL_LIMITS methods
+    - A 429 pauses that bucket for Retry-After seconds and the call is retried
+    - Among calls that may run now, the highest priority (then oldest) goes first
+    - Within one bucket and priority, calls tagged with a shard (e.g. a queue section) take turns round-robin,
+      so one shard's backlog does not hold back the others
+    """
+
+    def __init__(self, method_tiers=None, tier_per_minute=None, per_channel_limits=None):
+        self.method_tiers = METHOD_TIERS if method_tiers is None else method_tiers
+        self.tier_per_minute = TIER_PER_MINUTE if tier_per_minute is None else tier_per_minute
+        self.per_channel_limits = PER_CHANNEL_LIMITS if per_channel_limits is None else per_channel_limits
+        # Keyed by bucket: method, or (method, channel) for per channel methods
+        self._buckets = dict()      # bucket -> TokenBucket
+        self._pending = dict()      # bucket -> heap of [priority, turn, seq, coro_fn, future, retries]
+        self._next_turn = dict()    # (bucket, priority) -> {shard -> round of its next call}
+        self._served_turn = dict()  # (bucket, priority) -> round of the last sharded call sent
+        self._paused_until = dict() # bucket -> monotonic time, set by Retry-After
+        self._seq = 0
+        self._wake = None
+        self._task = None
+        self._running = set()       # _execute tasks, referenced until done so they are not garbage collected
+        # Stats
+        self.calls = dict()         # method -> calls sent
+        self.rate_limited = dict()  # method -> 429 responses
+        self.latency = HistogramFamily('slack_api_call_seconds', 'Slack Web API call latency, each attempt',
+                                       ('method',))
+
+    async def call(self, method, coro_fn, priority=PRIORITY_NORMAL, channel=None, shard=None):
+        """
+        :param method: Slack API method name, e.g. 'chat.postMessage'
+        :param coro_fn: Zero-argument coroutine function performing the call
+        :param priority: One of PRIORITY_*
+        :param channel: Channel the call targets, selects the bucket of PER_CHANNEL_LIMITS methods
+        :param shard: Fair share key, calls without one run in the current round in arrival order
+        :return: Result of coro_fn
+        """
+        self._ensure_started()
+        future = asyncio.get_event_loop().create_future()
+        bucket = (method, channel) if method in self.per_channel_limits else method
+        self._push(bucket, [priority, self._turn(bucket, priority, shard), self._seq, coro_fn, future, 0])
+        self._seq += 1
+        return await future
+
+    def pending(self):
+        return sum(len(heap) for heap in self._pending.values())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._task = asyncio.ensure_future(self._dispatch())
+
+    def _bucket(self, bucket):
+        if bucket not in self._buckets:
+            if isinstance(bucket, tuple):
+                self._buckets[bucket] = per_minute(*self.per_channel_limits[bucket[0]])
+            else:
+                self._buckets[bucket] = per_minute(
+                    self.tier_per_minute[self.method_tiers.get(bucket, DEFAULT_TIER)])
+        return self._buckets[bucket]
+
+    def _turn(self, bucket, priority, shard):
+        """ Round a call runs in: a shard's calls get one round each, an idle shard rejoins at the current one """
+        served = self._served_turn.get((bucket, priority), 0)
+        if shard is None:
+            return served
+        next_turn = self._next_turn.setdefault((bucket, priority), dict())
+        turn = max(next_turn.get(shard, 0), served)
+        next_turn[shard] = turn + 1
+        return turn
+
+    def _push(self, bucket, entry):
+        heapq.heappush(self._pending.setdefault(bucket, []), entry)
+        self._wake.set()
+
+    async def _dispatch(self):
+        while True:
+            self._wake.clear()
+            now = monotonic()
+            best = None
+            best_head = None    # (priority, seq) of best's next call, buckets compare by priority then age
+            wait = None
+            for bucket, heap in list(self._pending.items()):
+                if len(heap) == 0:
+                    if isinstance(bucket, tuple):
+                        del self._pending[bucket]   # One per channel ever posted to, don't keep scanning them
+                    continue
+                delay = max(self._paused_until.get(bucket, 0.0) - now, self._bucket(bucket).delay())
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                elif best is None or (heap[0][0], heap[0][2]) < best_head:
+                    best = bucket
+                    best_head = (heap[0][0], heap[0][2])
+
+            if best is not None:
+                self._bucket(best).try_acquire()
+                entry = heapq.heappop(self._pending[best])
+                if entry[1] > self._served_turn.get((best, entry[0]), 0):
+                    self._served_turn[(best, entry[0])] = entry[1]
+                task = asyncio.ensure_future(self._execute(best, entry))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+                continue
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, bucket, entry):
+        _, _, _, coro_fn, future, retries = entry
+        if future.cancelled():
+            return
+        method = bucket[0] if isinstance(bucket, tuple) else bucket
+        self.calls[method] = self.calls.get(method, 0) + 1
+        histogram = self.latency.labels(method)
+        start = monotonic()
+        try:
+            result = await coro_fn()
+        except Exception as e:
+            histogram.observe(monotonic() - start)
+            retry_after = _retry_after(e)
+            if retry_after is not None:
+                self.rate_limited[method] = self.rate_limited.get(method, 0) + 1
+            if retry_after is None or retries >= MAX_RATE_LIMITED_RETRIES:
+                if not future.done():
+                    future.set_exception(e)
+                return
+            self._paused_until[bucket] = max(self._paused_until.get(bucket, 0.0), monotonic() + retry_after)
+            entry[5] += 1
+            self._push(bucket, entry)
+            return
+        histogram.observe(monotonic() - start)
+        if not future.done():
+            future.set_result(result)
+
+
+def _retry_after(error):
+    """ Seconds to wait if error is a Slack 429 response, otherwise None """
+    response = getattr(error, 'response', None)
+    if response is None or getattr(response, 'status_code', None) != 429:
+        return None
+    return float(response.headers.get('Retry-After', 1))
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+RETRY_INITIAL = 1.0     # Seconds before retrying a failed startup step, doubled each time
+RETRY_MAX = 60.0
+
+
+class Readiness:
+    """
+    Startup steps run inside the event loop after the server is bound
+    The app is ready once every critical step has finished; other steps only warm caches or have a fallback.
+    A failing step is retried with backoff instead of leaving the process half started, non-critical steps
+    may give up after a number of attempts.
+    """
+
+    def __init__(self, critical):
+        """ :param critical: Names of the steps that must finish before requests are handled """
+        self.critical = set(critical)
+        self.started = monotonic()
+        self.finished = dict()      # Step name -> seconds after start
+        self.failures = dict()      # Step name -> failed attempts
+        self.abandoned = set()      # Steps that gave up
+        self._ready = asyncio.Event()
+        if len(self.critical) == 0:
+            self._ready.set()
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    async def wait(self):
+        await self._ready.wait()
+
+    def status(self):
+        return {
+            'ready': self.is_ready(),
+            'finished': self.finished,
+            'pending': sorted(self.critical - set(self.finished)),
+            'failures': self.failures,
+            'abandoned': sorted(self.abandoned),
+        }
+
+    async def run(self, name, coro_fn, attempts=None):
+        """
+        Run one step until it succeeds
+        :param attempts: Give up after this many failures, None to retry forever. Critical steps always retry.
+        """
+        assert attempts is None or name not in self.critical
+        delay = RETRY_INITIAL
+        while True:
+            try:
+                await coro_fn()
+                break
+            except Exception:
+                self.failures[name] = self.failures.get(name, 0) + 1
+                if attempts is not None and self.failures[name] >= attempts:
+                    logger.exception(f'Startup step {name} failed {attempts} times, giving up')
+                    self.abandoned.add(name)
+                    return
+                logger.exception(f'Startup step {name} failed, retrying in {delay:.0f}s')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX)
+        self.finished[name] = monotonic() - self.started
+        logger.info(f'Startup step {name} done after {self.finished[name]:.2f}s')
+        if self.critical.issubset(self.finished):
+            self._ready.set()
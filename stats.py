@@ -0,0 +1,170 @@
+import math
+from time import time
+
+SERVICE_ALPHA = 0.2             # Weight of the newest session in the service time EWMA
+RATE_HALF_LIFE = 30 * 60        # Seconds, arrival / throughput rates follow roughly the last half hour
+SKETCH_ACCURACY = 0.02          # Relative error of wait time quantiles
+SKETCH_MAX_BINS = 512           # Bounds sketch memory, enough for 1 ms .. days at 2% accuracy
+WAIT_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Ewma:
+    """ Exponentially weighted moving average, None until the first sample """
+
+    def __init__(self, alpha=SERVICE_ALPHA):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, sample):
+        self.value = sample if self.value is None else self.value + self.alpha * (sample - self.value)
+
+
+class DecayingRate:
+    """ Events per second, exponentially decayed so it follows the recent rate rather than the all-time average """
+
+    def __init__(self, half_life=RATE_HALF_LIFE):
+        self._tau = half_life / math.log(2)
+        self._value = 0.0
+        self._updated = None
+
+    def _decay(self, now):
+        if self._updated is not None:
+            self._value *= math.exp(-(now - self._updated) / self._tau)
+        self._updated = now
+
+    def record(self, now=None):
+        self._decay(time() if now is None else now)
+        self._value += 1
+
+    def rate(self, now=None):
+        self._decay(time() if now is None else now)
+        return self._value / self._tau
+
+
+class QuantileSketch:
+    """
+    Relative-error quantile sketch (DDSketch)
+    A value lands in logarithmic bucket ceil(log_gamma(value)), so any reported quantile is within `accuracy`
+    of the true one. add() is O(1); memory is at most max_bins counters, past that the two lowest buckets merge,
+    which only loses accuracy on the lowest quantiles.
+    """
+
+    def __init__(self, accuracy=SKETCH_ACCURACY, max_bins=SKETCH_MAX_BINS, min_value=1e-3):
+        self._gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.max_bins = max_bins
+        self.min_value = min_value      # Values at or below this count as zero
+        self.bins = dict()              # Bucket index -> count
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= self.min_value:
+            self.zero_count += 1
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + 1
+        if len(self.bins) > self.max_bins:
+            lowest = min(self.bins)
+            count = self.bins.pop(lowest)
+            second = min(self.bins)
+            self.bins[second] += count
+
+    def quantile(self, q):
+        """ :return: Estimated q-quantile, None if empty """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return 2 * self._gamma ** index / (self._gamma + 1)  # Bucket midpoint in relative terms
+        return 2 * self._gamma ** max(self.bins) / (self._gamma + 1)
+
+
+class TimingStats:
+    """ Streaming statistics for one TA or a whole section, O(1) per update and constant memory """
+
+    def __init__(self):
+        self.service = Ewma()
+        self.throughput = DecayingRate()
+        self.wait = QuantileSketch()
+        self.served = 0
+
+    def record_wait(self, seconds):
+        self.wait.add(seconds)
+
+    def record_service(self, seconds, now):
+        self.service.update(seconds)
+        self.throughput.record(now)
+        self.served += 1
+
+    def summary(self, now=None):
+        return {
+            'served': self.served,
+            'service_seconds_ewma': self.service.value,
+            'throughput_per_hour': self.throughput.rate(now) * 3600,
+            'wait_seconds': {str(q): self.wait.quantile(q) for q in WAIT_QUANTILES},
+        }
+
+
+class SectionStats:
+    """
+    Wait and service times of one section and each of its TAs, kept for the whole term
+    Memory grows only with the number of TAs, never with the number of sessions.
+    """
+
+    def __init__(self):
+        self.overall = TimingStats()
+        self.tas = dict()               # TA user ID -> TimingStats
+        self.arrivals = DecayingRate()
+        self.abandoned = 0              # Students who left the queue before being helped
+
+    def ta(self, ta_uid):
+        stats = self.tas.get(ta_uid)
+        if stats is None:
+            stats = self.tas[ta_uid] = TimingStats()
+        return stats
+
+    def on_arrival(self, now):
+        self.arrivals.record(now)
+
+    def on_assigned(self, ta_uid, wait):
+        self.overall.record_wait(wait)
+        self.ta(ta_uid).record_wait(wait)
+
+    def on_completed(self, ta_uid, service, now):
+        self.overall.record_service(service, now)
+        self.ta(ta_uid).record_service(service, now)
+
+    def on_abandoned(self):
+        self.abandoned += 1
+
+    def eta(self, position, active_tas):
+        """
+        Expected seconds until the student at `position` (1-based) is assigned: with every active TA busy,
+        sessions end at active_tas / service_time per second and the student needs `position` of them.
+        :return: Seconds, None while there is no service time estimate or no TA
+        """
+        service = self.overall.service.value
+        if service is None or active_tas == 0:
+            return None
+        return position * service / active_tas
+
+    def summary(self, now=None):
+        now = time() if now is None else now
+        summary = self.overall.summary(now)
+        arrivals_per_second = self.arrivals.rate(now)
+        service = self.overall.service.value
+        summary.update({
+            'arrivals_per_hour': arrivals_per_second * 3600,
+            'abandoned': self.abandoned,
+            # Little's law: TAs kept busy on average at the current arrival rate, the staffing floor
+            'offered_load_tas': arrivals_per_second * service if service is not None else None,
+            'tas': {ta_uid: stats.summary(now) for ta_uid, stats in self.tas.items()},
+        })
+        return summary
@@ -0,0 +1,483 @@
+import heapq
+from bisect import bisect_left, bisect_right
+
+
+class IndexedQueue:
+    """
+    FIFO queue of unique ids with cheap rank lookup and cancellation
+    - append / popleft / push_front: amortized O(1)
+    - position / remove: O(log n)
+
+    Items live in a slot array in arrival order. Cancelled slots are left in place and recorded in a Fenwick tree,
+    so the rank of an item is its distance from head minus the cancellations in between.
+    Slot array is compacted (and the tree reset) whenever it fills up, or leaves room in front when push_front
+    runs out of freed slots before head.
+
+    Items may carry a sort key. Keys must not decrease in arrival order (insert keeps them sorted); count_before
+    then counts live items with a smaller key in O(log n), which lets PriorityStudentQueue rank an item across
+    several queues.
+    """
+    _MIN_CAPACITY = 16
+
+    def __init__(self, items=()):
+        self._slots = []         # uid or None (cancelled / dequeued)
+        self._keys = []          # Sort key per slot, kept for cancelled slots too so bisect stays valid
+        self._index = dict()     # uid -> slot index
+        self._tree = []          # Fenwick tree over cancelled slots, 1-based
+        self._head = 0           # First slot that may hold a live item
+        self._capacity = 0
+        self._rebuild([], [], self._MIN_CAPACITY)
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, item):
+        return item in self._index
+
+    def __iter__(self):
+        for i in range(self._head, len(self._slots)):
+            item = self._slots[i]
+            if item is not None:
+                yield item
+
+    def __repr__(self):
+        return f'IndexedQueue({list(self)})'
+
+    def clear(self):
+        self._rebuild([], [], self._MIN_CAPACITY)
+
+    def items_after(self, item):
+        """ Iterate items queued behind item """
+        for i in range(self._index[item] + 1, len(self._slots)):
+            if self._slots[i] is not None:
+                yield self._slots[i]
+
+    def append(self, item, key=None):
+        if item in self._index:
+            raise ValueError(f'{item} is already in queue')
+        if len(self._slots) == self._capacity:
+            live = [i for i in range(self._head, len(self._slots)) if self._slots[i] is not None]
+            self._rebuild([self._slots[i] for i in live], [self._keys[i] for i in live],
+                          max(self._MIN_CAPACITY, 2 * (len(self._index) + 1)))
+        self._index[item] = len(self._slots)
+        self._slots.append(item)
+        self._keys.append(key)
+
+    def insert(self, item, key):
+        """
+        Queue item in key order, behind items with an equal key
+        O(1) like append unless key is smaller than the last key, then O(n)
+        """
+        last_key = self.last_key()
+        if last_key is None or key >= last_key:
+            self.append(item, key)
+            return
+        if item in self._index:
+            raise ValueError(f'{item} is already in queue')
+        live = [i for i in range(self._head, len(self._slots)) if self._slots[i] is not None]
+        items = [self._slots[i] for i in live]
+        keys = [self._keys[i] for i in live]
+        at = bisect_right(keys, key)
+        items.insert(at, item)
+        keys.insert(at, key)
+        self._rebuild(items, keys, max(self._MIN_CAPACITY, 2 * len(items)))
+
+    def push_front(self, item, key=None):
+        """ Queue item ahead of everyone, its key must not be larger than the current head's """
+        if item in self._index:
+            raise ValueError(f'{item} is already in queue')
+        if len(self._index) != 0:
+            self._skip_cancelled()
+        else:
+            self._head = len(self._slots)  # Skip cancelled slots, their keys may be larger than the new one
+        if self._head == 0:
+            live = [i for i in range(len(self._slots)) if self._slots[i] is not None]
+            gap = max(self._MIN_CAPACITY, len(live))
+            self._rebuild([self._slots[i] for i in live], [self._keys[i] for i in live],
+                          gap + max(self._MIN_CAPACITY, 2 * (len(live) + 1)), gap)
+        self._head -= 1
+        if self._cancelled_before(self._head + 1) != self._cancelled_before(self._head):
+            self._mark_cancelled(self._head, -1)  # Reused slot was cancelled, not popped
+        self._index[item] = self._head
+        self._slots[self._head] = item
+        self._keys[self._head] = key
+
+    def popleft(self):
+        if len(self._index) == 0:
+            raise IndexError('pop from an empty queue')
+        self._skip_cancelled()
+        item = self._slots[self._head]
+        self._slots[self._head] = None
+        self._head += 1
+        del self._index[item]
+        return item
+
+    def peek(self):
+        if len(self._index) == 0:
+            raise IndexError('peek from an empty queue')
+        self._skip_cancelled()
+        return self._slots[self._head]
+
+    def peek_key(self):
+        self.peek()
+        return self._keys[self._head]
+
+    def last_key(self):
+        """ Key of the newest slot, live or not, None if nothing was ever appended since the last compaction """
+        return self._keys[-1] if len(self._keys) > self._head else None
+
+    def keyed(self, *tag):
+        """ Iterate (key, *tag, item) in queue order """
+        for i in range(self._head, len(self._slots)):
+            if self._slots[i] is not None:
+                yield (self._keys[i],) + tag + (self._slots[i],)
+
+    def key_of(self, item):
+        return self._keys[self._index[item]]
+
+    def count_before(self, key, inclusive=False):
+        """ Number of live items whose key is smaller than key (or equal, if inclusive) """
+        slot = (bisect_right if inclusive else bisect_left)(self._keys, key, self._head)
+        return slot - self._head - (self._cancelled_before(slot) - self._cancelled_before(self._head))
+
+    def remove(self, item):
+        slot = self._index.pop(item)  # Raises KeyError like dict
+        self._slots[slot] = None
+        self._mark_cancelled(slot)
+
+    def position(self, item):
+        """ 1-based position of item in queue """
+        slot = self._index[item]
+        return slot - self._head + 1 - (self._cancelled_before(slot) - self._cancelled_before(self._head))
+
+    def _skip_cancelled(self):
+        while self._slots[self._head] is None:
+            self._head += 1
+
+    def _mark_cancelled(self, slot, delta=1):
+        i = slot + 1
+        while i <= self._capacity:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _cancelled_before(self, slot):
+        """ Number of cancelled slots in [0, slot) """
+        total = 0
+        i = slot
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _rebuild(self, live_items, live_keys, capacity, gap=0):
+        """ :param gap: Free slots left before head for push_front """
+        self._capacity = capacity
+        self._slots = [None] * gap + list(live_items)
+        self._keys = [None] * gap + list(live_keys)
+        self._index = {item: i for i, item in enumerate(self._slots) if item is not None}
+        self._tree = [0] * (capacity + 1)
+        self._head = gap
+
+
+CLASS_FLAGGED = 'flagged'       # Flagged by a section lead
+CLASS_REQUEUED = 'requeued'     # Asked again right after a session that dropped
+CLASS_NORMAL = 'normal'
+STUDENT_CLASSES = (CLASS_FLAGGED, CLASS_REQUEUED, CLASS_NORMAL)  # Ties go to the earlier class
+
+# Head start in seconds per student class. 'fifo' ignores classes, 'aging' lets a flagged student go ahead of
+# anyone who joined less than 20 minutes before them; a student who has waited longer than that is served first.
+STUDENT_QUEUE_POLICIES = {
+    'fifo': {},
+    'aging': {CLASS_FLAGGED: 20 * 60, CLASS_REQUEUED: 10 * 60},
+}
+
+
+class PriorityStudentQueue:
+    """
+    Student queue ordered by aging priority, drop-in for IndexedQueue
+    Each class has a FIFO IndexedQueue keyed by queued_at minus the class's head start. Everyone ages at the same
+    rate, so a priority class only jumps students who joined less than its head start earlier: nobody starves.
+    - append / popleft: amortized O(1) plus a pick among the class heads
+    - position / remove: O(log n), rank counts smaller keys in every class queue
+    A key smaller than the last one of its class (clock stepped back, promoted or restored student) is inserted in
+    order, O(n). The order only depends on keys and classes, so appending the same keys rebuilds it.
+    """
+
+    def __init__(self, credits=None):
+        """ :param credits: Class -> head start in seconds, see STUDENT_QUEUE_POLICIES """
+        self.credits = credits if credits is not None else dict()
+        self._queues = {student_class: IndexedQueue() for student_class in STUDENT_CLASSES}
+        self._class_of = dict()     # uid -> student class
+
+    def __len__(self):
+        return len(self._class_of)
+
+    def __contains__(self, item):
+        return item in self._class_of
+
+    def __iter__(self):
+        """ Items in service order """
+        merged = heapq.merge(*[queue.keyed(rank) for rank, queue in enumerate(self._queues.values())])
+        return (item for _, _, item in merged)
+
+    def __repr__(self):
+        return f'PriorityStudentQueue({list(self)})'
+
+    def clear(self):
+        for queue in self._queues.values():
+            queue.clear()
+        self._class_of = dict()
+
+    def class_of(self, item):
+        return self._class_of[item]
+
+    def items_after(self, item):
+        """ Iterate items queued behind item """
+        found = False
+        for other in self:
+            if found:
+                yield other
+            found = found or other == item
+
+    def append(self, item, queued_at=0.0, student_class=CLASS_NORMAL, key=None):
+        """
+        :param queued_at: Epoch time the student joined, ordering within and across classes
+        :param key: Ordering key to use instead of queued_at minus the class's head start, see key_of
+        """
+        if item in self._class_of:
+            raise ValueError(f'{item} is already in queue')
+        if key is None:
+            key = (queued_at or 0.0) - self.credits.get(student_class, 0)
+        self._queues[student_class].insert(item, key)
+        self._class_of[item] = student_class
+
+    def key_of(self, item):
+        """ Ordering key, smallest is served first """
+        return self._queues[self._class_of[item]].key_of(item)
+
+    def promote(self, item, student_class, queued_at):
+        """
+        Move a queued item to a class with a larger head start, e.g. a flagged student. Never moves it back.
+        :param queued_at: When the student joined, None if unknown
+        :return: New ordering key, the smaller of the current one and queued_at minus the class's head start
+        """
+        key = self.key_of(item)
+        if queued_at is not None:
+            key = min(key, queued_at - self.credits.get(student_class, 0))
+        self.remove(item)
+        self.append(item, student_class=student_class, key=key)
+        return key
+
+    def push_front(self, item, now, student_class=CLASS_NORMAL):
+        """
+        Queue item ahead of everyone, e.g. a student a TA passed on
+        :return: Ordering key that gives item this place, what append needs to rebuild the same order
+        """
+        if item in self._class_of:
+            raise ValueError(f'{item} is already in queue')
+        credit = self.credits.get(student_class, 0)
+        heads = [queue.peek_key() for queue in self._queues.values() if len(queue) != 0]
+        key = min([now - credit] + [head - 0.001 for head in heads])  # Strictly ahead, ties would go by class
+        self._queues[student_class].push_front(item, key)
+        self._class_of[item] = student_class
+        return key
+
+    def popleft(self):
+        if len(self._class_of) == 0:
+            raise IndexError('pop from an empty queue')
+        item = self._head_queue().popleft()
+        del self._class_of[item]
+        return item
+
+    def peek(self):
+        if len(self._class_of) == 0:
+            raise IndexError('peek from an empty queue')
+        return self._head_queue().peek()
+
+    def remove(self, item):
+        self._queues[self._class_of.pop(item)].remove(item)  # Raises KeyError like dict
+
+    def position(self, item):
+        """ 1-based position of item in service order """
+        student_class = self._class_of[item]
+        key = self._queues[student_class].key_of(item)
+        position = 0
+        ahead = True    # Classes listed before the item's own class win ties
+        for other_class, queue in self._queues.items():
+            if other_class == student_class:
+                position += queue.position(item)
+                ahead = False
+            elif len(queue) != 0:
+                position += queue.count_before(key, inclusive=ahead)
+        return position
+
+    def _head_queue(self):
+        """ Class queue whose head is served next, smallest key then class order """
+        _, _, queue = min((queue.peek_key(), rank, queue)
+                          for rank, queue in enumerate(self._queues.values()) if len(queue) != 0)
+        return queue
+
+
+class LeastRecentlyAssignedPolicy:
+    """ Pick the TA whose last assignment is the oldest. TAs never assigned go first, in the order they became free """
+    name = 'least-recently-assigned'
+
+    def key(self, ta):
+        return ta.last_assigned
+
+    def on_assign(self, ta):
+        pass
+
+    def state(self):
+        """ Plain-data policy state beyond what TAs carry, None if there is none """
+        return None
+
+    def load(self, state):
+        pass
+
+
+class FewestSessionsTodayPolicy:
+    """ Pick the TA who has helped the fewest students today, ties broken by least recently assigned """
+    name = 'fewest-sessions-today'
+
+    def key(self, ta):
+        return ta.sessions_today(), ta.last_assigned
+
+    def on_assign(self, ta):
+        pass
+
+    def state(self):
+        return None
+
+    def load(self, state):
+        pass
+
+
+class RoundRobinPolicy:
+    """
+    Rotate through TAs in the order they first logged in
+    A TA joining late starts at the current turn instead of catching up on every missed turn
+    """
+    name = 'round-robin'
+
+    def __init__(self):
+        self._order = dict()     # uid -> login order
+        self._turn = dict()      # uid -> number of turns taken
+        self._current_turn = 0
+
+    def key(self, ta):
+        if ta.uid not in self._order:
+            self._order[ta.uid] = len(self._order)
+            self._turn[ta.uid] = self._current_turn
+        return self._turn[ta.uid], self._order[ta.uid]
+
+    def on_assign(self, ta):
+        self._current_turn = self._turn[ta.uid]
+        self._turn[ta.uid] += 1
+
+    def state(self):
+        return {'order': dict(self._order), 'turn': dict(self._turn), 'current_turn': self._current_turn}
+
+    def load(self, state):
+        self._order = dict(state['order'])
+        self._turn = dict(state['turn'])
+        self._current_turn = state['current_turn']
+
+
+TA_POLICIES = {policy.name: policy for policy in [LeastRecentlyAssignedPolicy,
+                                                  FewestSessionsTodayPolicy,
+                                                  RoundRobinPolicy]}
+
+
+class TAPool:
+    """
+    Pool of free TAs ordered by an assignment policy
+    - add / remove / membership: O(1) (remove is lazy)
+    - pop: O(log n)
+
+    Policy key is computed when a TA enters the pool, TA state used by the key only changes while the TA is assigned.
+    Iteration follows the order TAs became free.
+    """
+
+    def __init__(self, policy=None):
+        self.policy = policy if policy is not None else LeastRecentlyAssignedPolicy()
+        self._entries = dict()   # ta -> heap entry [key, seq, ta, valid]
+        self._heap = []
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, ta):
+        return ta in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def clear(self):
+        self._entries = dict()
+        self._heap = []
+
+    def add(self, ta):
+        if ta in self._entries:
+            return
+        entry = [self.policy.key(ta), self._seq, ta, True]
+        self._seq += 1
+        self._entries[ta] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, ta):
+        entry = self._entries.pop(ta)  # Raises KeyError like dict
+        entry[3] = False
+        if len(self._heap) > 2 * len(self._entries) + 32:
+            self._heap = [e for e in self._heap if e[3]]
+            heapq.heapify(self._heap)
+
+    def discard(self, ta):
+        if ta in self._entries:
+            self.remove(ta)
+
+    def peek(self):
+        self._drop_removed()
+        if len(self._heap) == 0:
+            raise IndexError('peek from an empty pool')
+        return self._heap[0][2]
+
+    def pop(self):
+        """ Remove and return the TA chosen by policy """
+        self._drop_removed()
+        if len(self._heap) == 0:
+            raise IndexError('pop from an empty pool')
+        _, _, ta, _ = heapq.heappop(self._heap)
+        del self._entries[ta]
+        self.policy.on_assign(ta)
+        return ta
+
+    def pop_excluding(self, uids):
+        """
+        Remove and return the TA chosen by policy among those whose uid is not in uids
+        :return: None if every free TA is excluded
+        """
+        skipped = []
+        chosen = None
+        while chosen is None:
+            self._drop_removed()
+            if len(self._heap) == 0:
+                break
+            entry = heapq.heappop(self._heap)
+            if entry[2].uid in uids:
+                skipped.append(entry)
+            else:
+                chosen = entry[2]
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        if chosen is not None:
+            del self._entries[chosen]
+            self.policy.on_assign(chosen)
+        return chosen
+
+    def _drop_removed(self):
+        while len(self._heap) != 0 and not self._heap[0][3]:
+            heapq.heappop(self._heap)
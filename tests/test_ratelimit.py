@@ -0,0 +1,22 @@
+import asyncio
+
+from ratelimit import SlackCallScheduler, PRIORITY_NORMAL, PRIORITY_BACKGROUND
+
+
+def test_shards_take_turns():
+    scheduler = SlackCallScheduler(tier_per_minute={4: 6000})
+    order = []
+
+    def call(label, shard, priority=PRIORITY_BACKGROUND):
+        async def send():
+            order.append(label)
+        return scheduler.call('views.publish', send, priority, shard=shard)
+
+    async def run():
+        calls = [call(f'a{i}', 'a') for i in range(4)] + [call('b0', 'b'), call('b1', 'b'), call('c0', 'c')]
+        calls.append(call('click', None, PRIORITY_NORMAL))
+        await asyncio.gather(*calls)
+        await scheduler.stop()
+
+    asyncio.run(run())
+    assert order == ['click', 'a0', 'b0', 'c0', 'a1', 'b1', 'a2', 'a3']
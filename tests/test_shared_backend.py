@@ -0,0 +1,107 @@
+import asyncio
+import multiprocessing
+import os
+import random
+
+import pytest
+
+pytest.importorskip('slack')
+
+from api import Slack  # noqa: E402
+from backend import SQLiteBackend  # noqa: E402
+from journal import StateModel  # noqa: E402
+from manager import QueueRegistry, DEFAULT_SECTION  # noqa: E402
+
+STUDENTS = [f'S{i:03d}' for i in range(60)]
+TAS = [f'T{i:02d}' for i in range(6)]
+
+
+class SilentSlack(Slack):
+    """ Slack without a Web API: names are IDs, messages go nowhere """
+
+    def __init__(self):
+        pass
+
+    async def get_user_name(self, user_id):
+        return user_id
+
+    async def get_im_channel(self, user_id):
+        return 'D' + user_id
+
+    async def warm_im_channels(self, user_ids):
+        pass
+
+    async def send_chat_text(self, channel_id, text, priority=None):
+        return self
+
+    async def send_chat_block(self, channel_id, block, priority=None):
+        return self
+
+    async def get_request_block(self, student_uid):
+        return []
+
+
+async def drive(path, seed, ops):
+    """ Random clicks from one worker process; clicks made stale by another process are no-ops """
+    registry = QueueRegistry(SilentSlack(), backend=SQLiteBackend(path))
+    rng = random.Random(seed)
+    manager = await registry.route(TAS[0])
+    if not manager.system_active:
+        await manager.toggle_system_active(True)
+    for _ in range(ops):
+        if rng.random() < 0.25:
+            ta_id = rng.choice(TAS)
+            manager = await registry.route(ta_id)
+            if ta_id in manager.tas and manager.tas[ta_id].busy and rng.random() < 0.8:
+                await manager.ta_complete_request(ta_id)
+            else:
+                await manager.ta_login(ta_id)
+        else:
+            student_id = rng.choice(STUDENTS)
+            manager = await registry.route(student_id)
+            status = manager.get_student_status(student_id)
+            if status == 'idle':
+                await manager.student_request(student_id, None)
+            elif status == 'queued':
+                await manager.student_remove_from_queue(student_id, None)
+    for manager in registry:
+        await manager.stop()
+    registry.close()
+
+
+def worker(path, seed, ops):
+    asyncio.run(drive(path, seed, ops))
+
+
+def check_invariants(state):
+    model = StateModel(state)
+    paired_students = list(model.pairs.values())
+    assert len(paired_students) == len(set(paired_students)), 'Student paired with two TAs'
+    assert not set(paired_students) & set(model.queue), 'Student both queued and helped'
+    for student_id in model.queue:
+        assert model.status.get(student_id) == 'queued', f'{student_id} queued with wrong status'
+    for student_id in paired_students:
+        assert model.status.get(student_id) == 'busy', f'{student_id} helped with wrong status'
+    for ta_id in model.free_ta:
+        assert model.tas[ta_id]['active'], f'Inactive TA {ta_id} in free pool'
+        assert ta_id not in model.pairs, f'Busy TA {ta_id} in free pool'
+    assert len(model.free_ta) == 0 or len(model.queue) == 0, 'Free TA while students wait'
+    return model
+
+
+def test_worker_processes_keep_queue_invariants(tmp_path):
+    path = os.path.join(tmp_path, 'state.db')
+    SQLiteBackend(path).close()  # Create schema before workers race for it
+    processes = [multiprocessing.Process(target=worker, args=(path, seed, 200)) for seed in range(2)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    assert [p.exitcode for p in processes] == [0, 0]
+    backend = SQLiteBackend(path)
+    try:
+        version, state = backend.load(DEFAULT_SECTION)
+        assert version is not None
+        check_invariants(state)
+    finally:
+        backend.close()
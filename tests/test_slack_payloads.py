@@ -0,0 +1,41 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('slack')
+
+from api import Slack  # noqa: E402
+from benchmarks.fake_slack import FakeSlack  # noqa: E402
+
+VIEW = {'type': 'home', 'blocks': [{'type': 'section', 'text': {'type': 'mrkdwn', 'text': 'Queue "A" – #1'}}]}
+
+
+def publish(view):
+    """ Publish view through Slack to a FakeSlack, :return: (content type, arguments) views.publish received """
+    received = []
+    fake = FakeSlack({'U1': 'one'}, listener=lambda method, args, response: received.append(dict(args)))
+    base_url = fake.start()
+
+    async def run():
+        slack = Slack('xoxb-test', 'test-secret', base_url)
+        await slack.open_session()
+        try:
+            await slack.send_home_view('U1', view)
+        finally:
+            await slack.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        fake.stop()
+    return fake.content_types['views.publish'], received[-1]
+
+
+@pytest.mark.parametrize('view', [VIEW, json.dumps(VIEW)], ids=['dict', 'serialized'])
+def test_home_view_is_a_json_string_field(view):
+    content_type, args = publish(view)
+    assert content_type == 'application/x-www-form-urlencoded'
+    assert args['user_id'] == 'U1'
+    assert json.loads(args['view']) == VIEW  # Decodes to the view, not to a string holding it again
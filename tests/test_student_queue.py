@@ -0,0 +1,132 @@
+import asyncio
+import random
+
+import pytest
+
+from structures import PriorityStudentQueue, STUDENT_QUEUE_POLICIES, CLASS_NORMAL, CLASS_REQUEUED, CLASS_FLAGGED
+
+AGING = STUDENT_QUEUE_POLICIES['aging']
+
+
+def rebuilt(queue):
+    """ Queue restored the way QueueManager.restore does it, from each student's class and key """
+    copy = PriorityStudentQueue(queue.credits)
+    for item in list(queue):
+        copy.append(item, student_class=queue.class_of(item), key=queue.key_of(item))
+    return copy
+
+
+def test_flag_keeps_the_wait_already_earned():
+    queue = PriorityStudentQueue(AGING)
+    for item, queued_at in [('A', 0.0), ('D', 100.0), ('B', 1500.0)]:
+        queue.append(item, queued_at)
+    queue.promote('B', CLASS_FLAGGED, 1500.0)
+    queue.promote('A', CLASS_FLAGGED, 0.0)
+    assert list(queue) == ['A', 'D', 'B']
+    assert [queue.position(item) for item in ['A', 'D', 'B']] == [1, 2, 3]
+
+
+def test_flag_never_lowers_position():
+    rng = random.Random(0)
+    for _ in range(200):
+        queue = PriorityStudentQueue(AGING)
+        queued_at = dict()
+        for i in range(rng.randint(1, 30)):
+            queued_at[i] = rng.uniform(0, 3600)
+            queue.append(i, queued_at[i], rng.choice([CLASS_NORMAL, CLASS_NORMAL, CLASS_REQUEUED]))
+        for item in rng.sample(list(queued_at), rng.randint(1, len(queued_at))):
+            if queue.class_of(item) == CLASS_FLAGGED:
+                continue
+            before = queue.position(item)
+            queue.promote(item, CLASS_FLAGGED, queued_at[item])
+            assert queue.position(item) <= before
+            order = list(queue)
+            assert [queue.position(other) for other in order] == list(range(1, len(order) + 1))
+            assert list(rebuilt(queue)) == order
+
+
+def test_passed_student_stays_in_front_after_restore():
+    queue = PriorityStudentQueue(AGING)
+    queue.append('A', 0.0)
+    queue.append('B', 100.0, CLASS_REQUEUED)
+    queue.push_front('P', 5000.0, CLASS_REQUEUED)
+    assert list(rebuilt(queue)) == list(queue) == ['P', 'B', 'A']     # B's head start puts them ahead of A
+    queue.promote('A', CLASS_FLAGGED, 0.0)    # Waited longer than the flag's head start
+    assert list(rebuilt(queue)) == list(queue) == ['A', 'P', 'B']
+
+
+def silent_manager(queue_policy):
+    """ QueueManager whose Slack calls go nowhere, skipped without slackclient """
+    pytest.importorskip('slack')
+    from api import Slack
+    from manager import QueueManager
+
+    class SilentSlack(Slack):
+        def __init__(self):
+            pass
+
+        async def get_user_name(self, user_id):
+            return user_id
+
+        async def get_im_channel(self, user_id):
+            return 'D' + user_id
+
+        async def send_chat_text(self, channel_id, text, priority=None):
+            return self
+
+        async def send_chat_block(self, channel_id, block, priority=None):
+            return self
+
+        async def get_request_block(self, student_uid):
+            return []
+
+        async def warm_im_channels(self, user_ids):
+            pass
+
+    return QueueManager(SilentSlack(), queue_policy=queue_policy)
+
+
+def test_pass_keeps_request_time_apart_from_queue_key():
+    manager = silent_manager('aging')
+
+    async def run():
+        await manager.toggle_system_active(True)
+        await manager.ta_login('T1')
+        for student in ['A', 'B', 'C']:
+            await manager.student_request(student, None)
+        assert await manager.ta_pass('T1') == 'A'   # No other TA: A goes back in front, T1 takes B
+        assert await manager.ta_pass('T9') is None
+
+    asyncio.run(run())
+    queue = manager.student_queue
+    assert list(queue) == ['A', 'C']
+    assert manager._queued_at['A'] > manager._queued_at['C']    # Request time stays real, wait stats use it
+    assert manager.to_model().queue_key == {'A': queue.key_of('A')}
+
+
+def test_flag_under_fifo_does_nothing():
+    manager = silent_manager('fifo')
+    for item, queued_at in [('A', 0.0), ('B', 100.0), ('C', 200.0)]:
+        manager.student_queue.append(item, queued_at)
+        manager._queued_at[item] = queued_at
+    assert not manager.can_flag()
+    assert asyncio.run(manager.flag_student('C')) == 3
+    assert list(manager.student_queue) == ['A', 'B', 'C']
+    assert manager.student_queue.class_of('C') == CLASS_NORMAL
+
+
+def test_stale_clicks_do_nothing():
+    manager = silent_manager('aging')
+
+    async def run():
+        await manager.toggle_system_active(True)
+        await manager.student_request('A', None)
+        await manager.student_request('A', None)       # Connect clicked twice
+        await manager.student_remove_from_queue('B', None)   # Never queued
+        await manager.ta_login('T1')
+        await manager.student_remove_from_queue('A', None)   # Picked up meanwhile
+        await manager.stop()
+
+    asyncio.run(run())
+    assert list(manager.student_queue) == []
+    assert manager.get_student_status('A') == 'busy'
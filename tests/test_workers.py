@@ -0,0 +1,24 @@
+import asyncio
+
+from workers import KeyedWorkerPool, JOB_STATE, JOB_COSMETIC
+
+
+def test_state_changes_run_ahead_of_cosmetic_jobs():
+    pool = KeyedWorkerPool(workers=1, queue_size=3)
+    order = []
+
+    def job(label):
+        async def run():
+            order.append(label)
+        return run
+
+    async def run():
+        pool.start()
+        submitted = [pool.submit('U1', job(f'refresh{i}'), JOB_COSMETIC) for i in range(4)]
+        submitted += [pool.submit('U2', job(f'done{i}'), JOB_STATE) for i in range(3)]  # Never waits, never shed
+        await pool.stop()
+        return submitted
+
+    assert asyncio.run(run()) == [True, True, True, False, True, True, True]
+    assert order == ['done0', 'done1', 'done2', 'refresh0', 'refresh1', 'refresh2']
+    assert pool.shed == 1
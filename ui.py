@@ -1,4 +1,9 @@
 import datetime
+import json
+import re
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+from time import time
 import pytz
 
 DIVIDER = {"type": "divider"}
@@ -77,14 +82,24 @@ def off_confirm():
 
 
 def welcome_title(greeting_name):
-    utc_now = pytz.utc.localize(datetime.datetime.utcnow())
-    pst_now = utc_now.astimezone(pytz.timezone("America/Los_Angeles"))
-    current_hour = pst_now.hour
-    current_greeting = ("morning" if 5 <= current_hour <= 11
-                        else "afternoon" if 12 <= current_hour <= 17
-                        else "evening" if 18 <= current_hour <= 22
-                        else "night")
-    return text(f"Good {current_greeting} {greeting_name},")
+    return text(f"Good {current_greeting()} {greeting_name},")
+
+
+_greeting_hour = (None, None)  # (UTC hour since epoch, greeting)
+
+
+def current_greeting():
+    """ Greeting for the current hour in PST, computed once per hour (LA offsets are whole hours) """
+    global _greeting_hour
+    epoch_hour = int(time() // 3600)
+    if _greeting_hour[0] != epoch_hour:
+        utc_now = pytz.utc.localize(datetime.datetime.utcnow())
+        current_hour = utc_now.astimezone(pytz.timezone("America/Los_Angeles")).hour
+        _greeting_hour = (epoch_hour, ("morning" if 5 <= current_hour <= 11
+                                       else "afternoon" if 12 <= current_hour <= 17
+                                       else "evening" if 18 <= current_hour <= 22
+                                       else "night"))
+    return _greeting_hour[1]
 
 
 def greeting(is_ta, is_active, is_system_on):
@@ -100,5 +115,73 @@ def greeting(is_ta, is_active, is_system_on):
             return text(":red_circle: You are currently offline. Click TA Login to start accept requests.")
 
 
+def format_eta(seconds):
+    """ Rounded wait estimate, finer precision would promise more than the estimate knows """
+    minutes = round(seconds / 60)
+    if minutes < 1:
+        return "less than a minute"
+    elif minutes < 60:
+        return f"about {minutes} min"
+    else:
+        return f"about {minutes // 60} h {minutes % 60} min"
+
+
 def active_ta(active_num):
     return text(f"*{active_num} TA(s) Active*:")
+
+
+# Pre-serialized blocks for the App Home
+# Views are published as JSON strings: static blocks are serialized once at import,
+# dynamic ones are templates whose slots are JSON-escaped and spliced in.
+def raw(block):
+    """ Serialize a block once, the result can be placed in a view as is """
+    return json.dumps(block, separators=(',', ':'))
+
+
+class Template:
+    """
+    Block serialized once with named slots, written as "@@name@@" string values
+    fill() only escapes the slot values and joins the literal parts.
+    """
+    _SLOT = re.compile(r'"@@(\w+)@@"')
+
+    def __init__(self, block):
+        self._parts = self._SLOT.split(raw(block))  # Literal, slot name, literal, ...
+
+    def fill(self, **slots):
+        parts = self._parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = encode_basestring_ascii(str(slots[parts[i]]))
+        return ''.join(parts)
+
+
+DIVIDER_RAW = raw(DIVIDER)
+EMPTY_TEXT_RAW = raw(text(''))
+_TEXT = Template(text('@@text@@'))
+
+
+def text_raw(text_str):
+    return EMPTY_TEXT_RAW if text_str == '' else _TEXT.fill(text=text_str)
+
+
+def list_quote_text_raw(text_str_list):
+    assert isinstance(text_str_list, list)
+    return text_raw('> ' + '\n> '.join(text_str_list)) if len(text_str_list) != 0 else EMPTY_TEXT_RAW
+
+
+def welcome_title_raw(greeting_name):
+    return _TEXT.fill(text=f"Good {current_greeting()} {greeting_name},")
+
+
+@lru_cache(maxsize=None)
+def greeting_raw(is_ta, is_active, is_system_on):
+    return raw(greeting(is_ta, is_active, is_system_on))
+
+
+def active_ta_raw(active_num):
+    return _TEXT.fill(text=f"*{active_num} TA(s) Active*:")
+
+
+def view_raw(view_type, blocks_raw):
+    """ :param blocks_raw: List of serialized blocks """
+    return f'{{"type":"{view_type}","blocks":[{",".join(blocks_raw)}]}}'
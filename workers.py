@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+# Job priorities, lower runs first
+JOB_STATE = 0       # Changes queue state, e.g. Connect, Done, Pass, TA login
+JOB_COSMETIC = 1    # Only republishes a home view
+
+
+class KeyedWorkerPool:
+    """
+    Bounded pool of asyncio workers running jobs in the background
+    Jobs with the same key always land on the same worker, so jobs of one priority run in submission order, and
+    state changing jobs run ahead of cosmetic ones queued before them.
+    Submitting never waits, it runs while Slack waits for its answer. A worker already holding queue_size jobs
+    drops new cosmetic jobs; state changing jobs, i.e. clicks, are always queued.
+    """
+
+    def __init__(self, workers=8, queue_size=256):
+        assert workers > 0 and queue_size > 0
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queues = []
+        self._tasks = []
+        self._seq = 0               # Keeps submission order within a priority
+        # Metrics
+        self.submitted = 0
+        self.shed = 0               # Cosmetic jobs dropped on a full worker queue
+        self.completed = 0
+        self.failed = 0
+        self.last_lag = 0.0         # Seconds between submit and start of the latest job
+        self.max_lag = 0.0
+
+    def start(self):
+        if len(self._tasks) != 0:
+            return
+        self._queues = [asyncio.PriorityQueue() for _ in range(self.workers)]
+        self._tasks = [asyncio.ensure_future(self._work(q)) for q in self._queues]
+
+    async def stop(self):
+        """ Finish queued jobs then stop workers """
+        for q in self._queues:
+            await q.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def is_running(self):
+        return len(self._tasks) != 0
+
+    def submit(self, key, coro_fn, priority=JOB_STATE):
+        """
+        :param key: Ordering key, e.g. user ID
+        :param coro_fn: Zero-argument coroutine function to run
+        :param priority: JOB_STATE or JOB_COSMETIC
+        :return: Whether the job was queued
+        """
+        assert self.is_running()
+        q = self._queues[hash(key) % self.workers]
+        if priority != JOB_STATE and q.qsize() >= self.queue_size:
+            self.shed += 1
+            return False
+        self.submitted += 1
+        self._seq += 1
+        q.put_nowait((priority, self._seq, monotonic(), coro_fn))
+        return True
+
+    def depth(self):
+        """ Jobs waiting to start across all workers """
+        return sum(q.qsize() for q in self._queues)
+
+    async def _work(self, q):
+        while True:
+            _, _, submitted_at, coro_fn = await q.get()
+            lag = monotonic() - submitted_at
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            try:
+                await coro_fn()
+                self.completed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception('Background job failed')
+            finally:
+                q.task_done()
+
+
+FAN_OUT_LIMIT = 16
+
+
+class FanOutResult:
+    """ Outcome of fan_out: per-item results in input order, and failures that did not abort the batch """
+
+    def __init__(self, items):
+        self.items = items
+        self.results = [None] * len(items)
+        self.failures = []          # (item, exception)
+
+    @property
+    def total(self):
+        return len(self.items)
+
+    @property
+    def succeeded(self):
+        return self.total - len(self.failures)
+
+    def __repr__(self):
+        return f'FanOutResult({self.succeeded}/{self.total} succeeded)'
+
+
+async def fan_out(items, coro_fn, limit=FAN_OUT_LIMIT):
+    """
+    Run coro_fn(item) for every item concurrently, at most `limit` at a time
+    A failing item is recorded in the result instead of cancelling the others.
+    :return: FanOutResult
+    """
+    items = list(items)
+    outcome = FanOutResult(items)
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(i, item):
+        async with semaphore:
+            try:
+                outcome.results[i] = await coro_fn(item)
+            except Exception as e:
+                outcome.failures.append((item, e))
+
+    await asyncio.gather(*[run(i, item) for i, item in enumerate(items)])
+    return outcome